@@ -81,6 +81,8 @@ def json_to_modules(json_data: dict[str, Any]) -> list[ModuleBase]:
             )
 
             ModuleRegistry.register(module)
+            if isinstance(module, GenericBinaryModule):
+                module.preload_binary()
             modules.append(module)
         except KeyError as e:
             raise ValueError(
@@ -0,0 +1,87 @@
+from collections import deque
+from pathlib import Path
+import math
+import threading
+from app.utils.constants import (
+    BINARY_BATCH_INITIAL_FRAMES,
+    BINARY_BATCH_MAX_FRAMES,
+    BINARY_BATCH_OVERHEAD,
+)
+
+# Invocations the startup cost of a binary is estimated from
+BATCH_SIZER_HISTORY = 16
+
+
+class BatchSizer:
+    """Number of frames a binary is given per invocation, adapted to its
+    measured startup cost.
+
+    Invocations are modelled as `startup + frames * per_frame` seconds, fitted
+    to the recent invocations. Batches are made just large enough for the
+    startup to be at most `overhead` of an invocation, up to `max_frames`, so
+    that binaries that start quickly are not handed more frames (and memory)
+    than they need. Until invocations of two different sizes have been seen,
+    the batch size doubles to get them.
+    """
+
+    def __init__(
+        self,
+        initial_frames: int = BINARY_BATCH_INITIAL_FRAMES,
+        max_frames: int = BINARY_BATCH_MAX_FRAMES,
+        overhead: float = BINARY_BATCH_OVERHEAD,
+    ) -> None:
+        self.max_frames = max(max_frames, 1)
+        self.overhead = min(max(overhead, 0.01), 1.0)
+        self.size = min(max(initial_frames, 1), self.max_frames)
+        # Estimated startup and per-frame costs, in seconds
+        self.startup: float | None = None
+        self.per_frame: float | None = None
+        self._lock = threading.Lock()
+        self._history: deque[tuple[int, float]] = deque(maxlen=BATCH_SIZER_HISTORY)
+
+    # Account for an invocation that processed `frames` frames in `seconds`
+    def record(self, frames: int, seconds: float) -> None:
+        with self._lock:
+            self._history.append((frames, seconds))
+            if not self._fit():
+                self.size = min(self.size * 2, self.max_frames)
+                return
+            assert self.startup is not None and self.per_frame is not None
+            if self.per_frame <= 0:
+                self.size = self.max_frames
+            else:
+                frames_needed = (
+                    self.startup
+                    * (1 - self.overhead)
+                    / (self.overhead * self.per_frame)
+                )
+                self.size = min(max(math.ceil(frames_needed), 1), self.max_frames)
+
+    # Least squares fit of the cost model; False without two batch sizes
+    def _fit(self) -> bool:
+        count = len(self._history)
+        mean_frames = sum(frames for frames, _ in self._history) / count
+        mean_seconds = sum(seconds for _, seconds in self._history) / count
+        variance = sum((frames - mean_frames) ** 2 for frames, _ in self._history)
+        if variance == 0:
+            return False
+        covariance = sum(
+            (frames - mean_frames) * (seconds - mean_seconds)
+            for frames, seconds in self._history
+        )
+        self.per_frame = covariance / variance
+        self.startup = max(mean_seconds - self.per_frame * mean_frames, 0.0)
+        return True
+
+
+_sizers: dict[Path, BatchSizer] = {}
+_sizers_lock = threading.Lock()
+
+
+# Batch sizer of an executable, shared by every run that uses it
+def get_batch_sizer(exe: Path) -> BatchSizer:
+    with _sizers_lock:
+        sizer = _sizers.get(exe)
+        if sizer is None:
+            sizer = _sizers[exe] = BatchSizer()
+        return sizer
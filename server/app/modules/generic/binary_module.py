@@ -1,25 +1,54 @@
 import numpy as np
+from app.modules.generic.binary_batch import BatchSizer, get_batch_sizer
+from app.modules.generic.binary_pool import binary_slot, map_ordered
+from app.modules.generic.binary_resolver import ResolvedBinary, binary_cache
+from app.modules.generic.binary_worker import STDERR_TAIL_LINES, BinaryWorker
 from app.modules.module import ModuleBase
-from typing import Any, override
+from app.modules.utils.enums import BinaryMode
+from typing import Any, Generator, override
 from app.schemas.module import GenericParameterModel, ModuleFormat, ModuleParameter
 from pathlib import Path
+from pydantic import PrivateAttr
 from app.utils.shared_functionality import (
     decode_video,
+    read_yuv420_frames,
     write_yuv420_frame,
     read_yuv420_frame,
+    write_yuv420_frames,
+)
+from app.utils.constants import (
+    BINARY_MAX_PROCESSES,
+    BINARY_POOL_MAX_FRAMES,
+    BINARY_TRANSPORT_DIR,
 )
 from app.utils.enums import VideoFormats
-import platform
+import contextlib
+import cv2
+import logging
 import subprocess
-import json
 import tempfile
-import os
+import time
 
 BASE_DIR = Path(__file__).resolve().parents[3]
+BINARIES_DIR = BASE_DIR / "binaries"
+
+logger = logging.getLogger(__name__)
+
+
+class BinaryRunError(RuntimeError):
+    pass
 
 
 class GenericBinaryModule(ModuleBase):
     parameter_model: Any = GenericParameterModel
+    # Persistent workers of the running sessions, by id of their parameters
+    _workers: dict[int, BinaryWorker] = PrivateAttr(
+        default_factory=dict[int, BinaryWorker]
+    )
+    # Binary of the running sessions, by id of their parameters
+    _binaries: dict[int, ResolvedBinary] = PrivateAttr(
+        default_factory=dict[int, ResolvedBinary]
+    )
 
     @override
     def get_parameters(self) -> list[ModuleParameter]:
@@ -49,21 +78,111 @@ class GenericBinaryModule(ModuleBase):
         output_yuv = self.execute_binary(parameters, yuv, output_path)
         return output_yuv
 
+    # Binaries declaring the "stream" mode in their config get one process per
+    # run, fed raw I420 frames, instead of one process per frame; binaries
+    # declaring the "batch" mode get I420 files of several frames
+    @override
+    def open_session(
+        self, parameters: dict[str, Any]
+    ) -> contextlib.AbstractContextManager[None]:
+        binary = self.get_binary()
+
+        @contextlib.contextmanager
+        def session() -> Generator[None]:
+            worker: BinaryWorker | None = None
+            if binary.mode == BinaryMode.STREAM:
+                # "-" stands for the standard streams
+                command = binary.build_command(parameters, "-", "-")
+                worker = self._workers[id(parameters)] = BinaryWorker(command)
+            self._binaries[id(parameters)] = binary
+            try:
+                yield
+            finally:
+                del self._binaries[id(parameters)]
+                if worker is not None:
+                    del self._workers[id(parameters)]
+                    worker.close()
+
+        return session()
+
+    # The files the binary is resolved from, which change when it is uploaded
+    # again or its config is edited
+    @override
+    def get_code_version(self) -> Any:
+        try:
+            return self.get_binary().signature
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # The one process of a stream mode binary sees the frames in the order they
+    # are written to it, and may keep state between them
+    @override
+    def is_stateful(self, parameters: dict[str, Any]) -> bool:
+        try:
+            return self.get_binary().mode == BinaryMode.STREAM
+        except (FileNotFoundError, ValueError):
+            return False
+
+    # Frames to hand the binary at once: enough for every binary slot to run
+    # an invocation (of a batch of frames in batch mode, or of the plugin in
+    # plugin mode), while the one process of a stream mode binary takes frames
+    # one at a time
+    @override
+    def get_batch_size(self, parameters: dict[str, Any]) -> int:
+        binary = self._binaries.get(id(parameters)) or self.get_binary()
+        if binary.mode == BinaryMode.STREAM:
+            return 1
+        if binary.mode == BinaryMode.BATCH:
+            size = get_batch_sizer(binary.exe).size
+            return max(min(size * BINARY_MAX_PROCESSES, BINARY_POOL_MAX_FRAMES), size)
+        return max(min(BINARY_MAX_PROCESSES, BINARY_POOL_MAX_FRAMES), 1)
+
+    # Invocations of the frames (or of batches of up to the batch size frames
+    # in batch mode) run concurrently, up to the server's binary slots; their
+    # results are put back in frame order
+    @override
+    def process_batch(
+        self, frames: list[np.ndarray], parameters: dict[str, Any]
+    ) -> list[np.ndarray]:
+        binary = self._binaries.get(id(parameters))
+        if binary is None or id(parameters) in self._workers:
+            return super().process_batch(frames, parameters)
+        if binary.mode != BinaryMode.BATCH:
+            return map_ordered(
+                lambda frame: self.process_frame(frame, parameters), frames
+            )
+        sizer = get_batch_sizer(binary.exe)
+        size = sizer.size
+        batches = [frames[i : i + size] for i in range(0, len(frames), size)]
+        results = map_ordered(
+            lambda batch: self.execute_batch(binary, parameters, batch, sizer),
+            batches,
+        )
+        return [frame for batch in results for frame in batch]
+
     @override
     def process_frame(
         self, frame: np.ndarray, parameters: dict[str, Any]
     ) -> np.ndarray:
-        width, height = frame.shape[1], frame.shape[0]
+        worker = self._workers.get(id(parameters))
+        if worker is not None:
+            yuv: np.ndarray = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+            processed = worker.process(yuv.tobytes())
+            return cv2.cvtColor(
+                np.frombuffer(processed, dtype=np.uint8).reshape(yuv.shape),
+                cv2.COLOR_YUV2BGR_I420,
+            )
 
-        fd_in, input_path_raw = tempfile.mkstemp(suffix=".yuv")
-        fd_out, output_path_raw = tempfile.mkstemp(suffix=".yuv")
-        os.close(fd_in)
-        os.close(fd_out)
+        # Plugin mode binaries are called in-process on the frame itself
+        binary = self._binaries.get(id(parameters)) or self.get_binary()
+        if binary.plugin is not None:
+            arguments = binary.get_plugin_arguments(parameters)
+            with binary_slot():
+                return binary.plugin.process(frame, arguments)
 
-        input_path = Path(input_path_raw)
-        output_path = Path(output_path_raw)
+        width, height = frame.shape[1], frame.shape[0]
 
-        try:
+        with transport_files() as (input_path, output_path):
             # 1. Write input frame
             write_yuv420_frame(frame, input_path)
 
@@ -73,82 +192,75 @@ class GenericBinaryModule(ModuleBase):
             # 3. Read processed frame
             result_frame = read_yuv420_frame(out, width, height)
 
-        finally:
-            input_path.unlink(missing_ok=True)
-            output_path.unlink(missing_ok=True)
-
         return result_frame
 
+    # Executable for this platform and its parameter config, resolved once
+    # and again only when their files change
+    def get_binary(self) -> ResolvedBinary:
+        if self.executable_path is None:
+            raise FileNotFoundError("Executable path is not defined")
+        return binary_cache.get(BINARIES_DIR, self.executable_path)
+
+    # Resolve the binary ahead of its first run, e.g. when the module is
+    # loaded; binaries that are not installed or valid yet fail when run
+    def preload_binary(self) -> None:
+        with contextlib.suppress(FileNotFoundError, ValueError):
+            self.get_binary()
+
+    # Run the binary once on consecutive frames of the same size, written to
+    # one I420 file, and split its output file back into frames
+    def execute_batch(
+        self,
+        binary: ResolvedBinary,
+        parameters: dict[str, Any],
+        frames: list[np.ndarray],
+        sizer: BatchSizer,
+    ) -> list[np.ndarray]:
+        height, width = frames[0].shape[:2]
+        with transport_files() as (input_path, output_path):
+            write_yuv420_frames(frames, input_path)
+            command = binary.build_command(
+                parameters, str(input_path), str(output_path)
+            )
+            sizer.record(len(frames), run_binary(command))
+            return read_yuv420_frames(output_path, width, height, len(frames))
+
     # Function that executes the binary
     def execute_binary(
         self, parameters: dict[str, Any], input: Path, output: Path
     ) -> Any:
-        if self.executable_path is None:
-            raise FileNotFoundError("Executable path is not defined")
-        binary_name: str = self.executable_path
-        base_dir = Path(__file__).resolve().parents[3]
-        binary_dir = base_dir / "binaries" / binary_name
-
-        # Detect OS and choose binary accordingly
-        exe_path: Path = binary_dir / f"{platform.system()}-{platform.machine()}"
-        if not exe_path.exists():
-            raise FileNotFoundError(f"Executable path not found: {exe_path}")
-
-        if platform.system() in {"Linux", "Darwin"}:
-            exe = exe_path / f"{binary_name}"
-            subprocess.run(["chmod", "+x", str(exe)], check=True)
-        else:
-            exe = exe_path / f"{binary_name}.exe"
-
-        if not exe.exists():
-            raise FileNotFoundError(f"Executable not found: {exe}")
-
-        # Load parameter config
-        config_path = exe_path / "config.json"
-        if not config_path.exists():
-            raise FileNotFoundError(f"Config file not found: {config_path}")
-        try:
-            with open(config_path, "r") as f:
-                config = json.load(f)
-        except (json.JSONDecodeError, UnicodeDecodeError):
-            raise ValueError(f"Invalid JSON in config file: {config_path}")
-
-        # Build command
-        command = [str(exe)]
-
-        # Go through all expected parameters
-        for param in config["parameters"]:
-            name = param["name"]
-            flag = param["flag"]
-            param_type = param["type"]
-            required = param.get("required", False)
-
-            # Handle parameters
-            if name == "input":
-                value = str(input)
-            elif name == "output":
-                value = str(output)
-            else:
-                if name not in parameters:
-                    if required:
-                        raise ValueError(f"Missing required parameter: {name}")
-                    continue
-                value = parameters[name]
-
-            # Boolean flags (e.g., --verbose)
-            if param_type == "bool":
-                if value:
-                    command.append(flag)
-            else:
-                command += [flag, str(value)]
+        binary = self._binaries.get(id(parameters)) or self.get_binary()
+        command = binary.build_command(parameters, str(input), str(output))
+        run_binary(command)
+        return output
 
-        try:
-            result = subprocess.run(command, check=True, capture_output=True, text=True)
-            print("STDOUT:", result.stdout)
-        except subprocess.CalledProcessError as e:
-            print("Execution failed:")
-            print("STDOUT:\n", e.stdout)
-            print("STDERR:\n", e.stderr)
-            raise
 
-        return output
+# Input and output files of an invocation, in a fresh directory of the
+# transport directory (memory-backed where available) that is removed after
+@contextlib.contextmanager
+def transport_files() -> Generator[tuple[Path, Path]]:
+    with tempfile.TemporaryDirectory(
+        prefix="binary-", dir=BINARY_TRANSPORT_DIR or None
+    ) as tmp_dir:
+        yield Path(tmp_dir) / "input.yuv", Path(tmp_dir) / "output.yuv"
+
+
+# Run a binary in one of the server's binary slots; returns how long it ran,
+# not counting the wait for a slot. A failed run raises BinaryRunError with the
+# end of the binary's stderr
+def run_binary(command: list[str]) -> float:
+    try:
+        with binary_slot():
+            started = time.perf_counter()
+            result = subprocess.run(command, check=True, capture_output=True, text=True)
+            seconds = time.perf_counter() - started
+    except subprocess.CalledProcessError as e:
+        logger.debug("Binary %s output:\n%s", command[0], e.stdout)
+        stderr = "\n".join(str(e.stderr).splitlines()[-STDERR_TAIL_LINES:])
+        raise BinaryRunError(
+            f"Binary {command[0]} exited with code {e.returncode}"
+            + (f":\n{stderr}" if stderr else "")
+        ) from e
+    if result.stdout:
+        logger.debug("Binary %s output:\n%s", command[0], result.stdout)
+    return seconds
@@ -0,0 +1,126 @@
+from pathlib import Path
+import contextlib
+import ctypes
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+# Version of the plugin interface below, which plugins report through
+# PLUGIN_VERSION_SYMBOL
+PLUGIN_ABI_VERSION = 1
+PLUGIN_VERSION_SYMBOL = "mmrp_abi_version"
+PLUGIN_PROCESS_SYMBOL = "mmrp_process_frame"
+
+
+class PluginError(RuntimeError):
+    pass
+
+
+class NativePlugin:
+    """A module's shared library, called in-process on the frame buffers.
+
+    The library exports:
+
+        int32_t mmrp_abi_version(void);
+        int32_t mmrp_process_frame(
+            const uint8_t *input, uint8_t *output,
+            int32_t width, int32_t height, int32_t stride,
+            const char *const *names, const char *const *values, int32_t count);
+
+    `mmrp_abi_version` returns PLUGIN_ABI_VERSION. `mmrp_process_frame` reads
+    a BGR24 frame of `height` rows of `stride` bytes from `input` and writes
+    the processed frame, of the same layout, to `output`; the buffers are the
+    frames' own memory, and do not overlap. The module's parameters are given
+    as `count` UTF-8 name and value strings. It returns 0 on success. It may be
+    called from several threads at once, with distinct buffers.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        try:
+            self._library = ctypes.CDLL(str(load_path(path)))
+            version = getattr(self._library, PLUGIN_VERSION_SYMBOL)
+            self._process = getattr(self._library, PLUGIN_PROCESS_SYMBOL)
+        except (OSError, AttributeError) as e:
+            raise ValueError(f"Invalid plugin library {path.name}: {e}")
+        version.argtypes = []
+        version.restype = ctypes.c_int32
+        if version() != PLUGIN_ABI_VERSION:
+            raise ValueError(
+                f"Plugin library {path.name} implements version {version()} of "
+                f"the plugin interface, not {PLUGIN_ABI_VERSION}"
+            )
+        self._process.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_int32,
+            ctypes.c_int32,
+            ctypes.c_int32,
+            ctypes.POINTER(ctypes.c_char_p),
+            ctypes.POINTER(ctypes.c_char_p),
+            ctypes.c_int32,
+        ]
+        self._process.restype = ctypes.c_int32
+
+    # Process a BGR frame; the plugin reads the frame's buffer and writes the
+    # returned frame's buffer directly. The GIL is released during the call
+    def process(
+        self, frame: np.ndarray, arguments: list[tuple[str, str]]
+    ) -> np.ndarray:
+        if frame.dtype != np.uint8 or frame.ndim != 3 or frame.shape[2] != 3:
+            raise ValueError(f"Plugins process BGR frames, got {frame.shape} frame")
+        # Only copied if its rows are not laid out one after the other
+        frame = np.ascontiguousarray(frame)
+        output = np.empty_like(frame)
+        names = (ctypes.c_char_p * len(arguments))(
+            *(name.encode("utf-8") for name, _ in arguments)
+        )
+        values = (ctypes.c_char_p * len(arguments))(
+            *(value.encode("utf-8") for _, value in arguments)
+        )
+        status = self._process(
+            frame.ctypes.data,
+            output.ctypes.data,
+            frame.shape[1],
+            frame.shape[0],
+            frame.strides[0],
+            names,
+            values,
+            len(arguments),
+        )
+        if status != 0:
+            raise PluginError(f"Plugin {self.path.name} failed with status {status}")
+        return output
+
+
+# Paths of the libraries loaded by this process, with the version loaded and
+# the copy it was loaded from, if any
+_loaded: dict[Path, tuple[int, Path | None]] = {}
+_loaded_lock = threading.Lock()
+# Directory of the copies, removed when the process exits
+_copies_dir: tempfile.TemporaryDirectory[str] | None = None
+
+
+# Path to load a library from. A library that was already loaded from its path
+# would be returned again by the loader, even if the file was replaced since,
+# so changed libraries are loaded from a copy named after their version. The
+# copy of the version they replace is removed; plugins still using it keep
+# their mapping of it
+def load_path(path: Path) -> Path:
+    global _copies_dir
+    with _loaded_lock:
+        version = path.stat().st_mtime_ns
+        loaded_version, previous = _loaded.setdefault(path, (version, None))
+        if loaded_version == version:
+            return previous or path
+        if _copies_dir is None:
+            _copies_dir = tempfile.TemporaryDirectory(prefix="plugins-")
+        copy = Path(_copies_dir.name) / f"{path.stem}-{version}{path.suffix}"
+        shutil.copy2(path, copy)
+        _loaded[path] = (version, copy)
+    if previous is not None:
+        # Libraries cannot be removed while loaded on Windows
+        with contextlib.suppress(OSError):
+            previous.unlink()
+    return copy
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Generator, TypeVar
+import threading
+from app.utils.constants import BINARY_MAX_PROCESSES
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Held by every running binary invocation, whichever job or runner starts it,
+# so that binaries never compete for more cores than the server has
+binary_slots = threading.BoundedSemaphore(max(BINARY_MAX_PROCESSES, 1))
+
+# Threads waiting on the binary invocations of batches, shared by every job
+binary_executor = ThreadPoolExecutor(
+    max_workers=max(BINARY_MAX_PROCESSES, 1), thread_name_prefix="binary"
+)
+
+
+# Hold one of the server's binary slots while a binary runs
+@contextmanager
+def binary_slot() -> Generator[None]:
+    with binary_slots:
+        yield
+
+
+# Apply `function` to every item concurrently on the binary threads, and
+# return the results in the order of the items. The first failure is raised
+# once the items before it are done; items not started yet are cancelled
+def map_ordered(function: Callable[[T], R], items: list[T]) -> list[R]:
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    return list(binary_executor.map(function, items))
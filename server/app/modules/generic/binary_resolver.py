@@ -0,0 +1,199 @@
+from pathlib import Path
+from typing import Any, NamedTuple
+import json
+import os
+import platform
+import stat
+import threading
+from app.modules.generic.binary_plugin import NativePlugin
+from app.modules.utils.enums import BinaryMode
+
+# (modification time, size) of each file a binary is resolved from
+FileSignature = tuple[tuple[int, int], ...]
+
+
+class BinaryArgument(NamedTuple):
+    """A parameter of a binary's command line, from its config."""
+
+    name: str
+    flag: str
+    type: str
+    required: bool
+
+
+class ResolvedBinary(NamedTuple):
+    """The executable of a binary for this platform and its parsed config,
+    with the command line template built from the config; plugin mode binaries
+    have their library loaded instead."""
+
+    exe: Path
+    config: dict[str, Any]
+    mode: BinaryMode
+    arguments: list[BinaryArgument]
+    plugin: NativePlugin | None
+    # Files the binary was resolved from, and their signature then
+    files: list[Path]
+    signature: FileSignature
+
+    # Command line for the given parameters; "input" and "output" parameters
+    # get the given paths
+    def build_command(
+        self, parameters: dict[str, Any], input: str, output: str
+    ) -> list[str]:
+        command = [str(self.exe)]
+        for argument in self.arguments:
+            if argument.name == "input":
+                value = input
+            elif argument.name == "output":
+                value = output
+            elif argument.name in parameters:
+                value = parameters[argument.name]
+            elif argument.required:
+                raise ValueError(f"Missing required parameter: {argument.name}")
+            else:
+                continue
+
+            # Boolean flags (e.g., --verbose)
+            if argument.type == "bool":
+                if value:
+                    command.append(argument.flag)
+            else:
+                command += [argument.flag, str(value)]
+        return command
+
+    # Parameters of a plugin call as (name, value) strings; boolean values are
+    # "1" or "0"
+    def get_plugin_arguments(self, parameters: dict[str, Any]) -> list[tuple[str, str]]:
+        arguments: list[tuple[str, str]] = []
+        for argument in self.arguments:
+            if argument.name in ("input", "output"):
+                continue
+            if argument.name not in parameters:
+                if argument.required:
+                    raise ValueError(f"Missing required parameter: {argument.name}")
+                continue
+            value = parameters[argument.name]
+            if argument.type == "bool":
+                arguments.append((argument.name, "1" if value else "0"))
+            else:
+                arguments.append((argument.name, str(value)))
+        return arguments
+
+
+# Executable and config of a binary for this platform; the config must exist,
+# the executable is checked once the config tells whether it is needed
+def get_binary_files(binaries_dir: Path, binary_name: str) -> tuple[Path, Path]:
+    # Detect OS and choose binary accordingly
+    exe_path = binaries_dir / binary_name / f"{platform.system()}-{platform.machine()}"
+    if not exe_path.exists():
+        raise FileNotFoundError(f"Executable path not found: {exe_path}")
+    if platform.system() in {"Linux", "Darwin"}:
+        exe = exe_path / binary_name
+    else:
+        exe = exe_path / f"{binary_name}.exe"
+    config_path = exe_path / "config.json"
+    if not config_path.exists():
+        raise FileNotFoundError(f"Config file not found: {config_path}")
+    return exe, config_path
+
+
+def get_file_signature(files: list[Path]) -> FileSignature:
+    stats = [path.stat() for path in files]
+    return tuple((result.st_mtime_ns, result.st_size) for result in stats)
+
+
+# Load the config of a binary, then make its executable runnable and build its
+# command line template, or load its library for plugin mode binaries
+def resolve_binary(exe: Path, config_path: Path) -> ResolvedBinary:
+    try:
+        with open(config_path, "r") as f:
+            config: dict[str, Any] = json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError(f"Invalid JSON in config file: {config_path}")
+    try:
+        arguments = [
+            BinaryArgument(
+                param["name"],
+                param["flag"],
+                param["type"],
+                param.get("required", False),
+            )
+            for param in config["parameters"]
+        ]
+        mode = BinaryMode(config.get("mode", BinaryMode.FILE))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid config file {config_path}: {e!r}")
+
+    if mode == BinaryMode.PLUGIN:
+        library = find_plugin_library(exe.parent, config)
+        files = [config_path, library]
+        signature = get_file_signature(files)
+        plugin = NativePlugin(library)
+        return ResolvedBinary(exe, config, mode, arguments, plugin, files, signature)
+
+    if not exe.exists():
+        raise FileNotFoundError(f"Executable not found: {exe}")
+    if platform.system() in {"Linux", "Darwin"} and not os.access(exe, os.X_OK):
+        exe.chmod(exe.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    # Taken after the chmod, which changes neither time nor size
+    files = [config_path, exe]
+    signature = get_file_signature(files)
+    return ResolvedBinary(exe, config, mode, arguments, None, files, signature)
+
+
+# Shared library file extension of each platform
+LIBRARY_SUFFIXES = {"Linux": ".so", "Darwin": ".dylib", "Windows": ".dll"}
+
+
+# Library of a plugin mode binary: the one the config names, or else the only
+# library uploaded for this platform
+def find_plugin_library(exe_path: Path, config: dict[str, Any]) -> Path:
+    name = config.get("library")
+    if isinstance(name, str):
+        library = exe_path / Path(name).name
+        if not library.exists():
+            raise FileNotFoundError(f"Plugin library not found: {library}")
+        return library
+    suffix = LIBRARY_SUFFIXES.get(platform.system(), ".so")
+    libraries = sorted(exe_path.glob(f"*{suffix}"))
+    if len(libraries) != 1:
+        raise FileNotFoundError(
+            f"Expected one {suffix} plugin library in {exe_path}, found "
+            f'{len(libraries)}; name it in the config\'s "library" field'
+        )
+    return libraries[0]
+
+
+class BinaryCache:
+    """Resolved binaries by directory, so that invocations only check that
+    the files a binary was resolved from have not changed since, rather than
+    resolving it again."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._binaries: dict[Path, ResolvedBinary] = {}
+
+    def get(self, binaries_dir: Path, binary_name: str) -> ResolvedBinary:
+        exe, config_path = get_binary_files(binaries_dir, binary_name)
+        key = exe.parent
+        with self._lock:
+            binary = self._binaries.get(key)
+        try:
+            if binary is not None and get_file_signature(binary.files) == (
+                binary.signature
+            ):
+                return binary
+        except FileNotFoundError:
+            pass  # reported by resolving it again
+
+        binary = resolve_binary(exe, config_path)
+        with self._lock:
+            self._binaries[key] = binary
+        return binary
+
+    def clear(self) -> None:
+        with self._lock:
+            self._binaries.clear()
+
+
+binary_cache = BinaryCache()
@@ -0,0 +1,158 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO
+import subprocess
+import threading
+from app.modules.generic.binary_pool import binary_slot
+from app.utils.constants import BINARY_WORKER_TIMEOUT
+
+# Lines of a worker's stderr kept to explain its failures
+STDERR_TAIL_LINES = 20
+
+
+class BinaryWorkerError(RuntimeError):
+    pass
+
+
+class BinaryWorker:
+    """A long-lived binary that processes raw frames over its standard streams.
+
+    Every frame is written to the binary's stdin as-is, and the processed
+    frame, of the same size, is read back from its stdout; frames are only
+    delimited by their size, which is fixed by the first frame. The process
+    is started on the first frame and stops when its stdin is closed. A frame
+    not returned within `timeout` seconds kills the process; once failed, the
+    worker raises its error for every further frame.
+    """
+
+    def __init__(self, command: list[str], timeout: float = BINARY_WORKER_TIMEOUT):
+        self.command = command
+        self.timeout = timeout
+        self.frame_size: int | None = None
+        self._process: subprocess.Popen[bytes] | None = None
+        self._lock = threading.Lock()
+        self._error: BinaryWorkerError | None = None
+        self._timed_out = False
+        self._stderr: deque[str] = deque(maxlen=STDERR_TAIL_LINES)
+        self._stderr_thread: threading.Thread | None = None
+        # Writes frames to stdin while stdout is read, so that binaries that
+        # write while they read cannot block on a full pipe
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="binary-worker-stdin"
+        )
+
+    # Process one frame; frames are processed one at a time, in call order,
+    # each holding one of the server's binary slots
+    def process(self, data: bytes) -> bytes:
+        with self._lock, binary_slot():
+            if self._error is not None:
+                raise self._error
+            if self.frame_size is None:
+                self.frame_size = len(data)
+                self._start()
+            elif len(data) != self.frame_size:
+                raise ValueError(
+                    f"Frame size changed from {self.frame_size} to {len(data)} bytes"
+                )
+            process = self._process
+            assert process is not None and process.stdin and process.stdout
+
+            written = self._writer.submit(self._write, process.stdin, data)
+            timer = threading.Timer(self.timeout, self._kill)
+            timer.start()
+            try:
+                output = read_exactly(process.stdout, len(data))
+            finally:
+                timer.cancel()
+            try:
+                written.result()
+            except OSError:
+                pass  # the binary exited; reported below
+            if len(output) != len(data):
+                self._error = self._describe_failure(len(output))
+                self._kill()
+                raise self._error
+            return output
+
+    def close(self) -> None:
+        with self._lock:
+            process = self._process
+            if process is not None:
+                if process.stdin is not None:
+                    try:
+                        process.stdin.close()
+                    except OSError:
+                        pass
+                try:
+                    process.wait(timeout=self.timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                if process.stdout is not None:
+                    process.stdout.close()
+                if self._stderr_thread is not None:
+                    self._stderr_thread.join()
+            self._writer.shutdown(wait=True)
+
+    def _start(self) -> None:
+        self._process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._stderr_thread = threading.Thread(
+            target=self._drain_stderr,
+            args=(self._process.stderr,),
+            name="binary-worker-stderr",
+            daemon=True,
+        )
+        self._stderr_thread.start()
+
+    def _write(self, stdin: IO[bytes], data: bytes) -> None:
+        stdin.write(data)
+        stdin.flush()
+
+    # Keep the last lines of stderr; reading it also keeps the binary from
+    # blocking on a full pipe
+    def _drain_stderr(self, stderr: IO[bytes]) -> None:
+        with stderr:
+            for line in stderr:
+                self._stderr.append(line.decode("utf-8", "replace").rstrip())
+
+    def _kill(self) -> None:
+        if self._process is not None and self._process.poll() is None:
+            self._timed_out = self._error is None
+            self._process.kill()
+
+    def _describe_failure(self, received: int) -> BinaryWorkerError:
+        if self._timed_out:
+            reason = f"did not return a frame within {self.timeout} seconds"
+        else:
+            assert self._process is not None
+            try:
+                code = self._process.wait(timeout=self.timeout)
+                reason = f"exited with code {code}"
+            except subprocess.TimeoutExpired:
+                reason = "closed its output"
+            reason += f" after {received} of {self.frame_size} bytes of a frame"
+        # Give stderr a moment to be drained up to the exit
+        if self._stderr_thread is not None:
+            self._stderr_thread.join(timeout=1)
+        stderr = "\n".join(self._stderr)
+        return BinaryWorkerError(
+            f"Binary {self.command[0]} {reason}" + (f":\n{stderr}" if stderr else "")
+        )
+
+
+# Read `size` bytes, or fewer if the stream ends first
+def read_exactly(stream: IO[bytes], size: int) -> bytes:
+    chunks: list[bytes] = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
@@ -1,5 +1,5 @@
 import contextlib
-from typing import Any, Iterator, override
+from typing import Any, Iterator, NamedTuple, override
 import cv2
 import numpy as np
 from app.modules.module import ModuleBase
@@ -8,6 +8,14 @@ from app.utils.shared_functionality import get_video_path, as_context
 from pathlib import Path
 
 
+# Properties reported by the container; the frame count may be an estimate
+class VideoInfo(NamedTuple):
+    fps: float
+    frame_count: int
+    width: int
+    height: int
+
+
 class VideoSource(ModuleBase):
     parameter_model: Any = VideoSourceParams
 
@@ -30,7 +38,15 @@ class VideoSource(ModuleBase):
         # Source frames are injected by the pipeline service, never called directly
         raise NotImplementedError("Frame injection is handled by the pipeline service")
 
+    # Resolve the source file path: mmrp/server/videos
+    def get_source_path(self, parameters: dict[str, Any]) -> Path:
+        return get_video_path(str(parameters["path"]))
+
     # Process video path
+    # An optional frame range can be given with the runtime "start_frame" and
+    # "end_frame" (exclusive) parameters. Given the start frame's timestamp
+    # (ms) as the runtime "start_timestamp" parameter, the capture is checked to
+    # land on it, since backends do not always seek where asked
     @override
     def process(
         self, input_data: Any, parameters: dict[str, Any]
@@ -38,7 +54,10 @@ class VideoSource(ModuleBase):
         # Get source file and name
         source_file: str = str(parameters["path"])
         name_without_ext = Path(source_file).stem
-        video_path = get_video_path(source_file)
+        video_path = self.get_source_path(parameters)
+        start_frame: int = int(parameters.get("start_frame", 0))
+        end_frame: int | None = parameters.get("end_frame")
+        start_timestamp: float | None = parameters.get("start_timestamp")
 
         cv2VideoCaptureContext = as_context(cv2.VideoCapture, lambda cap: cap.release())
 
@@ -49,14 +68,52 @@ class VideoSource(ModuleBase):
                 if not cap.isOpened():
                     raise ValueError(f"Could not open video file: {video_path}")
                 fps = cap.get(cv2.CAP_PROP_FPS)
+                grabbed = False
+                if start_frame > 0:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+                    if start_timestamp is not None:
+                        grabbed = cap.grab()
+                        landed = cap.get(cv2.CAP_PROP_POS_MSEC)
+                        if not grabbed or abs(landed - start_timestamp) > 500 / (
+                            fps or 30.0
+                        ):
+                            raise ValueError(
+                                f"Seeking to frame {start_frame} of {source_file} "
+                                f"landed at {landed:.0f} ms instead of "
+                                f"{start_timestamp:.0f} ms"
+                            )
 
                 def frame_generator():
-                    while True:
-                        ret, frame = cap.read()
+                    index = start_frame
+                    # The frame grabbed to check the seek comes first
+                    retrieve = grabbed
+                    while end_frame is None or index < end_frame:
+                        if retrieve:
+                            ret, frame = cap.retrieve()
+                            retrieve = False
+                        else:
+                            ret, frame = cap.read()
                         if not ret:
                             break
                         yield frame
+                        index += 1
 
                 yield name_without_ext, fps, frame_generator()
 
         return generator_context()
+
+    # Frame rate, number of frames and frame size of the video
+    def get_video_info(self, parameters: dict[str, Any]) -> VideoInfo:
+        video_path = get_video_path(str(parameters["path"]))
+
+        cv2VideoCaptureContext = as_context(cv2.VideoCapture, lambda cap: cap.release())
+
+        with cv2VideoCaptureContext(str(video_path)) as cap:
+            if not cap.isOpened():
+                raise ValueError(f"Could not open video file: {video_path}")
+            return VideoInfo(
+                fps=cap.get(cv2.CAP_PROP_FPS),
+                frame_count=int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+                width=int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                height=int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            )
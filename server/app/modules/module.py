@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from typing import Any
+import contextlib
 from pydantic import BaseModel, Field, ConfigDict
 import numpy as np
 from app.schemas.module import (
@@ -51,3 +52,33 @@ class ModuleBase(BaseModel, ABC):
         self, frame: np.ndarray, parameters: dict[str, Any]
     ) -> np.ndarray[Any]:
         pass
+
+    # Hold resources for the frames of one run (e.g. a long-lived process),
+    # released when the returned context exits; `parameters` are the module's
+    # parameters in that run. Nothing by default
+    def open_session(
+        self, parameters: dict[str, Any]
+    ) -> contextlib.AbstractContextManager[None]:
+        return contextlib.nullcontext()
+
+    # Version of the code the module runs (e.g. of its executable), part of
+    # the cache keys of its outputs so that they are not reused once it
+    # changes. None for the modules built into the server
+    def get_code_version(self) -> Any:
+        return None
+
+    # Whether the module keeps state from one frame to the next, and so must
+    # be given every frame of a run, in order
+    def is_stateful(self, parameters: dict[str, Any]) -> bool:
+        return False
+
+    # Number of consecutive frames the module would rather process at once,
+    # through process_batch
+    def get_batch_size(self, parameters: dict[str, Any]) -> int:
+        return 1
+
+    # Process consecutive frames, in order; one frame at a time by default
+    def process_batch(
+        self, frames: list[np.ndarray], parameters: dict[str, Any]
+    ) -> list[np.ndarray]:
+        return [self.process_frame(frame, parameters) for frame in frames]
@@ -1,10 +1,12 @@
+import contextlib
+import shutil
+import subprocess
 from pathlib import Path
-from typing import Any, Iterator, override
+from typing import Any, Callable, Iterator, override
 import cv2
 import numpy as np
 from app.modules.module import ModuleBase
 from app.schemas.module import ModuleFormat, ModuleParameter, VideoOutputParams
-from app.utils.shared_functionality import as_context
 
 
 class VideoOutput(ModuleBase):
@@ -31,38 +33,98 @@ class VideoOutput(ModuleBase):
     def process(
         self, input_data: Iterator[np.ndarray], parameters: dict[str, Any]
     ) -> Any:
-        # mmrp/server/output
-        out_path = (
+        with self.open_writer(parameters) as write:
+            for frame in input_data:
+                write(frame)
+
+    # Resolve the output file path: mmrp/server/output
+    def get_output_path(self, parameters: dict[str, Any]) -> Path:
+        return (
             Path(__file__).resolve().parent.parent.parent.parent
             / "output"
             / parameters["path"]
         )
-        out_path.parent.mkdir(parents=True, exist_ok=True)
-        out_path = str(out_path)
 
-        # Convert iterator to an explicit iterable to call next multiple times
-        input_data = iter(input_data)
+    # Open a writer that accepts frames one at a time, so callers can stream
+    # frames to disk as soon as they are produced instead of buffering them
+    def open_writer(
+        self, parameters: dict[str, Any]
+    ) -> contextlib.AbstractContextManager[Callable[[np.ndarray], None]]:
+        out_path = self.get_output_path(parameters)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
 
-        # First value is FPS
         fps = parameters["fps"]
         if not isinstance(fps, float):
             raise ValueError(f"Expected fps as float, got {type(fps)}")
 
-        # Second value is the first frame
-        first_frame = next(input_data)
-
-        h, w = first_frame.shape[:2]
         # FIXME: OpenCV warning (use a format that is supported with the codec)
         fourcc = getattr(cv2, "VideoWriter_fourcc")(*"VP80")
 
-        # context wrapper
-        cv2VideoWriterContext = as_context(
-            cv2.VideoWriter, lambda writer: writer.release()
+        @contextlib.contextmanager
+        def writer_context():
+            writer: cv2.VideoWriter | None = None
+
+            # The frame size is only known once the first frame arrives
+            def write(frame: np.ndarray) -> None:
+                nonlocal writer
+                if writer is None:
+                    h, w = frame.shape[:2]
+                    writer = cv2.VideoWriter(str(out_path), fourcc, fps, (w, h))
+                writer.write(frame)
+
+            try:
+                yield write
+            finally:
+                if writer is not None:
+                    writer.release()
+
+        return writer_context()
+
+    # Join separately encoded segments into the output file, in order, by
+    # stream-copying them with ffmpeg
+    def concat_segments(
+        self, segment_paths: list[Path], parameters: dict[str, Any]
+    ) -> None:
+        ffmpeg = find_ffmpeg()
+        out_path = self.get_output_path(parameters)
+        segment_paths = [path for path in segment_paths if path.exists()]
+
+        list_path = out_path.with_suffix(".txt")
+        list_path.write_text(
+            "".join(f"file '{path.resolve()}'\n" for path in segment_paths)
         )
+        try:
+            subprocess.run(
+                [
+                    ffmpeg,
+                    "-y",
+                    "-loglevel",
+                    "error",
+                    "-f",
+                    "concat",
+                    "-safe",
+                    "0",
+                    "-i",
+                    str(list_path),
+                    "-c",
+                    "copy",
+                    str(out_path),
+                ],
+                check=True,
+                capture_output=True,
+            )
+        finally:
+            list_path.unlink(missing_ok=True)
 
-        with cv2VideoWriterContext(out_path, fourcc, fps, (w, h)) as out:
-            # Write the first frame
-            out.write(first_frame)
-            # Write the remaining frames
-            for frame in input_data:
-                out.write(frame)
+
+# Path of the ffmpeg executable. Segments are only joined without loss by
+# copying their streams, so there is no fallback: decoding and encoding them
+# again would add a second lossy generation
+def find_ffmpeg() -> str:
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError(
+            "Joining video segments needs ffmpeg, which is not installed; install "
+            "it or set MMRP_PIPELINE_SEGMENT_WORKERS to 1"
+        )
+    return ffmpeg
@@ -26,6 +26,12 @@ class ColorModule(ModuleBase):
     def process_frame(
         self, frame: np.ndarray, parameters: dict[str, Any]
     ) -> np.ndarray[Any]:
+        # Chains of conversions fused by the pipeline optimizer
+        conversions: list[list[str]] | None = parameters.get("conversions")
+        if conversions:
+            return self.convert_chain(
+                frame, tuple((step[0], step[1]) for step in conversions)
+            )
         input: str = parameters["input_colorspace"]
         output: str = parameters["output_colorspace"]
         return self.match_colorspace(frame, input, output)
@@ -43,6 +49,17 @@ class ColorModule(ModuleBase):
             f"Unsupported input-output ColorSpace: {input_color} {output_color}"
         )
 
+    # Apply several conversions, one after the other. A single lookup table
+    # pass is not used: OpenCV rounds some conversions differently depending on
+    # the frame width, so a table built from one frame size would not match
+    # the conversions of every other
+    def convert_chain(
+        self, frame: np.ndarray, conversions: tuple[tuple[str, str], ...]
+    ) -> np.ndarray[Any]:
+        for input_color, output_color in conversions:
+            frame = self.match_colorspace(frame, input_color, output_color)
+        return frame
+
     @override
     def process(self, input_data: str, parameters: dict[str, Any]) -> None:
         output_path: str = str(
@@ -90,3 +90,16 @@ class FrameRate(StrEnum):
     FPS_60 = "60"  # Progressive high frame rate
     FPS_120 = "120"  # Ultra high frame rate
     FPS_240 = "240"  # Slow motion capture
+
+
+# How a binary module exchanges frames with its executable
+class BinaryMode(StrEnum):
+    # One process per frame, reading and writing I420 files
+    FILE = "file"
+    # One process per run, reading and writing raw I420 frames on stdin/stdout
+    STREAM = "stream"
+    # One process per batch of frames, reading and writing multi-frame I420
+    # files
+    BATCH = "batch"
+    # No process: the module's shared library is called on the frame buffers
+    PLUGIN = "plugin"
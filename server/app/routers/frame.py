@@ -1,18 +1,32 @@
-from contextlib import ExitStack
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from pathlib import Path
-import cv2
+from pydantic import ValidationError
 import asyncio
-import json
-import numpy as np
-from typing import Optional
-from app.utils.shared_functionality import as_context
-from app.utils.quality_metrics import compute_metrics
-from app.schemas.frame import FrameData
+from app.schemas.frame import VideoSeekRequest, VideoStreamRequest
+from app.services.frame_hub import FrameSubscription, frame_hub
+from app.services.frame_store import get_video_identity
+from app.services.frame_stream import StreamSettings
+from app.utils.shared_functionality import get_output_video_path, get_video_path
 
 router = APIRouter()
 
-cv2VideoCaptureContext = as_context(cv2.VideoCapture, lambda cap: cap.release())
+
+# Apply the commands the client sends while it is streamed to: {"action":
+# "seek", "frame": N} continues the stream from frame N. Invalid messages are
+# ignored; a disconnection ends the stream
+async def receive_commands(
+    websocket: WebSocket, subscription: FrameSubscription
+) -> None:
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                command = VideoSeekRequest.model_validate_json(message)
+            except ValidationError:
+                continue
+            await subscription.seek(command.frame)
+    except Exception as e:
+        subscription.stop(e)
 
 
 @router.websocket("/ws/video")
@@ -20,78 +34,53 @@ async def video_feed(websocket: WebSocket) -> None:
     await websocket.accept()
     print("WebSocket connection accepted")
 
-    # Wait for client to specify filenames
+    # Wait for client to specify filenames, of uploaded videos or, with
+    # "output" (for all files or per file), of pipeline outputs, and
+    # optionally its viewport, bandwidth or latency targets and start frame
     try:
         init_msg: str = await websocket.receive_text()
-        init_data = json.loads(init_msg)
-        filenames: str = init_data.get("filenames")
+        init_data = VideoStreamRequest.model_validate_json(init_msg)
     except Exception:
         await websocket.close()
         return
 
-    base_path: Path = (
-        Path(__file__).resolve().parent.parent.parent.parent / "server" / "videos"
-    )
-    video_paths: list[Path] = [base_path / name for name in filenames[:2]]
+    filenames = init_data.filenames[:2]
+    output = init_data.output
+    outputs = output if isinstance(output, list) else [output] * len(filenames)
+    video_paths: list[Path] = [
+        get_output_video_path(name) if is_output else get_video_path(name)
+        for name, is_output in zip(filenames, outputs)
+    ]
+    viewport: tuple[int, int] | None = None
+    if init_data.viewport_width and init_data.viewport_height:
+        viewport = (init_data.viewport_width, init_data.viewport_height)
+    settings = StreamSettings(viewport, init_data.max_bitrate, init_data.max_latency)
 
     try:
-        with ExitStack() as stack:
-            caps: list[cv2.VideoCapture] = [
-                stack.enter_context(cv2VideoCaptureContext(str(path)))
-                for path in video_paths
-            ]
-
-            if not all(cap.isOpened() for cap in caps):
-                await websocket.close()
-                return
-
-            fps: float = caps[0].get(cv2.CAP_PROP_FPS) or 30.0
-            mime_type: str = "image/webp"
-
-            while all(cap.isOpened() for cap in caps):
-                frames: list[Optional[np.ndarray]] = []
-                raw_frames: list[
-                    np.ndarray
-                ] = []  # Keep originals for metrics computation
-
-                for cap in caps:
-                    ret, frame = cap.read()
-                    if not ret:
-                        return  # Exit if any video ends
-
-                    raw_frames.append(frame)
-
-                    encode_success: bool
-                    buffer: Optional[np.ndarray]
-                    encode_success, buffer = cv2.imencode(
-                        ".webp", frame, [cv2.IMWRITE_WEBP_QUALITY, 100]
-                    )
-                    assert isinstance(buffer, (np.ndarray, type(None)))
-
-                    if not encode_success:
-                        mime_type = "image/png"
-                        encode_success, buffer = cv2.imencode(".png", frame)
-                        assert isinstance(buffer, (np.ndarray, type(None)))
-
-                    if encode_success:
-                        frames.append(buffer)
-                    else:
-                        frames.append(None)
-
-                # Skip sending frames if any encoding failed
-                if any(buf is None for buf in frames):
-                    continue
-
-                metrics = compute_metrics(raw_frames[0], raw_frames[1])
-                metadata = FrameData(fps=fps, mime=mime_type, metrics=metrics)
-
-                await websocket.send_text(metadata.model_dump_json())
-
-                for buf in frames:
-                    if buf is not None:
-                        await websocket.send_bytes(buf.tobytes())
-
-                await asyncio.sleep(0)
+        identities = [
+            get_video_identity(path, is_output)
+            for path, is_output in zip(video_paths, outputs)
+        ]
+        # Viewers of the same videos with the same settings share the work of
+        # decoding, encoding and scoring the frames, done in worker threads;
+        # this loop only sends them
+        loop = asyncio.get_running_loop()
+        async with frame_hub.subscribe(
+            video_paths, identities, settings, init_data.start
+        ) as subscription:
+            commands = asyncio.create_task(receive_commands(websocket, subscription))
+            try:
+                async for frame in subscription.frames():
+                    # Slow sends show that the client or its link cannot keep
+                    # up, which lowers the quality of the next frames
+                    sent_at = loop.time()
+                    await websocket.send_text(frame.metadata.model_dump_json())
+                    for buffer in frame.buffers:
+                        await websocket.send_bytes(buffer)
+                    subscription.sent(frame, loop.time() - sent_at)
+            finally:
+                commands.cancel()
+                await asyncio.gather(commands, return_exceptions=True)
 
     except WebSocketDisconnect:
         print("WebSocket disconnected by the client")
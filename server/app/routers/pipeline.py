@@ -1,8 +1,16 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+import json
+from fastapi import APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect
 from pydantic import ValidationError
+from app.schemas.job import PipelineJob
 from app.schemas.pipeline import PipelineRequest, PipelineResponse
 from app.schemas.pipeline import ExamplePipeline
-from app.services.pipeline import handle_pipeline_request, list_examples
+from app.services.jobs import FINISHED_JOB_STATES, pipeline_jobs
+from app.services.pipeline import list_examples
+from app.services.scheduler import (
+    SchedulerFullError,
+    handle_scheduled_pipeline_request,
+)
 
 router = APIRouter(
     prefix="/pipeline",
@@ -11,24 +19,37 @@ router = APIRouter(
 )
 
 
-# Endpoint to execute a video pipeline frame by frame
+# Maps an error raised while validating or running a pipeline to a response
+def get_pipeline_http_exception(e: Exception) -> HTTPException:
+    # TODO: handle all exceptions that can be raised during pipeline processing
+    if isinstance(e, SchedulerFullError):
+        return HTTPException(status_code=503, detail=str(e))
+    if isinstance(e, KeyError):
+        return HTTPException(status_code=400, detail=f"Missing required field: {e}")
+    if isinstance(e, TypeError):
+        return HTTPException(status_code=422, detail=f"Type error: {e}")
+    if isinstance(e, ValidationError):
+        return HTTPException(status_code=422, detail=f"Validation error: {e.errors()}")
+    if isinstance(e, ValueError):
+        return HTTPException(status_code=422, detail=f"Value error: {e}")
+    if isinstance(e, RuntimeError):
+        return HTTPException(status_code=500, detail=str(e))
+    return HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
+
+# Clients are told apart by address for fair scheduling
+def get_client_id(http_request: Request) -> str:
+    return http_request.client.host if http_request.client else "unknown"
+
+
+# Endpoint to execute a video pipeline frame by frame; waits for a scheduler
+# slot first, ahead of background jobs
 @router.post("/", response_model=PipelineResponse)
-def process_pipeline(request: PipelineRequest):
+def process_pipeline(request: PipelineRequest, http_request: Request):
     try:
-        return handle_pipeline_request(request)
-    # TODO: handle all exceptions that can be raised during pipeline processing
-    except KeyError as e:
-        raise HTTPException(status_code=400, detail=f"Missing required field: {e}")
-    except TypeError as e:
-        raise HTTPException(status_code=422, detail=f"Type error: {e}")
-    except ValidationError as e:
-        raise HTTPException(status_code=422, detail=f"Validation error: {e.errors()}")
-    except ValueError as e:
-        raise HTTPException(status_code=422, detail=f"Value error: {e}")
-    except RuntimeError as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        return handle_scheduled_pipeline_request(request, get_client_id(http_request))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+        raise get_pipeline_http_exception(e)
 
 
 @router.get("/examples/", response_model=list[ExamplePipeline])
@@ -38,3 +59,72 @@ def get_pipeline_examples():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
     return examples
+
+
+# Endpoint to run a video pipeline in the background
+@router.post("/jobs/", response_model=PipelineJob, status_code=202)
+def submit_pipeline_job(request: PipelineRequest, http_request: Request):
+    try:
+        return pipeline_jobs.submit(request, get_client_id(http_request)).snapshot()
+    except Exception as e:
+        raise get_pipeline_http_exception(e)
+
+
+@router.get("/jobs/{job_id}", response_model=PipelineJob)
+def get_pipeline_job(job_id: str):
+    try:
+        return pipeline_jobs.get(job_id).snapshot()
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+
+@router.delete("/jobs/{job_id}", response_model=PipelineJob)
+def cancel_pipeline_job(job_id: str):
+    try:
+        return pipeline_jobs.cancel(job_id).snapshot()
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+
+# Streams the status of a job until it finishes. Sending {"action": "cancel"}
+# or disconnecting cancels the job
+@router.websocket("/jobs/{job_id}/ws")
+async def pipeline_job_progress(websocket: WebSocket, job_id: str):
+    await websocket.accept()
+    try:
+        job = pipeline_jobs.get(job_id)
+    except KeyError:
+        await websocket.send_json({"error": f"Job {job_id} not found"})
+        await websocket.close()
+        return
+
+    updates = job.subscribe()
+    receiver = asyncio.create_task(websocket.receive_text())
+    getter = asyncio.create_task(updates.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                {receiver, getter}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter in done:
+                status = getter.result()
+                await websocket.send_text(status.model_dump_json())
+                if status.state in FINISHED_JOB_STATES:
+                    break
+                getter = asyncio.create_task(updates.get())
+            if receiver in done:
+                try:
+                    message = json.loads(receiver.result())
+                except json.JSONDecodeError:
+                    message = None
+                if message == {"action": "cancel"}:
+                    job.cancel()
+                receiver = asyncio.create_task(websocket.receive_text())
+        await websocket.close()
+    except WebSocketDisconnect:
+        # Nobody is waiting for the result anymore
+        job.cancel()
+    finally:
+        receiver.cancel()
+        getter.cancel()
+        job.unsubscribe(updates)
@@ -1,8 +1,16 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import Response
 from pathlib import Path
-from app.utils.shared_functionality import get_video_path
+from app.services.frame_store import (
+    FrameEncoding,
+    get_or_encode_frame,
+    get_stored_frame,
+    get_video_identity,
+)
+from app.services.video_index import read_video_frame
+from app.utils.shared_functionality import get_output_video_path, get_video_path
 from app.utils.constants import VIDEO_TYPES
+from app.utils.file_response import RangeFileResponse
 from app.schemas.video import VideoRequest
 
 router = APIRouter(
@@ -16,11 +24,11 @@ router = APIRouter(
 )
 
 
-# Send a mp4 video to the frontend
-@router.post("/")
-def get_video(request: VideoRequest):
+# Send a video file, or the byte ranges of it the request asks for, so that
+# players can seek without downloading the whole file again. Browsers may
+# cache it and revalidate it through its ETag and Last-Modified date
+def send_video(video_name: str, output: bool) -> RangeFileResponse:
     try:
-        video_name: str = request.video_name
         file_ext = Path(video_name).suffix.lower()
 
         if file_ext not in VIDEO_TYPES:
@@ -29,27 +37,19 @@ def get_video(request: VideoRequest):
             )
 
         # Get video path
-        if request.output:
-            video_path = (
-                Path(__file__).resolve().parent.parent.parent / "output" / video_name
-            )
+        if output:
+            video_path = get_output_video_path(video_name)
         else:
             video_path = get_video_path(video_name)
 
-        if not video_path.exists():
+        if not video_path.is_file():
             raise HTTPException(404, detail=f"Video not found at {video_path}")
 
-        # Read video in chunks for better performance
-        def iterfile(chunk_size: int = 1024 * 1024):  # 1 MB chunks
-            with open(video_path, "rb") as file:
-                while chunk := file.read(chunk_size):
-                    yield chunk
-
-        return StreamingResponse(
-            iterfile(),
+        return RangeFileResponse(
+            video_path,
             media_type=VIDEO_TYPES[file_ext],
             headers={
-                "Accept-Ranges": "bytes",
+                "Cache-Control": "no-cache",
                 "Content-Disposition": f"inline; filename={video_name}",
             },
         )
@@ -57,3 +57,57 @@ def get_video(request: VideoRequest):
         raise
     except Exception as e:
         raise HTTPException(500, detail=str(e))
+
+
+# Send a mp4 video to the frontend
+@router.post("/")
+def get_video(request: VideoRequest):
+    return send_video(request.video_name, request.output)
+
+
+# Same as the POST variant, with a URL browsers can cache and point <video>
+# elements at
+@router.get("/")
+def get_video_file(video_name: str, output: bool = False):
+    return send_video(video_name, output)
+
+
+# Send a single frame of a video as an image (WebP, or PNG where WebP is not
+# supported). The frame is decoded from its keyframe unless it is in the frame
+# store or was decoded recently, so any frame is reached equally fast
+@router.get("/frame")
+def get_video_frame(
+    video_name: str,
+    frame: int = Query(ge=0),
+    output: bool = False,
+    quality: int = Query(default=100, ge=1, le=100),
+):
+    try:
+        file_ext = Path(video_name).suffix.lower()
+        if file_ext not in VIDEO_TYPES:
+            raise HTTPException(
+                400, detail=f"Unsupported format. Allowed: {list(VIDEO_TYPES.keys())}"
+            )
+
+        video_path = (
+            get_output_video_path(video_name) if output else get_video_path(video_name)
+        )
+        if not video_path.exists():
+            raise HTTPException(404, detail=f"Video not found at {video_path}")
+
+        video_identity = get_video_identity(video_path, output)
+        encoding = FrameEncoding(quality)
+        image = get_stored_frame(video_identity, frame, encoding)
+        if image is None:
+            decoded = read_video_frame(video_path, video_identity, frame)
+            if decoded is None:
+                raise HTTPException(404, detail=f"Frame {frame} not found")
+            image = get_or_encode_frame(video_identity, frame, decoded, encoding)
+            if image is None:
+                raise HTTPException(500, detail="Could not encode frame")
+
+        return Response(content=image[0], media_type=image[1])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, detail=str(e))
@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from typing import Literal
+from pydantic import BaseModel, Field
 from app.schemas.metrics import Metrics
 
 
@@ -6,3 +7,27 @@ class FrameData(BaseModel):
     fps: float
     mime: str
     metrics: Metrics
+    # Index of the frame in the videos; frames may be dropped to keep up
+    index: int = 0
+
+
+# Init message of /ws/video
+class VideoStreamRequest(BaseModel):
+    filenames: list[str]
+    # Whether the files are pipeline outputs, for all files or per file
+    output: bool | list[bool] = False
+    # Size (pixels) the frames are displayed at; larger frames are downscaled
+    viewport_width: int | None = Field(default=None, ge=1)
+    viewport_height: int | None = Field(default=None, ge=1)
+    # Bandwidth target (bits per second) the encode quality is adjusted to
+    max_bitrate: float | None = Field(default=None, gt=0)
+    # Delay (seconds) behind real time after which frames are dropped
+    max_latency: float | None = Field(default=None, gt=0)
+    # Frame the stream starts at
+    start: int = Field(default=0, ge=0)
+
+
+# Message of a /ws/video client to continue the stream from another frame
+class VideoSeekRequest(BaseModel):
+    action: Literal["seek"]
+    frame: int = Field(ge=0)
@@ -0,0 +1,15 @@
+from pydantic import BaseModel
+from app.schemas.pipeline import PipelineResponse
+from app.utils.enums import JobState
+
+
+class PipelineJob(BaseModel):
+    id: str
+    state: JobState
+    queue_position: int  # position in the scheduler queue, 0 once running
+    frames_done: int
+    total_frames: int
+    fps: float | None  # processed frames per second
+    eta: float | None  # estimated seconds until completion
+    result: PipelineResponse | None = None
+    error: str | None = None
@@ -5,3 +5,6 @@ class Metrics(BaseModel):
     message: str | None
     psnr: float | None
     ssim: float | None
+    # Chroma plane PSNR, only computed for YUV_I420 frames
+    psnr_u: float | None = None
+    psnr_v: float | None = None
@@ -0,0 +1,352 @@
+from collections import deque
+from contextlib import ExitStack, asynccontextmanager
+from pathlib import Path
+from typing import AsyncGenerator, Callable
+import asyncio
+import cv2
+from app.services.frame_stream import (
+    FrameStream,
+    StreamFrame,
+    StreamSettings,
+    frame_executor,
+)
+from app.services.metrics_sidecar import find_pipeline_metrics
+from app.utils.constants import FRAME_HUB_BUFFER_SIZE, FRAME_HUB_SLOW_CONSUMER
+from app.utils.enums import SlowConsumerPolicy
+from app.utils.shared_functionality import as_context
+
+cv2VideoCaptureContext = as_context(cv2.VideoCapture, lambda cap: cap.release())
+
+BroadcastKey = tuple[tuple[str, ...], StreamSettings, int]
+
+
+class SlowConsumerError(Exception):
+    pass
+
+
+class FrameSubscriber:
+    """A viewer of a broadcast, with its own bounded buffer of frames."""
+
+    def __init__(self, buffer_size: int, on_consumed: Callable[[], None]) -> None:
+        self.buffer_size = buffer_size
+        self.dropped = 0
+        self._on_consumed = on_consumed
+        self._frames: deque[StreamFrame] = deque()
+        self._ended = False
+        self._error: BaseException | None = None
+        self._available = asyncio.Event()
+
+    @property
+    def full(self) -> bool:
+        return len(self._frames) >= self.buffer_size
+
+    # Buffer a frame, dropping the oldest one if the buffer is full
+    def put(self, frame: StreamFrame) -> None:
+        if self.full:
+            self._frames.popleft()
+            self.dropped += 1
+        self._frames.append(frame)
+        self._available.set()
+
+    # End the subscriber's frames, with an error to raise if any
+    def end(self, error: BaseException | None = None) -> None:
+        self._ended = True
+        self._error = error
+        self._available.set()
+
+    # Buffered frames in order, until the broadcast ends
+    async def frames(self) -> AsyncGenerator[StreamFrame]:
+        while True:
+            while self._frames:
+                frame = self._frames.popleft()
+                self._on_consumed()
+                yield frame
+            if self._ended:
+                if self._error is not None:
+                    raise self._error
+                return
+            self._available.clear()
+            await self._available.wait()
+
+
+class FrameBroadcast:
+    """One FrameStream shared by every viewer of the same videos and settings,
+    from the same start frame.
+
+    Each frame is handed to every subscriber's buffer. The stream goes as fast
+    as its fastest subscriber; a subscriber whose buffer is full is handled by
+    the slow consumer policy: the stream waits for it (WAIT), its oldest frame
+    is dropped (DROP_OLDEST) or it is disconnected (DISCONNECT). The first
+    `buffer_size` frames are kept, so viewers joining before the stream has
+    gone further still receive it from the start.
+
+    The stream's quality follows its fastest subscriber too: the send times of
+    a frame are accounted once, with the shortest of them, when every
+    subscriber has sent it or a later frame has been sent.
+    """
+
+    def __init__(
+        self,
+        video_paths: list[Path],
+        video_identities: list[str],
+        settings: StreamSettings,
+        start: int,
+        buffer_size: int,
+        policy: SlowConsumerPolicy,
+    ) -> None:
+        self.video_paths = video_paths
+        self.video_identities = video_identities
+        self.settings = settings
+        self.start = start
+        self.buffer_size = max(buffer_size, 1)
+        self.policy = policy
+        self.subscribers: list[FrameSubscriber] = []
+        self.stream: FrameStream | None = None
+        self._history: list[StreamFrame] = []
+        self._produced = 0
+        self._ended = False
+        self._error: BaseException | None = None
+        # Set whenever a subscriber consumes a frame or leaves
+        self._room = asyncio.Event()
+        self._task: asyncio.Task[None] | None = None
+        # Frames sent by some subscribers, by index, with the shortest send
+        # time so far and the number of subscribers that sent them
+        self._sends: dict[int, tuple[StreamFrame, float, int]] = {}
+        # Index of the last frame whose send time was accounted
+        self._accounted = -1
+
+    @property
+    def key(self) -> BroadcastKey:
+        return (tuple(self.video_identities), self.settings, self.start)
+
+    # Whether a new viewer can still receive the stream from its first frame
+    @property
+    def joinable(self) -> bool:
+        return self._produced <= self.buffer_size
+
+    def subscribe(self) -> FrameSubscriber:
+        subscriber = FrameSubscriber(self.buffer_size, self._room.set)
+        for frame in self._history:
+            subscriber.put(frame)
+        if self._ended:
+            subscriber.end(self._error)
+        self.subscribers.append(subscriber)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return subscriber
+
+    # Remove a subscriber; returns whether the broadcast has none left, in
+    # which case it is stopped
+    async def unsubscribe(self, subscriber: FrameSubscriber) -> bool:
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        self._room.set()
+        if self.subscribers:
+            return False
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        return True
+
+    # Account for a frame a subscriber sent in `seconds`. Frames are passed on
+    # to the stream in order, once each; earlier frames some subscribers have
+    # not sent, having dropped or joined after them, are passed on as they are
+    def sent(self, frame: StreamFrame, seconds: float) -> None:
+        index = frame.metadata.index
+        if self.stream is None or index <= self._accounted:
+            return
+        _, fastest, count = self._sends.get(index, (frame, seconds, 0))
+        self._sends[index] = (frame, min(fastest, seconds), count + 1)
+        for pending in sorted(self._sends):
+            if pending > index:
+                break
+            pending_frame, fastest, count = self._sends[pending]
+            if pending == index and count < len(self.subscribers):
+                break
+            del self._sends[pending]
+            self._accounted = pending
+            self.stream.sent(pending_frame, fastest)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            with ExitStack() as stack:
+                caps = [
+                    stack.enter_context(cv2VideoCaptureContext(str(path)))
+                    for path in self.video_paths
+                ]
+                if not all(cap.isOpened() for cap in caps):
+                    raise ValueError("Could not open video files")
+                fps: float = caps[0].get(cv2.CAP_PROP_FPS) or 30.0
+
+                # Metrics the pipeline computed for these videos, if they are
+                # its outputs
+                metrics = await loop.run_in_executor(
+                    frame_executor,
+                    find_pipeline_metrics,
+                    self.video_paths,
+                    self.video_identities,
+                )
+                self.stream = FrameStream(
+                    caps,
+                    self.video_identities,
+                    fps,
+                    metrics,
+                    self.settings,
+                    start=self.start,
+                    video_paths=self.video_paths,
+                )
+                async with self.stream:
+                    async for frame in self.stream.frames():
+                        await self._wait_for_room()
+                        self._deliver(frame)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._ended = True
+            for subscriber in self.subscribers:
+                subscriber.end(self._error)
+
+    # Wait until the subscribers the policy waits for have room for a frame
+    async def _wait_for_room(self) -> None:
+        while self.subscribers:
+            full = [subscriber.full for subscriber in self.subscribers]
+            if self.policy == SlowConsumerPolicy.WAIT:
+                if not any(full):
+                    return
+            elif not all(full):
+                return
+            self._room.clear()
+            await self._room.wait()
+
+    def _deliver(self, frame: StreamFrame) -> None:
+        if self._produced < self.buffer_size:
+            self._history.append(frame)
+        self._produced += 1
+        for subscriber in list(self.subscribers):
+            if subscriber.full and self.policy == SlowConsumerPolicy.DISCONNECT:
+                subscriber.end(SlowConsumerError("Viewer is too slow for the stream"))
+                self.subscribers.remove(subscriber)
+            else:
+                subscriber.put(frame)
+
+
+class FrameSubscription:
+    """A viewer's handle on the broadcast it receives frames from; seeking
+    moves the viewer to the broadcast starting at the new frame."""
+
+    def __init__(
+        self,
+        hub: "FrameStreamHub",
+        broadcast: FrameBroadcast,
+        subscriber: FrameSubscriber,
+    ) -> None:
+        self.hub = hub
+        self.broadcast = broadcast
+        self.subscriber = subscriber
+
+    # Frames of the current broadcast, switching broadcasts on seeks; frames
+    # buffered before a seek are not returned
+    async def frames(self) -> AsyncGenerator[StreamFrame]:
+        while True:
+            subscriber = self.subscriber
+            async for frame in subscriber.frames():
+                if subscriber is not self.subscriber:
+                    break
+                yield frame
+            if subscriber is self.subscriber:
+                return
+
+    def sent(self, frame: StreamFrame, seconds: float) -> None:
+        self.broadcast.sent(frame, seconds)
+
+    # Continue from the given frame
+    async def seek(self, frame_index: int) -> None:
+        broadcast, subscriber = self.broadcast, self.subscriber
+        self.broadcast, self.subscriber = self.hub.join(
+            broadcast.video_paths,
+            broadcast.video_identities,
+            broadcast.settings,
+            frame_index,
+        )
+        subscriber.end()
+        await self.hub.leave(broadcast, subscriber)
+
+    # End the frames, raising the given error if any
+    def stop(self, error: BaseException | None = None) -> None:
+        self.subscriber.end(error)
+
+
+class FrameStreamHub:
+    """Broadcasts of the videos being played, one per (videos, settings, start
+    frame) key.
+
+    Viewers of the same comparison with the same settings share one producer,
+    so the decoding, encoding and scoring work depends on the number of
+    distinct streams rather than on the number of viewers. Must be used from
+    a single event loop.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int = FRAME_HUB_BUFFER_SIZE,
+        policy: SlowConsumerPolicy = FRAME_HUB_SLOW_CONSUMER,
+    ) -> None:
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self._broadcasts: dict[BroadcastKey, FrameBroadcast] = {}
+
+    @asynccontextmanager
+    async def subscribe(
+        self,
+        video_paths: list[Path],
+        video_identities: list[str],
+        settings: StreamSettings = StreamSettings(),
+        start: int = 0,
+    ) -> AsyncGenerator[FrameSubscription]:
+        broadcast, subscriber = self.join(
+            video_paths, video_identities, settings, start
+        )
+        subscription = FrameSubscription(self, broadcast, subscriber)
+        try:
+            yield subscription
+        finally:
+            await self.leave(subscription.broadcast, subscription.subscriber)
+
+    # Subscribe to the broadcast of the given key, starting it if needed
+    def join(
+        self,
+        video_paths: list[Path],
+        video_identities: list[str],
+        settings: StreamSettings,
+        start: int,
+    ) -> tuple[FrameBroadcast, FrameSubscriber]:
+        key: BroadcastKey = (tuple(video_identities), settings, start)
+        broadcast = self._broadcasts.get(key)
+        if broadcast is None or not broadcast.joinable:
+            broadcast = FrameBroadcast(
+                video_paths,
+                video_identities,
+                settings,
+                start,
+                self.buffer_size,
+                self.policy,
+            )
+            self._broadcasts[key] = broadcast
+        return broadcast, broadcast.subscribe()
+
+    async def leave(
+        self, broadcast: FrameBroadcast, subscriber: FrameSubscriber
+    ) -> None:
+        if await broadcast.unsubscribe(subscriber):
+            # A newer broadcast may have replaced this one
+            if self._broadcasts.get(broadcast.key) is broadcast:
+                del self._broadcasts[broadcast.key]
+
+    # Number of broadcasts currently producing frames
+    @property
+    def broadcast_count(self) -> int:
+        return len(self._broadcasts)
+
+
+frame_hub = FrameStreamHub()
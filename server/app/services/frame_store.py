@@ -0,0 +1,178 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+import hashlib
+import threading
+import cv2
+import numpy as np
+from app.utils.constants import (
+    FRAME_STORE_DIR,
+    FRAME_STORE_FILL_BACKLOG,
+    FRAME_STORE_FILL_ON_RUN,
+    FRAME_STORE_MAX_BYTES,
+)
+from app.utils.disk_cache import DiskLRUCache
+from app.utils.shared_functionality import as_context
+
+cv2VideoCaptureContext = as_context(cv2.VideoCapture, lambda cap: cap.release())
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Encoded frames of played and produced videos, shared by every process of
+# this server
+frame_store = DiskLRUCache(FRAME_STORE_DIR, FRAME_STORE_MAX_BYTES)
+
+# Encodes the frames of the videos produced by pipeline runs into the store,
+# one video at a time, in the background
+_fill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frame-store")
+_fill_backlog = threading.BoundedSemaphore(max(FRAME_STORE_FILL_BACKLOG, 1))
+
+
+class FrameEncoding(NamedTuple):
+    """Encode settings of the frames sent to the comparison player; part of
+    every stored frame's key."""
+
+    # WebP quality (1-100)
+    quality: int = 100
+    # Size frames are downscaled to, or None to keep the video's size
+    size: tuple[int, int] | None = None
+
+    def __str__(self) -> str:
+        if self.size is None:
+            return f"webp-{self.quality}"
+        return f"webp-{self.quality}-{self.size[0]}x{self.size[1]}"
+
+
+# Encode a frame as WebP, or as PNG where WebP is not supported. Returns the
+# image and its media type, or None if both encodings fail
+def encode_frame(
+    frame: np.ndarray, encoding: FrameEncoding = FrameEncoding()
+) -> tuple[bytes, str] | None:
+    if encoding.size is not None and encoding.size != frame.shape[1::-1]:
+        frame = cv2.resize(frame, encoding.size, interpolation=cv2.INTER_AREA)
+    success, buffer = cv2.imencode(
+        ".webp", frame, [cv2.IMWRITE_WEBP_QUALITY, encoding.quality]
+    )
+    if success:
+        return buffer.tobytes(), "image/webp"
+    success, buffer = cv2.imencode(".png", frame)
+    if success:
+        return buffer.tobytes(), "image/png"
+    return None
+
+
+def get_image_mime(data: bytes) -> str:
+    return "image/png" if data.startswith(PNG_SIGNATURE) else "image/webp"
+
+
+# Identity of a video file in the store. Output files are written once under
+# unique names, so their path identifies them (and is known while they are
+# still being written); other videos can be replaced, so their size and
+# modification time are part of it
+def get_video_identity(path: Path, output: bool) -> str:
+    if output:
+        return str(path.resolve())
+    stat = path.stat()
+    return f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+# Size of a width x height video scaled down to fit the viewport, keeping its
+# aspect ratio, or None if it already fits
+def get_viewport_size(
+    width: int, height: int, viewport: tuple[int, int]
+) -> tuple[int, int] | None:
+    scale = min(viewport[0] / width, viewport[1] / height)
+    if scale >= 1:
+        return None
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def get_frame_key(
+    video_identity: str, frame_index: int, encoding: FrameEncoding = FrameEncoding()
+) -> str:
+    video_key = hashlib.sha256(
+        f"{video_identity}|{encoding}".encode("utf-8")
+    ).hexdigest()
+    return f"{video_key}-{frame_index}"
+
+
+# Stored frame of a video and its media type, or None
+def get_stored_frame(
+    video_identity: str,
+    frame_index: int,
+    encoding: FrameEncoding = FrameEncoding(),
+) -> tuple[bytes, str] | None:
+    data = frame_store.get(get_frame_key(video_identity, frame_index, encoding))
+    if data is None:
+        return None
+    return data, get_image_mime(data)
+
+
+# Stored frames of the given videos, or None unless all of them are stored
+def get_stored_frames(
+    video_identities: list[str], frame_index: int, encodings: list[FrameEncoding]
+) -> list[tuple[bytes, str]] | None:
+    frames: list[tuple[bytes, str]] = []
+    for video_identity, encoding in zip(video_identities, encodings):
+        stored = get_stored_frame(video_identity, frame_index, encoding)
+        if stored is None:
+            return None
+        frames.append(stored)
+    return frames
+
+
+# Stored frame of a video, encoding and storing the given frame on a miss
+def get_or_encode_frame(
+    video_identity: str,
+    frame_index: int,
+    frame: np.ndarray,
+    encoding: FrameEncoding = FrameEncoding(),
+) -> tuple[bytes, str] | None:
+    stored = get_stored_frame(video_identity, frame_index, encoding)
+    if stored is not None:
+        return stored
+    encoded = encode_frame(frame, encoding)
+    if encoded is not None:
+        key = get_frame_key(video_identity, frame_index, encoding)
+        frame_store.put(key, encoded[0])
+    return encoded
+
+
+# Store the frames of a video that are not stored yet, decoded from the file
+def store_video_frames(path: Path) -> None:
+    video_identity = get_video_identity(path, output=True)
+    with cv2VideoCaptureContext(str(path)) as cap:
+        frame_index = 0
+        while cap.grab():
+            key = get_frame_key(video_identity, frame_index)
+            if not frame_store.contains(key):
+                ret, frame = cap.retrieve()
+                if not ret:
+                    return
+                encoded = encode_frame(frame)
+                if encoded is not None:
+                    frame_store.put(key, encoded[0])
+            frame_index += 1
+
+
+# Fill the store with the frames of a finished output video in the background,
+# if runs fill it. They are decoded from the written file rather than kept from
+# the pipeline, so that every stored frame matches what playback of the file
+# shows. Videos beyond the backlog are left for playback to store
+def fill_frame_store(output_path: Path) -> None:
+    if not FRAME_STORE_FILL_ON_RUN or not frame_store.enabled:
+        return
+    if not _fill_backlog.acquire(blocking=False):
+        return
+
+    def fill() -> None:
+        try:
+            store_video_frames(output_path)
+        finally:
+            _fill_backlog.release()
+
+    _fill_executor.submit(fill)
+
+
+def shutdown_frame_store() -> None:
+    _fill_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,368 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from types import TracebackType
+from typing import AsyncGenerator, NamedTuple
+import asyncio
+import cv2
+import numpy as np
+from app.schemas.frame import FrameData
+from app.schemas.metrics import Metrics
+from app.services.frame_store import (
+    FrameEncoding,
+    get_or_encode_frame,
+    get_stored_frames,
+    get_viewport_size,
+)
+from app.services.video_index import VideoIndex, get_video_indexes, grab_frame
+from app.utils.constants import (
+    FRAME_STREAM_PREFETCH,
+    FRAME_STREAM_WORKERS,
+    METRICS_FORMAT,
+)
+from app.utils.quality_metrics import compute_bgr_metrics
+
+# Threads decoding, encoding and scoring the frames of every /ws/video stream,
+# so that the event loop only sends them
+frame_executor = ThreadPoolExecutor(
+    max_workers=FRAME_STREAM_WORKERS, thread_name_prefix="frame-stream"
+)
+
+# WebP qualities adaptive streams step through, best first
+STREAM_QUALITIES = (100, 90, 80, 70, 60, 50, 40, 30)
+
+# Frames sent well within the frame interval and bitrate target before the
+# quality is raised a step
+QUALITY_RECOVERY_FRAMES = 30
+
+# Fraction of the bitrate target a stream must stay under to raise its quality
+QUALITY_RAISE_HEADROOM = 0.7
+
+# Weight of the latest frame in the moving average of a stream's bitrate
+BITRATE_SMOOTHING = 0.2
+
+
+# Delivery settings a viewer asked for
+class StreamSettings(NamedTuple):
+    # Size the frames are displayed at; larger frames are downscaled
+    viewport: tuple[int, int] | None = None
+    # Bandwidth target, in bits per second
+    max_bitrate: float | None = None
+    # Delay, in seconds, behind real time after which frames are dropped
+    max_latency: float | None = None
+
+
+class StreamFrame(NamedTuple):
+    metadata: FrameData
+    buffers: list[bytes]
+
+
+# Read the next frame of every capture, or None once any of them has ended.
+# The captures are first moved to the given frame index, if any, through the
+# videos' indexes when given
+def read_frames(
+    caps: list[cv2.VideoCapture],
+    frame_index: int | None = None,
+    indexes: list[VideoIndex] | None = None,
+) -> list[np.ndarray] | None:
+    frames: list[np.ndarray] = []
+    for i, cap in enumerate(caps):
+        if frame_index is not None and indexes is not None:
+            if not grab_frame(cap, indexes[i], frame_index):
+                return None
+            ret, frame = cap.retrieve()
+        else:
+            if frame_index is not None:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            ret, frame = cap.read()
+        if not ret:
+            return None
+        frames.append(frame)
+    return frames
+
+
+class QualityController:
+    """Encode quality of a stream, adjusted from how its sends keep up.
+
+    The quality drops a step when sending a frame takes longer than the frame
+    interval (the socket is backing up) or the stream exceeds its bitrate
+    target, and rises a step after QUALITY_RECOVERY_FRAMES frames sent well
+    within both. After a step, the frames already encoded at the previous
+    quality are not taken into account.
+    """
+
+    def __init__(
+        self, fps: float, max_bitrate: float | None, settle_frames: int
+    ) -> None:
+        self.interval = 1 / fps
+        self.max_bitrate = max_bitrate
+        self.settle_frames = settle_frames
+        self.level = 0
+        # Moving average of the stream's bitrate, in bits per second
+        self.bitrate: float | None = None
+        self._settling = 0
+        self._comfortable = 0
+
+    @property
+    def quality(self) -> int:
+        return STREAM_QUALITIES[self.level]
+
+    # Account for a frame (all its images) of `size` bytes, sent in `seconds`
+    def update(self, size: int, seconds: float) -> None:
+        if self._settling > 0:
+            self._settling -= 1
+            return
+        bitrate = size * 8 / self.interval
+        if self.bitrate is None:
+            self.bitrate = bitrate
+        else:
+            self.bitrate += BITRATE_SMOOTHING * (bitrate - self.bitrate)
+
+        if seconds > self.interval or (
+            self.max_bitrate is not None and self.bitrate > self.max_bitrate
+        ):
+            self._step(1)
+        elif seconds < self.interval / 2 and (
+            self.max_bitrate is None
+            or self.bitrate < self.max_bitrate * QUALITY_RAISE_HEADROOM
+        ):
+            self._comfortable += 1
+            if self._comfortable >= QUALITY_RECOVERY_FRAMES:
+                self._step(-1)
+        else:
+            self._comfortable = 0
+
+    def _step(self, direction: int) -> None:
+        level = min(max(self.level + direction, 0), len(STREAM_QUALITIES) - 1)
+        if level != self.level:
+            self.level = level
+            self.bitrate = None
+            self._settling = self.settle_frames
+        self._comfortable = 0
+
+
+class FrameStream:
+    """Frames of two videos, prepared for a socket in the frame worker pool.
+
+    Frames are read in order, one read at a time, and up to `prefetch` of them
+    are encoded and scored ahead of the socket; the streams of one frame are
+    encoded in parallel. Encoded frames are taken from the frame store when
+    present, and stored otherwise. Given the metrics of the pipeline run that
+    produced the videos, frames found in the store are not decoded at all.
+
+    The stream starts at frame `start`; given the videos' paths, the captures
+    are moved there, and to frames missing from the store, from their
+    keyframes. The videos are only indexed for that on the first such move, so
+    playback from the first frame does not wait for their packets to be read.
+
+    Frames are downscaled to fit the settings' viewport, if any. With a bitrate
+    or latency target, the encode quality follows the socket's backpressure
+    (see QualityController); with a latency target, frames more than
+    `max_latency` seconds behind real time are dropped.
+
+    Used as an async context manager, which waits for the read in progress on
+    exit so that the captures can be released.
+    """
+
+    def __init__(
+        self,
+        caps: list[cv2.VideoCapture],
+        video_identities: list[str],
+        fps: float,
+        metrics: list[Metrics] | None = None,
+        settings: StreamSettings = StreamSettings(),
+        prefetch: int = FRAME_STREAM_PREFETCH,
+        start: int = 0,
+        video_paths: list[Path] | None = None,
+    ) -> None:
+        self.caps = caps
+        self.video_identities = video_identities
+        self.fps = fps
+        self.metrics = metrics
+        self.start = start
+        self.video_paths = video_paths
+        self.indexes: list[VideoIndex] | None = None
+        self.max_latency = settings.max_latency
+        self.sizes = [
+            get_viewport_size(
+                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                settings.viewport,
+            )
+            if settings.viewport is not None
+            else None
+            for cap in caps
+        ]
+        self.quality: QualityController | None = None
+        if settings.max_bitrate is not None or settings.max_latency is not None:
+            self.quality = QualityController(
+                fps, settings.max_bitrate, max(prefetch, 1)
+            )
+        self.dropped = 0
+        # Frames being prepared, in order; None marks the end of the videos
+        self._queue: asyncio.Queue[asyncio.Future[StreamFrame | None] | None] = (
+            asyncio.Queue(max(prefetch, 1))
+        )
+        self._read: Future[list[np.ndarray] | None] | None = None
+        self._producer: asyncio.Task[None] | None = None
+        # Event loop time at which frame 0 is due, once the first frame is sent
+        self._start: float | None = None
+
+    async def __aenter__(self) -> "FrameStream":
+        self._producer = asyncio.create_task(self._prefetch())
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        if self._producer is not None:
+            self._producer.cancel()
+            await asyncio.gather(self._producer, return_exceptions=True)
+        while not self._queue.empty():
+            pending = self._queue.get_nowait()
+            if pending is not None:
+                pending.cancel()
+        # A worker may still be reading from the captures
+        if self._read is not None:
+            await asyncio.wait([asyncio.wrap_future(self._read)])
+
+    # Frames ready to send, in order; frames that could not be encoded or are
+    # too late are skipped. Errors of the workers are raised here
+    async def frames(self) -> AsyncGenerator[StreamFrame]:
+        loop = asyncio.get_running_loop()
+        while (pending := await self._queue.get()) is not None:
+            frame = await pending
+            if frame is None:
+                continue
+            if self._start is None:
+                self._start = loop.time() - frame.metadata.index / self.fps
+            if self._is_late(frame.metadata.index):
+                self.dropped += 1
+                continue
+            yield frame
+
+    # Account for a frame sent in `seconds`
+    def sent(self, frame: StreamFrame, seconds: float) -> None:
+        if self.quality is not None:
+            self.quality.update(sum(len(data) for data in frame.buffers), seconds)
+
+    def _is_late(self, frame_index: int) -> bool:
+        if self.max_latency is None or self._start is None:
+            return False
+        due = self._start + frame_index / self.fps
+        return asyncio.get_running_loop().time() - due > self.max_latency
+
+    def _get_encodings(self) -> list[FrameEncoding]:
+        quality = self.quality.quality if self.quality is not None else 100
+        return [FrameEncoding(quality, size) for size in self.sizes]
+
+    async def _prefetch(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            frame_index = self.start
+            # Index of the frame the captures return next
+            position = 0
+            while self.metrics is None or frame_index < len(self.metrics):
+                if self.metrics is not None:
+                    if self._is_late(frame_index):
+                        self.dropped += 1
+                        frame_index += 1
+                        continue
+                    encodings = self._get_encodings()
+                    stored = await loop.run_in_executor(
+                        frame_executor,
+                        get_stored_frames,
+                        self.video_identities,
+                        frame_index,
+                        encodings,
+                    )
+                    if stored is not None:
+                        ready: asyncio.Future[StreamFrame | None] = loop.create_future()
+                        ready.set_result(
+                            self._build_frame(
+                                frame_index, stored, self.metrics[frame_index]
+                            )
+                        )
+                        await self._queue.put(ready)
+                        frame_index += 1
+                        continue
+
+                seek = frame_index != position
+                if seek and self.indexes is None and self.video_paths is not None:
+                    self.indexes = await loop.run_in_executor(
+                        frame_executor, get_video_indexes, self.video_paths
+                    )
+                self._read = frame_executor.submit(
+                    read_frames,
+                    self.caps,
+                    frame_index if seek else None,
+                    self.indexes,
+                )
+                frames = await asyncio.wrap_future(self._read)
+                if frames is None:
+                    break
+                position = frame_index + 1
+                # Late frames are read to keep the captures in order, but
+                # neither encoded nor scored
+                if self._is_late(frame_index):
+                    self.dropped += 1
+                else:
+                    await self._queue.put(
+                        asyncio.ensure_future(self._prepare(frame_index, frames))
+                    )
+                frame_index += 1
+        except Exception as e:
+            failed: asyncio.Future[StreamFrame | None] = loop.create_future()
+            failed.set_exception(e)
+            await self._queue.put(failed)
+        await self._queue.put(None)
+
+    async def _prepare(
+        self, frame_index: int, frames: list[np.ndarray]
+    ) -> StreamFrame | None:
+        loop = asyncio.get_running_loop()
+        if self.metrics is not None and frame_index < len(self.metrics):
+            metrics: asyncio.Future[Metrics] = loop.create_future()
+            metrics.set_result(self.metrics[frame_index])
+        else:
+            metrics = loop.run_in_executor(
+                frame_executor,
+                compute_bgr_metrics,
+                frames[0],
+                frames[1],
+                METRICS_FORMAT,
+            )
+        encoded = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    frame_executor,
+                    get_or_encode_frame,
+                    identity,
+                    frame_index,
+                    frame,
+                    encoding,
+                )
+                for identity, frame, encoding in zip(
+                    self.video_identities, frames, self._get_encodings()
+                )
+            )
+        )
+        images: list[tuple[bytes, str]] = []
+        for image in encoded:
+            if image is None:
+                metrics.cancel()
+                return None
+            images.append(image)
+        return self._build_frame(frame_index, images, await metrics)
+
+    def _build_frame(
+        self, frame_index: int, images: list[tuple[bytes, str]], metrics: Metrics
+    ) -> StreamFrame:
+        # One media type is sent for both frames
+        mime = next((mime for _, mime in images if mime != "image/webp"), "image/webp")
+        metadata = FrameData(
+            fps=self.fps, mime=mime, metrics=metrics, index=frame_index
+        )
+        return StreamFrame(metadata, [data for data, _ in images])
@@ -0,0 +1,243 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Generator
+import asyncio
+import threading
+import time
+import uuid
+from app.schemas.job import PipelineJob
+from app.schemas.pipeline import PipelineRequest, PipelineResponse
+from app.services.pipeline import (
+    PipelineCancelledError,
+    PipelinePlan,
+    build_pipeline_plan,
+    execute_pipeline_plan,
+    get_plan_video_info,
+)
+from app.services.scheduler import (
+    JOB_PRIORITY,
+    PipelineScheduler,
+    SchedulerTicket,
+    estimate_plan_memory,
+    pipeline_scheduler,
+)
+from app.utils.constants import PIPELINE_JOB_HISTORY
+from app.utils.enums import JobState
+
+# Minimum time, in seconds, between two progress updates sent to subscribers
+PROGRESS_INTERVAL = 0.25
+
+FINISHED_JOB_STATES = {JobState.COMPLETED, JobState.FAILED, JobState.CANCELLED}
+
+
+class Job:
+    """A pipeline request run in the background once the scheduler admits it.
+
+    Progress is published to asyncio queues of subscribers, which may live on
+    another thread than the one running the job.
+    """
+
+    def __init__(
+        self,
+        request: PipelineRequest,
+        plan: PipelinePlan,
+        total_frames: int,
+        scheduler: PipelineScheduler,
+        ticket: SchedulerTicket,
+    ) -> None:
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.plan = plan
+        self.scheduler = scheduler
+        self.ticket = ticket
+        self.state = JobState.QUEUED
+        self.frames_done = 0
+        self.total_frames = total_frames
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.result: PipelineResponse | None = None
+        self.error: str | None = None
+        self.future: Future[None] | None = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._subscribers: list[
+            tuple[asyncio.AbstractEventLoop, asyncio.Queue[PipelineJob]]
+        ] = []
+        self._last_published = 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_JOB_STATES
+
+    def snapshot(self) -> PipelineJob:
+        with self._lock:
+            fps = eta = None
+            if self.started_at is not None and self.frames_done > 0:
+                end = self.finished_at or time.monotonic()
+                fps = self.frames_done / max(end - self.started_at, 1e-6)
+                if not self.finished:
+                    eta = max(self.total_frames - self.frames_done, 0) / fps
+            return PipelineJob(
+                id=self.id,
+                state=self.state,
+                queue_position=self.scheduler.get_position(self.ticket),
+                frames_done=self.frames_done,
+                total_frames=self.total_frames,
+                fps=fps,
+                eta=eta,
+                result=self.result,
+                error=self.error,
+            )
+
+    # Must be called from a running event loop; the current status is sent first
+    def subscribe(self) -> asyncio.Queue[PipelineJob]:
+        updates: asyncio.Queue[PipelineJob] = asyncio.Queue()
+        with self._lock:
+            self._subscribers.append((asyncio.get_running_loop(), updates))
+        updates.put_nowait(self.snapshot())
+        return updates
+
+    def unsubscribe(self, updates: asyncio.Queue[PipelineJob]) -> None:
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s[1] is not updates]
+
+    # Stop the job at the next frame; queued jobs never start
+    def cancel(self) -> None:
+        self._cancelled.set()
+        if self.future is not None and self.future.cancel():
+            self.scheduler.release(self.ticket)
+            self._finish(JobState.CANCELLED)
+
+    def run(self) -> None:
+        try:
+            if self._cancelled.is_set():
+                raise PipelineCancelledError(f"Job {self.id} was cancelled")
+            result = execute_pipeline_plan(
+                self.request, self.plan, self._on_frame, self._slot
+            )
+        except PipelineCancelledError:
+            self._finish(JobState.CANCELLED)
+        except Exception as e:
+            self._finish(JobState.FAILED, error=str(e))
+        else:
+            self._finish(JobState.COMPLETED, result=result)
+        finally:
+            # Answered from the result cache without running, or cancelled
+            self.scheduler.release(self.ticket)
+
+    # Scheduler slot of the job; the job is running once it is admitted
+    @contextmanager
+    def _slot(self) -> Generator[None]:
+        with self.scheduler.hold(self.ticket, self._cancelled):
+            with self._lock:
+                self.state = JobState.RUNNING
+                self.started_at = time.monotonic()
+            self._publish()
+            yield
+
+    # Progress callback of the pipeline runners
+    def _on_frame(self, frames_done: int) -> None:
+        if self._cancelled.is_set():
+            raise PipelineCancelledError(f"Job {self.id} was cancelled")
+        with self._lock:
+            self.frames_done = frames_done
+            # Estimated frame counts can be too low
+            self.total_frames = max(self.total_frames, frames_done)
+        if time.monotonic() - self._last_published >= PROGRESS_INTERVAL:
+            self._publish()
+
+    def _finish(
+        self,
+        state: JobState,
+        result: PipelineResponse | None = None,
+        error: str | None = None,
+    ) -> None:
+        with self._lock:
+            if self.finished:
+                return
+            self.state = state
+            self.result = result
+            self.error = error
+            self.finished_at = time.monotonic()
+            if state == JobState.COMPLETED:
+                self.total_frames = self.frames_done = max(
+                    self.frames_done, len(result.metrics) if result else 0
+                )
+        self._publish()
+
+    def _publish(self) -> None:
+        self._last_published = time.monotonic()
+        status = self.snapshot()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, updates in subscribers:
+            try:
+                loop.call_soon_threadsafe(updates.put_nowait, status)
+            except RuntimeError:
+                # The subscriber's event loop is closed
+                self.unsubscribe(updates)
+
+
+class PipelineJobManager:
+    """Runs pipeline jobs through the scheduler and keeps the most recent ones."""
+
+    def __init__(self, scheduler: PipelineScheduler, max_finished: int) -> None:
+        self.scheduler = scheduler
+        self.max_finished = max_finished
+        # Queued jobs wait inside their thread, the scheduler decides what runs
+        self._executor = ThreadPoolExecutor(
+            max_workers=scheduler.max_jobs + scheduler.max_queued,
+            thread_name_prefix="pipeline-job",
+        )
+        self._lock = threading.Lock()
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+
+    # Invalid requests are rejected here, with the errors of build_pipeline_plan,
+    # and so are requests the scheduler has no room for (SchedulerFullError)
+    def submit(
+        self, request: PipelineRequest, client_id: str, priority: int = JOB_PRIORITY
+    ) -> Job:
+        plan = build_pipeline_plan(request)
+        info = get_plan_video_info(plan)
+        ticket = self.scheduler.enqueue(
+            client_id, priority, estimate_plan_memory(plan, info)
+        )
+        job = Job(request, plan, info.frame_count, self.scheduler, ticket)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        try:
+            job.future = self._executor.submit(job.run)
+        except RuntimeError:
+            # The manager was shut down
+            self.scheduler.release(ticket)
+            raise
+        return job
+
+    # Raises KeyError for unknown (or expired) jobs
+    def get(self, job_id: str) -> Job:
+        with self._lock:
+            return self._jobs[job_id]
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        job.cancel()
+        return job
+
+    # Cancel every job, e.g. when the server shuts down
+    def shutdown(self) -> None:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # Forget the oldest finished jobs; lock must be held
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[: max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job_id]
+
+
+pipeline_jobs = PipelineJobManager(pipeline_scheduler, PIPELINE_JOB_HISTORY)
@@ -0,0 +1,78 @@
+from pathlib import Path
+import io
+import os
+import uuid
+import numpy as np
+from app.schemas.metrics import Metrics
+
+# Metrics stored as float32 columns, NaN where a frame was not scored
+METRIC_COLUMNS = ("psnr", "ssim", "psnr_u", "psnr_v")
+
+
+# The metrics of a pipeline run are kept next to its (first) output file
+def get_metrics_sidecar_path(video_path: Path) -> Path:
+    return video_path.with_name(f"{video_path.name}.metrics.npz")
+
+
+# Write the per-frame metrics of a run comparing the videos with the given
+# identities: one column per metric, a column of messages and the identities
+def write_metrics_sidecar(
+    output_path: Path, video_identities: list[str], metrics: list[Metrics]
+) -> None:
+    columns = {
+        name: np.array(
+            [np.nan if (value := getattr(m, name)) is None else value for m in metrics],
+            dtype=np.float32,
+        )
+        for name in METRIC_COLUMNS
+    }
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        allow_pickle=False,
+        videos=np.array(sorted(video_identities), dtype=np.str_),
+        message=np.array([m.message or "" for m in metrics], dtype=np.str_),
+        **columns,
+    )
+
+    # Write to a temporary file first so readers never see partial sidecars
+    path = get_metrics_sidecar_path(output_path)
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp_path.write_bytes(buffer.getvalue())
+    os.replace(tmp_path, path)
+
+
+# Metrics of a sidecar, or None if it is missing, unreadable or compares other
+# videos
+def read_metrics_sidecar(
+    path: Path, video_identities: list[str]
+) -> list[Metrics] | None:
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if data["videos"].tolist() != sorted(video_identities):
+                return None
+            messages: list[str] = data["message"].tolist()
+            columns = {name: data[name].tolist() for name in METRIC_COLUMNS}
+    except (OSError, KeyError, ValueError):
+        return None
+    return [
+        Metrics(
+            message=message or None,
+            **{
+                name: None if np.isnan(column[i]) else column[i]
+                for name, column in columns.items()
+            },
+        )
+        for i, message in enumerate(messages)
+    ]
+
+
+# Metrics a pipeline run computed between the given videos, or None
+def find_pipeline_metrics(
+    video_paths: list[Path], video_identities: list[str]
+) -> list[Metrics] | None:
+    for path in video_paths:
+        metrics = read_metrics_sidecar(get_metrics_sidecar_path(path), video_identities)
+        if metrics is not None:
+            return metrics
+    return None
@@ -0,0 +1,80 @@
+from typing import Any
+import hashlib
+import io
+import json
+import zlib
+import numpy as np
+from app.modules.module import ModuleBase
+from app.schemas.pipeline import PipelineModule
+from app.utils.constants import NODE_CACHE_DIR, NODE_CACHE_MAX_BYTES
+from app.utils.disk_cache import DiskLRUCache
+from app.utils.shared_functionality import get_video_path
+
+# Shared by every pipeline run (and every process) of this server
+node_output_cache = DiskLRUCache(NODE_CACHE_DIR, NODE_CACHE_MAX_BYTES)
+
+
+def is_node_cache_enabled() -> bool:
+    return node_output_cache.enabled
+
+
+# Identity of a source video file: changes whenever the file is replaced
+def get_source_identity(path: str) -> dict[str, Any]:
+    video_path = get_video_path(path)
+    stat = video_path.stat()
+    return {"path": str(video_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+# Key every module by a hash of its own class, code version and validated
+# parameters and the keys of its inputs, i.e. of the whole upstream subgraph
+# down to the source video. Editing a module, or replacing its binary, changes
+# its key and the keys of everything downstream
+def get_node_keys(
+    ordered_modules: list[PipelineModule],
+    module_map: dict[str, tuple[ModuleBase, dict[str, Any]]],
+    source_identity: dict[str, Any],
+) -> dict[str, str]:
+    keys: dict[str, str] = {}
+
+    for mod in ordered_modules:
+        mod_instance, params = module_map[mod.id]
+        signature = {
+            "module_class": mod.module_class,
+            "executable": mod_instance.executable_path,
+            "version": mod_instance.get_code_version(),
+            "parameters": params,
+            "sources": [keys[src_id] for src_id in mod.source],
+        }
+        if not mod.source:
+            signature["video"] = source_identity
+        keys[mod.id] = hashlib.sha256(
+            json.dumps(signature, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    return keys
+
+
+def encode_frame(frame: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, frame, allow_pickle=False)
+    # Fastest level: the cache has to be cheaper than recomputing the frame
+    return zlib.compress(buffer.getvalue(), 1)
+
+
+def decode_frame(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(zlib.decompress(data)), allow_pickle=False)
+
+
+# Cached output of a module for a frame, or None
+def get_node_output(node_key: str, frame_index: int) -> np.ndarray | None:
+    data = node_output_cache.get(f"{node_key}-{frame_index}")
+    if data is None:
+        return None
+    try:
+        return decode_frame(data)
+    except (zlib.error, ValueError, OSError):
+        return None
+
+
+def put_node_output(node_key: str, frame_index: int, frame: np.ndarray) -> None:
+    node_output_cache.put(f"{node_key}-{frame_index}", encode_frame(frame))
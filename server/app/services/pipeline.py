@@ -1,14 +1,59 @@
 import numpy as np
 from collections import defaultdict, deque
-from typing import Any, Iterator
-from pydantic import ValidationError
+from concurrent.futures import (
+    FIRST_EXCEPTION,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import AbstractContextManager, ExitStack, nullcontext
+from typing import Any, Callable, TypeVar
+import hashlib
+import itertools
+import multiprocessing
+from multiprocessing.sharedctypes import Synchronized
+from multiprocessing.synchronize import Event as EventType
+import queue
+import threading
+from pydantic import BaseModel, ValidationError
+from app.db.convert_json_to_modules import get_all_mock_modules
+from app.modules.inputs.video_source import VideoInfo, VideoSource
 from app.modules.module import ModuleBase
+from app.modules.outputs.video_output import VideoOutput, find_ffmpeg
 from app.schemas.pipeline import PipelineModule
 from app.schemas.pipeline import PipelineRequest, PipelineResponse
 from app.services.module_registry import ModuleRegistry
+from app.services.plan_optimizer import optimize_pipeline
+from app.services import frame_store, node_cache
+from app.services.frame_store import fill_frame_store, get_video_identity
+from app.services.metrics_sidecar import write_metrics_sidecar
+from app.services.video_index import VideoIndex, video_indexes
+from app.services.result_cache import pipeline_result_cache
+from app.services.node_cache import (
+    get_node_keys,
+    get_node_output,
+    get_source_identity,
+    is_node_cache_enabled,
+    put_node_output,
+)
 import uuid
 import base64
-from app.utils.quality_metrics import compute_metrics
+from app.utils.constants import (
+    METRICS_FORMAT,
+    METRICS_SAMPLE_INTERVAL,
+    METRICS_SAMPLING,
+    METRICS_SCENE_THRESHOLD,
+    PIPELINE_BRANCH_WORKERS,
+    PIPELINE_FRAME_WORKERS,
+    PIPELINE_OPTIMIZE,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_SEGMENT_MIN_FRAMES,
+    PIPELINE_SEGMENT_WORKERS,
+)
+from app.utils.metrics_sampling import MetricsSampler
+from app.utils.quality_metrics import compute_bgr_metrics
 from app.schemas.metrics import Metrics
 from app.modules.utils.enums import ModuleName
 from pathlib import Path
@@ -17,11 +62,39 @@ import json
 
 EXAMPLES_DIR = Path(__file__).parent.parent / "db/examples"
 
+# How often blocked pipeline stages check whether they should stop (seconds)
+QUEUE_POLL_INTERVAL = 0.1
+
+T = TypeVar("T")
+
+# Called by the runners after every finished frame with the number of frames
+# finished so far; raising from it (e.g. PipelineCancelledError) stops the run
+FrameCallback = Callable[[int], None]
+
+
+class PipelineCancelledError(Exception):
+    """Raised when a pipeline run is cancelled before it completes"""
+
+
+# Progress counter and cancel flag shared with the segment worker processes
+_segment_worker_state: "tuple[Synchronized[int], EventType] | None" = None
+
 
 def get_module_class(module: PipelineModule) -> str:
     return module.module_class
 
 
+# Run a single module on its input frames from the frame cache
+def run_pipeline_module(
+    mod: PipelineModule,
+    frame_cache: dict[str, np.ndarray],
+    module_map: dict[str, tuple[ModuleBase, dict[str, Any]]],
+) -> np.ndarray:
+    mod_instance, params = module_map[mod.id]
+    input_frames = [frame_cache[src_id] for src_id in mod.source]
+    return mod_instance.process_frame(input_frames[0], params)
+
+
 # Process a single frame through the pipeline
 def process_pipeline_frame(
     frame_cache: dict[str, np.ndarray],
@@ -29,12 +102,62 @@ def process_pipeline_frame(
     module_map: dict[str, tuple[ModuleBase, dict[str, Any]]],
 ) -> None:
     for mod in ordered_modules:
-        mod_id = mod.id
-        mod_instance, params = module_map[mod_id]
+        frame_cache[mod.id] = run_pipeline_module(mod, frame_cache, module_map)
 
-        input_frames = [frame_cache[src_id] for src_id in mod.source]
-        frame_output = mod_instance.process_frame(input_frames[0], params)
-        frame_cache[mod_id] = frame_output
+
+# Process a single frame level by level, running the independent modules of
+# each level (e.g. the left and right comparison branches) on the thread pool
+def process_pipeline_frame_parallel(
+    frame_cache: dict[str, np.ndarray],
+    levels: list[list[PipelineModule]],
+    module_map: dict[str, tuple[ModuleBase, dict[str, Any]]],
+    executor: Executor,
+) -> None:
+    run_pipeline_levels(
+        frame_cache,
+        levels,
+        lambda mod: run_pipeline_module(mod, frame_cache, module_map),
+        executor,
+    )
+
+
+# Run the modules of every level with `run_module`, the independent modules of
+# a level on the thread pool if there is one, and store their outputs in the
+# frame cache
+def run_pipeline_levels(
+    frame_cache: dict[str, np.ndarray],
+    levels: list[list[PipelineModule]],
+    run_module: Callable[[PipelineModule], np.ndarray],
+    executor: Executor | None,
+) -> None:
+    for level in levels:
+        if executor is None or len(level) <= 1:
+            for mod in level:
+                frame_cache[mod.id] = run_module(mod)
+            continue
+        futures = [(mod.id, executor.submit(run_module, mod)) for mod in level]
+        # Only the calling thread writes to the frame cache
+        for mod_id, future in futures:
+            frame_cache[mod_id] = future.result()
+
+
+# Group ordered modules by dependency level: every module only depends on
+# modules of earlier levels, so the modules within a level are independent
+def get_execution_levels(
+    ordered_modules: list[PipelineModule],
+) -> list[list[PipelineModule]]:
+    level_of: dict[str, int] = {}
+    levels: list[list[PipelineModule]] = []
+
+    for mod in ordered_modules:
+        # Sources outside the given modules (e.g. the video source) are level -1
+        level = 1 + max((level_of.get(src_id, -1) for src_id in mod.source), default=-1)
+        level_of[mod.id] = level
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(mod)
+
+    return levels
 
 
 # Get modules in correct execution order in the pipeline
@@ -84,8 +207,23 @@ def get_execution_order(modules: list[PipelineModule]) -> list[PipelineModule]:
     return execution_order
 
 
-# Handle the pipeline request and process the video
-def handle_pipeline_request(request: PipelineRequest) -> PipelineResponse:
+# Validated, ready-to-run view of a pipeline request
+class PipelinePlan(BaseModel):
+    source: PipelineModule
+    processing_nodes: list[PipelineModule]
+    processing_levels: list[list[PipelineModule]]
+    result_modules: list[PipelineModule]
+    module_map: dict[str, tuple[ModuleBase, dict[str, Any]]]
+    # Content hash of every module's upstream subgraph, including the source
+    # video's identity; empty when the source video does not exist
+    node_keys: dict[str, str] = {}
+    # Whether a module keeps state between frames: such plans are run in frame
+    # order, by a single runner, and their node outputs are not cached
+    stateful: bool = False
+
+
+# Validate the pipeline request and resolve its modules and parameters
+def build_pipeline_plan(request: PipelineRequest) -> PipelinePlan:
     ordered_modules: list[PipelineModule] = get_execution_order(request.modules)
     # Validate pipeline structure
     if not ordered_modules:
@@ -110,7 +248,7 @@ def handle_pipeline_request(request: PipelineRequest) -> PipelineResponse:
     # Validate module parameters
     for mod in ordered_modules:
         mod_id = mod.id
-        mod_instance, params = module_map[mod_id]
+        mod_instance, _ = module_map[mod_id]
         param_dict = {p.key: p.value for p in mod.parameters}
         try:
             validated = mod_instance.parameter_model(**param_dict)
@@ -137,6 +275,15 @@ def handle_pipeline_request(request: PipelineRequest) -> PipelineResponse:
         if source_mod.id in result_mod.source:
             raise ValueError("Pipeline must have at least one processing node")
 
+    # Remove and fuse redundant modules; this can leave no processing node
+    if PIPELINE_OPTIMIZE:
+        ordered_modules = optimize_pipeline(ordered_modules, module_map)
+        result_modules = [
+            module
+            for module in ordered_modules
+            if get_module_class(module) == ModuleName.RESULT
+        ]
+
     # Get processing nodes (remove source and result modules)
     processing_nodes = [
         m
@@ -144,86 +291,781 @@ def handle_pipeline_request(request: PipelineRequest) -> PipelineResponse:
         if m.module_class not in {ModuleName.VIDEO_SOURCE, ModuleName.RESULT}
     ]
 
-    with module_map[source_mod.id][0].process(None, module_map[source_mod.id][1]) as (
-        source_file,
-        fps,
-        frame_iter,
-    ):
-        # Frame storage of original frames
-        original_frames: list[np.ndarray] = []
-        # Frame storage per result module
-        result_frames: dict[str, list[np.ndarray]] = {
-            mod.id: [] for mod in result_modules
-        }
+    node_keys: dict[str, str] = {}
+    try:
+        source_identity = get_source_identity(module_map[source_mod.id][1]["path"])
+    except FileNotFoundError:
+        # Reported by the video source when the pipeline runs
+        source_identity = None
+    if source_identity is not None:
+        node_keys = get_node_keys(
+            [source_mod, *processing_nodes], module_map, source_identity
+        )
 
-        # Run frames through whole pipeline and return the frames that need to be written
-        def base_pipeline_iterator() -> Iterator[tuple[str, np.ndarray]]:
-            frame_cache: dict[str, np.ndarray] = {}
-            for frame in frame_iter:
-                original_frames.append(frame.copy())
-                frame_cache.clear()
-                frame_cache[source_mod.id] = frame
-                # Process frames and save them to a frame cache
-                process_pipeline_frame(frame_cache, processing_nodes, module_map)
-                for result_mod in result_modules:
-                    for sid in result_mod.source:
-                        # Yield the result module and the corresponding frames to be written
-                        yield (result_mod.id, frame_cache[sid])
+    return PipelinePlan(
+        source=source_mod,
+        processing_nodes=processing_nodes,
+        processing_levels=get_execution_levels(processing_nodes),
+        result_modules=result_modules,
+        module_map=module_map,
+        node_keys=node_keys,
+        stateful=any(
+            module_map[mod.id][0].is_stateful(module_map[mod.id][1])
+            for mod in processing_nodes
+        ),
+    )
+
+
+# Whether the plan's node outputs are taken from, and stored in, the node cache
+def uses_node_cache(plan: PipelinePlan) -> bool:
+    return bool(plan.node_keys) and not plan.stateful and is_node_cache_enabled()
+
+
+# Whether the plan runs on the staged runner's frame workers, which process
+# frames one at a time and out of order
+def uses_frame_workers(plan: PipelinePlan) -> bool:
+    return (
+        PIPELINE_FRAME_WORKERS > 1
+        and not plan.stateful
+        and get_plan_batch_size(plan) == 1
+    )
+
+
+# Only compute what the results need: walk up from the result inputs and stop
+# at the first module whose output for this frame is cached, so that a re-run
+# only executes the modules downstream of an edit. The modules left to run are
+# run level by level, on the branch thread pool if there is one
+def process_pipeline_frame_cached(
+    frame_cache: dict[str, np.ndarray],
+    plan: PipelinePlan,
+    frame_index: int,
+    executor: Executor | None = None,
+) -> None:
+    nodes = {mod.id: mod for mod in plan.processing_nodes}
+    to_run: set[str] = set()
+
+    def resolve(mod_id: str) -> None:
+        if mod_id in frame_cache or mod_id in to_run:
+            return
+        output = get_node_output(plan.node_keys[mod_id], frame_index)
+        if output is not None:
+            frame_cache[mod_id] = output
+            return
+        to_run.add(mod_id)
+        for src_id in nodes[mod_id].source:
+            resolve(src_id)
 
-        for mod_id, frame in base_pipeline_iterator():
-            result_frames[mod_id].append(frame)
+    for result_mod in plan.result_modules:
+        for sid in result_mod.source:
+            resolve(sid)
 
-        outputs: list[dict[str, str]] = []
+    def run_module(mod: PipelineModule) -> np.ndarray:
+        output = run_pipeline_module(mod, frame_cache, plan.module_map)
+        put_node_output(plan.node_keys[mod.id], frame_index, output)
+        return output
 
-        for result_mod in result_modules:
-            mod_instance, params = module_map[result_mod.id]
+    levels = [
+        [mod for mod in level if mod.id in to_run] for level in plan.processing_levels
+    ]
+    run_pipeline_levels(frame_cache, levels, run_module, executor)
+
+
+# Process a frame of the plan with whichever strategy the plan allows
+def process_plan_frame(
+    frame_cache: dict[str, np.ndarray],
+    plan: PipelinePlan,
+    frame_index: int,
+    executor: Executor | None = None,
+) -> None:
+    if uses_node_cache(plan):
+        process_pipeline_frame_cached(frame_cache, plan, frame_index, executor)
+    elif executor is not None:
+        process_pipeline_frame_parallel(
+            frame_cache, plan.processing_levels, plan.module_map, executor
+        )
+    else:
+        process_pipeline_frame(frame_cache, plan.processing_nodes, plan.module_map)
+
+
+# Number of consecutive frames to process together: the largest batch size the
+# plan's processing modules ask for
+def get_plan_batch_size(plan: PipelinePlan) -> int:
+    return max(
+        (
+            plan.module_map[mod.id][0].get_batch_size(plan.module_map[mod.id][1])
+            for mod in plan.processing_nodes
+        ),
+        default=1,
+    )
+
+
+# Process consecutive frames of the plan together, so that modules preferring
+# batches (e.g. batch mode binaries) get them; like
+# process_pipeline_frame_cached, modules whose outputs are all cached are
+# neither run nor their inputs computed
+def process_plan_batch(
+    frame_caches: list[dict[str, np.ndarray]],
+    plan: PipelinePlan,
+    first_index: int,
+) -> None:
+    nodes = {mod.id: mod for mod in plan.processing_nodes}
+    use_node_cache = uses_node_cache(plan)
 
-            # Create video file name
-            unique_id = uuid.uuid4()
-            filename_base64 = (
-                base64.urlsafe_b64encode(unique_id.bytes).decode("utf-8").rstrip("=")
+    def resolve(mod_id: str) -> None:
+        if mod_id in frame_caches[0]:
+            return
+        outputs: list[np.ndarray] = []
+        if use_node_cache:
+            for i in range(len(frame_caches)):
+                output = get_node_output(plan.node_keys[mod_id], first_index + i)
+                if output is None:
+                    break
+                outputs.append(output)
+        if len(outputs) < len(frame_caches):
+            mod = nodes[mod_id]
+            for src_id in mod.source:
+                resolve(src_id)
+            mod_instance, params = plan.module_map[mod_id]
+            outputs = mod_instance.process_batch(
+                [frame_cache[mod.source[0]] for frame_cache in frame_caches], params
             )
-            filename = f"{source_file}-{filename_base64}.webm"
+            if use_node_cache:
+                for i, output in enumerate(outputs):
+                    put_node_output(plan.node_keys[mod_id], first_index + i, output)
+        for frame_cache, output in zip(frame_caches, outputs):
+            frame_cache[mod_id] = output
 
-            params["path"] = filename
-            params["fps"] = fps
+    for result_mod in plan.result_modules:
+        for sid in result_mod.source:
+            resolve(sid)
+
+
+# Create a unique output file name for a result of the given source video
+def make_output_filename(source_file: str) -> str:
+    unique_id = uuid.uuid4()
+    filename_base64 = (
+        base64.urlsafe_b64encode(unique_id.bytes).decode("utf-8").rstrip("=")
+    )
+    return f"{source_file}-{filename_base64}.webm"
+
+
+# Compute the metrics of a single frame pair in the configured format; frames
+# left out by the metrics sampling get empty metrics
+def compute_frame_metrics(
+    frame1: np.ndarray, frame2: np.ndarray, error_msg: str, sampled: bool = True
+) -> Metrics:
+    if frame1.shape != frame2.shape:
+        return Metrics(message=error_msg, psnr=None, ssim=None)
+    if not sampled:
+        return Metrics(message=None, psnr=None, ssim=None)
+    return compute_bgr_metrics(frame1, frame2, METRICS_FORMAT)
 
-            # Pass only the frames for the specific result module
-            def frame_iter_result() -> Iterator[np.ndarray]:
-                yield from result_frames[result_mod.id]
 
-            mod_instance.process(frame_iter_result(), params)
+# Compare the original frame against the single result, or both results
+def score_pipeline_frame(
+    plan: PipelinePlan, frame_cache: dict[str, np.ndarray], sampled: bool = True
+) -> Metrics:
+    if len(plan.result_modules) == 1:
+        return compute_frame_metrics(
+            frame_cache[plan.source.id],
+            frame_cache[plan.result_modules[0].source[0]],
+            "Original and processed frames must match in size for metric comparison",
+            sampled,
+        )
+    return compute_frame_metrics(
+        frame_cache[plan.result_modules[0].source[0]],
+        frame_cache[plan.result_modules[1].source[0]],
+        "Result frames must be the same size for metric comparison",
+        sampled,
+    )
+
+
+# Sampler of the frames a run scores, following the server's configuration
+def create_metrics_sampler() -> MetricsSampler:
+    return MetricsSampler(
+        METRICS_SAMPLING, METRICS_SAMPLE_INTERVAL, METRICS_SCENE_THRESHOLD
+    )
 
-            # Return the video player side and video file name
-            outputs.append({"video_player": params["video_player"], "path": filename})
 
-        output_map = {entry["video_player"]: entry["path"] for entry in outputs}
+# Open one writer per result module; the writers are closed with the stack
+# Output file names can be given per result module (for segments), otherwise
+# they are generated and, once a run succeeds, its output videos fill the
+# frame store. If the run fails or is cancelled, its truncated output videos
+# are removed
+def open_result_writers(
+    plan: PipelinePlan,
+    stack: ExitStack,
+    source_file: str,
+    fps: float,
+    filenames: dict[str, str] | None = None,
+) -> tuple[dict[str, Callable[[np.ndarray], None]], list[dict[str, str]]]:
+    writers: dict[str, Callable[[np.ndarray], None]] = {}
+    outputs: list[dict[str, str]] = []
+
+    for result_mod in plan.result_modules:
+        mod_instance, params = plan.module_map[result_mod.id]
+        if not isinstance(mod_instance, VideoOutput):
+            raise ValueError(f"Result module must be a {ModuleName.RESULT} module")
+        if filenames is not None:
+            filename = filenames[result_mod.id]
+        else:
+            filename = make_output_filename(source_file)
+        params["path"] = filename
+        params["fps"] = fps
+        # Pushed first, so that they run once the writer has closed the file
+        output_path = mod_instance.get_output_path(params)
+        stack.push(remove_after_failure(output_path))
+        if filenames is None:
+            stack.push(fill_after_success(output_path))
+        writers[result_mod.id] = stack.enter_context(mod_instance.open_writer(params))
+
+        # Return the video player side and video file name
+        outputs.append({"video_player": params["video_player"], "path": filename})
+
+    return writers, outputs
+
+
+# Exit callback filling the frame store with an output video, unless the run
+# failed
+def fill_after_success(output_path: Path) -> Callable[..., None]:
+    def fill(exc_type: type[BaseException] | None, *_: Any) -> None:
+        if exc_type is None:
+            fill_frame_store(output_path)
+
+    return fill
+
+
+# Exit callback removing an output video if the run failed or was cancelled
+def remove_after_failure(output_path: Path) -> Callable[..., None]:
+    def remove(exc_type: type[BaseException] | None, *_: Any) -> None:
+        if exc_type is not None:
+            output_path.unlink(missing_ok=True)
+
+    return remove
+
+
+# Open the processing modules' sessions for a run (e.g. persistent binary
+# workers); they are closed with the stack
+def open_module_sessions(plan: PipelinePlan, stack: ExitStack) -> None:
+    for mod in plan.processing_nodes:
+        mod_instance, params = plan.module_map[mod.id]
+        stack.enter_context(mod_instance.open_session(params))
+
+
+def build_pipeline_response(
+    outputs: list[dict[str, str]], metrics: list[Metrics]
+) -> PipelineResponse:
+    output_map = {entry["video_player"]: entry["path"] for entry in outputs}
+
+    return PipelineResponse(
+        left=output_map.get("left", ""),
+        right=output_map.get("right", ""),
+        metrics=metrics,
+    )
+
+
+# Run the plan frame by frame: every decoded frame is processed, written to the
+# open result writers and scored before the next one is read, so memory usage
+# does not grow with the length of the video. Modules asking for batches get
+# that many frames at a time
+def run_pipeline_streaming(
+    plan: PipelinePlan,
+    filenames: dict[str, str] | None = None,
+    on_frame: FrameCallback | None = None,
+) -> PipelineResponse:
+    source_instance, source_params = plan.module_map[plan.source.id]
+
+    # Independent branches are only worth a thread pool if there are any
+    max_branches = max((len(level) for level in plan.processing_levels), default=1)
+
+    with ExitStack() as stack:
+        executor: Executor | None = None
+        if max_branches > 1 and PIPELINE_BRANCH_WORKERS > 1:
+            executor = stack.enter_context(
+                ThreadPoolExecutor(
+                    max_workers=min(max_branches, PIPELINE_BRANCH_WORKERS),
+                    thread_name_prefix="pipeline-branch",
+                )
+            )
+
+        source_file, fps, frame_iter = stack.enter_context(
+            source_instance.process(None, source_params)
+        )
+        writers, outputs = open_result_writers(plan, stack, source_file, fps, filenames)
+        open_module_sessions(plan, stack)
 
         # Frame-by-frame metrics
         metrics: list[Metrics] = []
-        if len(result_modules) in (1, 2):
-            if len(result_modules) == 1:
-                frames1 = original_frames
-                frames2 = result_frames[result_modules[0].id]
-                error_msg = "Original and processed frames must match in size for metric comparison"
+        sampler = create_metrics_sampler()
+
+        frame_index: int = source_params.get("start_frame", 0)
+        while True:
+            # Frames are processed one at a time unless a module asks for
+            # batches, whose size can change from batch to batch
+            batch_size = get_plan_batch_size(plan)
+            frames: list[np.ndarray] = list(itertools.islice(frame_iter, batch_size))
+            if not frames:
+                break
+            # Process frames and save them to a frame cache each
+            frame_caches: list[dict[str, np.ndarray]] = [
+                {plan.source.id: frame} for frame in frames
+            ]
+            if batch_size > 1:
+                process_plan_batch(frame_caches, plan, frame_index)
             else:
-                frames1 = result_frames[result_modules[0].id]
-                frames2 = result_frames[result_modules[1].id]
-                error_msg = "Result frames must be the same size for metric comparison"
-
-            for frame1, frame2 in zip(frames1, frames2):
-                if frame1.shape != frame2.shape:
-                    metrics.append(Metrics(message=error_msg, psnr=None, ssim=None))
-                else:
-                    m = compute_metrics(frame1, frame2)
-                    metrics.append(m)
-
-        response = PipelineResponse(
-            left=output_map.get("left", ""),
-            right=output_map.get("right", ""),
-            metrics=metrics,
+                process_plan_frame(frame_caches[0], plan, frame_index, executor)
+
+            for frame, frame_cache in zip(frames, frame_caches):
+                for result_mod in plan.result_modules:
+                    for sid in result_mod.source:
+                        writers[result_mod.id](frame_cache[sid])
+                sampled = sampler.should_score(frame_index, frame)
+                metrics.append(score_pipeline_frame(plan, frame_cache, sampled))
+                if on_frame is not None:
+                    on_frame(len(metrics))
+                frame_index += 1
+
+    return build_pipeline_response(outputs, metrics)
+
+
+# Put an item on a bounded queue, giving up once the stop event is set
+def put_until_stopped(q: queue.Queue[T], item: T, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# Get an item from a queue, returning None once the stop event is set
+def get_until_stopped(q: queue.Queue[T | None], stop: threading.Event) -> T | None:
+    while not stop.is_set():
+        try:
+            return q.get(timeout=QUEUE_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+    return None
+
+
+# Run the plan as three overlapping stages connected by bounded queues:
+# one thread decodes, `workers` threads process and score frames, and one
+# thread per result module encodes. Futures are queued in decode order, so
+# frames reach the encoders and metrics in their original order
+def run_pipeline_staged(
+    plan: PipelinePlan, workers: int, on_frame: FrameCallback | None = None
+) -> PipelineResponse:
+    source_instance, source_params = plan.module_map[plan.source.id]
+
+    # Set by any stage that fails so the others stop instead of blocking
+    stop = threading.Event()
+    errors: list[BaseException] = []
+
+    def fail(e: BaseException) -> None:
+        errors.append(e)
+        stop.set()
+
+    def process_frame(
+        frame_index: int, frame: np.ndarray, sampled: bool
+    ) -> tuple[list[list[np.ndarray]], Metrics]:
+        frame_cache: dict[str, np.ndarray] = {plan.source.id: frame}
+        process_plan_frame(frame_cache, plan, frame_index)
+        result_frames = [
+            [frame_cache[sid] for sid in result_mod.source]
+            for result_mod in plan.result_modules
+        ]
+        return result_frames, score_pipeline_frame(plan, frame_cache, sampled)
+
+    with ExitStack() as stack:
+        source_file, fps, frame_iter = stack.enter_context(
+            source_instance.process(None, source_params)
+        )
+        writers, outputs = open_result_writers(plan, stack, source_file, fps)
+        open_module_sessions(plan, stack)
+
+        executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pipeline-worker"
+        )
+        # Registered last, so it shuts down before the writers and source close
+        stack.callback(executor.shutdown, wait=True, cancel_futures=True)
+
+        pending: queue.Queue[Future[tuple[list[list[np.ndarray]], Metrics]] | None] = (
+            queue.Queue(maxsize=workers * 2)
+        )
+        encode_queues: list[queue.Queue[list[np.ndarray] | None]] = [
+            queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in plan.result_modules
+        ]
+
+        def decode() -> None:
+            try:
+                # Sampling needs the frames in order, so it is decided here
+                sampler = create_metrics_sampler()
+                first_index: int = source_params.get("start_frame", 0)
+                for frame_index, frame in enumerate(frame_iter, first_index):
+                    sampled = sampler.should_score(frame_index, frame)
+                    future = executor.submit(process_frame, frame_index, frame, sampled)
+                    if not put_until_stopped(pending, future, stop):
+                        return
+                put_until_stopped(pending, None, stop)
+            except BaseException as e:
+                fail(e)
+
+        def encode(
+            q: queue.Queue[list[np.ndarray] | None],
+            write: Callable[[np.ndarray], None],
+        ) -> None:
+            try:
+                while (frames := get_until_stopped(q, stop)) is not None:
+                    for frame in frames:
+                        write(frame)
+            except BaseException as e:
+                fail(e)
+
+        threads = [threading.Thread(target=decode, name="pipeline-decode")] + [
+            threading.Thread(
+                target=encode,
+                args=(q, writers[result_mod.id]),
+                name=f"pipeline-encode-{result_mod.id}",
+            )
+            for q, result_mod in zip(encode_queues, plan.result_modules)
+        ]
+        for thread in threads:
+            thread.start()
+
+        metrics: list[Metrics] = []
+        try:
+            while (future := get_until_stopped(pending, stop)) is not None:
+                result_frames, frame_metrics = future.result()
+                for q, frames in zip(encode_queues, result_frames):
+                    put_until_stopped(q, frames, stop)
+                metrics.append(frame_metrics)
+                if on_frame is not None:
+                    on_frame(len(metrics))
+            for q in encode_queues:
+                put_until_stopped(q, None, stop)
+        except BaseException as e:
+            fail(e)
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    return build_pipeline_response(outputs, metrics)
+
+
+# Set up a segment worker process
+def init_segment_worker(
+    frames_done: "Synchronized[int]", cancel_event: EventType
+) -> None:
+    global _segment_worker_state
+    _segment_worker_state = (frames_done, cancel_event)
+    # Worker processes start with an empty module registry
+    get_all_mock_modules()
+    # Each worker would index the caches' directories and evict from them by
+    # its own accounting of their size, so only the server process uses them
+    node_cache.node_output_cache.disable()
+    frame_store.frame_store.disable()
+
+
+# Count a finished frame of a segment worker and stop if the run was cancelled
+def report_segment_frame(_: int) -> None:
+    if _segment_worker_state is None:
+        return
+    frames_done, cancel_event = _segment_worker_state
+    with frames_done.get_lock():
+        frames_done.value += 1
+    if cancel_event.is_set():
+        raise PipelineCancelledError("Pipeline run was cancelled")
+
+
+# Run one frame range of the pipeline inside a worker process, writing each
+# result to the given segment file, and return the metrics of the range
+def run_pipeline_segment(
+    request: PipelineRequest,
+    start_frame: int,
+    end_frame: int | None,
+    filenames: dict[str, str],
+    start_timestamp: float | None = None,
+) -> list[Metrics]:
+    plan = build_pipeline_plan(request)
+    source_params = plan.module_map[plan.source.id][1]
+    source_params["start_frame"] = start_frame
+    source_params["end_frame"] = end_frame
+    source_params["start_timestamp"] = start_timestamp
+    return run_pipeline_streaming(plan, filenames, report_segment_frame).metrics
+
+
+# First frames of the segments of a video: the keyframes at or before evenly
+# spaced frames, so that every segment is reached by a seek to a keyframe.
+# Videos with too few keyframes get fewer segments
+def get_segment_starts(index: VideoIndex, segment_count: int) -> list[int]:
+    return sorted(
+        {
+            index.get_keyframe(index.frame_count * i // segment_count)
+            for i in range(segment_count)
+        }
+    )
+
+
+# Split the video into contiguous frame ranges starting at the given keyframes,
+# run every range in its own process and stitch the encoded segments together;
+# metrics are merged in order. Every segment checks that its seek landed on the
+# timestamp of its first frame
+def run_pipeline_segmented(
+    request: PipelineRequest,
+    plan: PipelinePlan,
+    fps: float,
+    index: VideoIndex,
+    starts: list[int],
+    on_frame: FrameCallback | None = None,
+) -> PipelineResponse:
+    # Fail before processing any frame if the segments cannot be joined
+    find_ffmpeg()
+
+    segment_count = len(starts)
+    # The last range is open-ended, in case the index missed trailing frames
+    bounds: list[int | None] = [*starts, None]
+
+    source_file = Path(str(plan.module_map[plan.source.id][1]["path"])).stem
+    final_names = {
+        result_mod.id: make_output_filename(source_file)
+        for result_mod in plan.result_modules
+    }
+    segment_names = [
+        {
+            mod_id: f"{Path(filename).stem}.part{i}.webm"
+            for mod_id, filename in final_names.items()
+        }
+        for i in range(segment_count)
+    ]
+
+    metrics: list[Metrics] = []
+    outputs: list[dict[str, str]] = []
+    segment_paths: list[Path] = []
+
+    mp_context = multiprocessing.get_context("spawn")
+    frames_done = mp_context.Value("i", 0)
+    cancel_event = mp_context.Event()
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=segment_count,
+            mp_context=mp_context,
+            initializer=init_segment_worker,
+            initargs=(frames_done, cancel_event),
+        ) as pool:
+            futures = [
+                pool.submit(
+                    run_pipeline_segment,
+                    request,
+                    starts[i],
+                    bounds[i + 1],
+                    segment_names[i],
+                    index.timestamps[starts[i]],
+                )
+                for i in range(segment_count)
+            ]
+            try:
+                # Relay the workers' progress until all segments are done
+                reported = 0
+                not_done = set(futures)
+                while not_done:
+                    done, not_done = wait(
+                        not_done,
+                        timeout=QUEUE_POLL_INTERVAL,
+                        return_when=FIRST_EXCEPTION,
+                    )
+                    if any(future.exception() is not None for future in done):
+                        break
+                    if on_frame is not None and frames_done.value != reported:
+                        reported = frames_done.value
+                        on_frame(reported)
+                for future in futures:
+                    metrics.extend(future.result())
+            except BaseException:
+                # Stop the remaining workers at their next frame
+                cancel_event.set()
+                raise
+
+        for result_mod in plan.result_modules:
+            mod_instance, params = plan.module_map[result_mod.id]
+            if not isinstance(mod_instance, VideoOutput):
+                raise ValueError(f"Result module must be a {ModuleName.RESULT} module")
+            parts = [
+                mod_instance.get_output_path({"path": names[result_mod.id]})
+                for names in segment_names
+            ]
+            segment_paths.extend(parts)
+
+            params["path"] = final_names[result_mod.id]
+            params["fps"] = fps
+            mod_instance.concat_segments(parts, params)
+            fill_frame_store(mod_instance.get_output_path(params))
+
+            outputs.append(
+                {"video_player": params["video_player"], "path": params["path"]}
+            )
+    except BaseException:
+        # Joined videos may be incomplete
+        for result_mod in plan.result_modules:
+            mod_instance, _ = plan.module_map[result_mod.id]
+            if isinstance(mod_instance, VideoOutput):
+                params = {"path": final_names[result_mod.id]}
+                mod_instance.get_output_path(params).unlink(missing_ok=True)
+        raise
+    finally:
+        for path in segment_paths:
+            path.unlink(missing_ok=True)
+
+    return build_pipeline_response(outputs, metrics)
+
+
+# Frame rate, (possibly estimated) number of frames and size of the plan's source
+def get_plan_video_info(plan: PipelinePlan) -> VideoInfo:
+    source_instance, source_params = plan.module_map[plan.source.id]
+    if not isinstance(source_instance, VideoSource):
+        raise ValueError(f"Pipeline must start with a {ModuleName.VIDEO_SOURCE} module")
+    return source_instance.get_video_info(source_params)
+
+
+# Frame layout of the plan's source, to split it at keyframes
+def get_plan_video_index(plan: PipelinePlan) -> VideoIndex:
+    source_instance, source_params = plan.module_map[plan.source.id]
+    if not isinstance(source_instance, VideoSource):
+        raise ValueError(f"Pipeline must start with a {ModuleName.VIDEO_SOURCE} module")
+    return video_indexes.get(source_instance.get_source_path(source_params))
+
+
+# Number of processes the segment-parallel runner splits a video across; 1 if
+# the video is too short to be split
+def get_segment_count(frame_count: int) -> int:
+    if PIPELINE_SEGMENT_WORKERS <= 1:
+        return 1
+    return max(
+        1, min(PIPELINE_SEGMENT_WORKERS, frame_count // PIPELINE_SEGMENT_MIN_FRAMES)
+    )
+
+
+# Paths of the videos a run's metrics compare (the source and the result, or
+# both results) and whether they are outputs. Output paths are only known once
+# the run has set them
+def get_compared_video_paths(plan: PipelinePlan) -> list[tuple[Path, bool]]:
+    paths: list[tuple[Path, bool]] = []
+    if len(plan.result_modules) == 1:
+        source_instance, source_params = plan.module_map[plan.source.id]
+        if not isinstance(source_instance, VideoSource):
+            raise ValueError(
+                f"Pipeline must start with a {ModuleName.VIDEO_SOURCE} module"
+            )
+        paths.append((source_instance.get_source_path(source_params), False))
+    for result_mod in plan.result_modules:
+        mod_instance, params = plan.module_map[result_mod.id]
+        if not isinstance(mod_instance, VideoOutput):
+            raise ValueError(f"Result module must be a {ModuleName.RESULT} module")
+        paths.append((mod_instance.get_output_path(params), True))
+    return paths
+
+
+# Write the metrics of a finished run to a sidecar of its first output file
+def save_pipeline_metrics(plan: PipelinePlan, response: PipelineResponse) -> None:
+    paths = get_compared_video_paths(plan)
+    identities = [get_video_identity(path, output) for path, output in paths]
+    output_path = next(path for path, output in paths if output)
+    write_metrics_sidecar(output_path, identities, response.metrics)
+
+
+# Run a validated plan with the best suited runner
+def run_pipeline_plan(
+    request: PipelineRequest,
+    plan: PipelinePlan,
+    on_frame: FrameCallback | None = None,
+) -> PipelineResponse:
+    response: PipelineResponse | None = None
+
+    # Long videos are split into segments processed by separate processes
+    if PIPELINE_SEGMENT_WORKERS > 1 and not plan.stateful:
+        info = get_plan_video_info(plan)
+        segment_count = get_segment_count(info.frame_count)
+        if segment_count > 1:
+            index = get_plan_video_index(plan)
+            starts = get_segment_starts(index, segment_count)
+            if len(starts) > 1:
+                response = run_pipeline_segmented(
+                    request, plan, info.fps, index, starts, on_frame
+                )
+
+    if response is None:
+        if uses_frame_workers(plan):
+            response = run_pipeline_staged(plan, PIPELINE_FRAME_WORKERS, on_frame)
+        else:
+            response = run_pipeline_streaming(plan, on_frame=on_frame)
+
+    # Keep the metrics next to the outputs, so playback does not compute them
+    save_pipeline_metrics(plan, response)
+    return response
+
+
+# Content hash of what a plan computes: the result players and the upstream
+# subgraphs feeding them. Module ids and parameter order do not matter
+def get_pipeline_result_key(plan: PipelinePlan) -> str | None:
+    if not plan.node_keys:
+        return None
+    results = sorted(
+        (
+            str(plan.module_map[result_mod.id][1]["video_player"]),
+            [plan.node_keys[sid] for sid in result_mod.source],
         )
-        return response
+        for result_mod in plan.result_modules
+    )
+    return hashlib.sha256(json.dumps(results).encode("utf-8")).hexdigest()
+
+
+# Whether the output files of a previous response are still available
+def pipeline_outputs_exist(plan: PipelinePlan, response: PipelineResponse) -> bool:
+    output_instance = plan.module_map[plan.result_modules[0].id][0]
+    if not isinstance(output_instance, VideoOutput):
+        return False
+    return all(
+        output_instance.get_output_path({"path": filename}).exists()
+        for filename in (response.left, response.right)
+        if filename
+    )
+
+
+# Execute a validated plan; identical requests are answered from the result
+# cache and concurrent ones only run once. `slot` (e.g. a scheduler slot) is
+# only entered around an actual run
+def execute_pipeline_plan(
+    request: PipelineRequest,
+    plan: PipelinePlan,
+    on_frame: FrameCallback | None = None,
+    slot: Callable[[], AbstractContextManager[Any]] = nullcontext,
+) -> PipelineResponse:
+    def run() -> PipelineResponse:
+        with slot():
+            return run_pipeline_plan(request, plan, on_frame)
+
+    key = get_pipeline_result_key(plan)
+    if key is None:
+        return run()
+    return pipeline_result_cache.get_or_run(
+        key,
+        run,
+        lambda response: pipeline_outputs_exist(plan, response),
+        # Another request cancelling the shared run must not fail this one
+        retry_on=PipelineCancelledError,
+    )
+
+
+# Handle the pipeline request and process the video
+def handle_pipeline_request(
+    request: PipelineRequest, on_frame: FrameCallback | None = None
+) -> PipelineResponse:
+    plan = build_pipeline_plan(request)
+    return execute_pipeline_plan(request, plan, on_frame)
 
 
 def list_examples() -> list[ExamplePipeline]:
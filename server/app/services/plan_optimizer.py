@@ -0,0 +1,132 @@
+from typing import Any
+import json
+from app.modules.module import ModuleBase
+from app.modules.transforms.color import ColorModule
+from app.modules.utils.enums import ModuleName
+from app.schemas.pipeline import PipelineModule
+
+
+# Whether a module is a color conversion to the colorspace it converts from
+def is_identity_color(mod_instance: ModuleBase, params: dict[str, Any]) -> bool:
+    return (
+        isinstance(mod_instance, ColorModule)
+        and not params.get("conversions")
+        and params["input_colorspace"] == params["output_colorspace"]
+    )
+
+
+# Color conversions applied by a (possibly already fused) color module
+def get_color_conversions(params: dict[str, Any]) -> list[list[str]]:
+    return params.get("conversions") or [
+        [params["input_colorspace"], params["output_colorspace"]]
+    ]
+
+
+# Drop the modules whose output never reaches a result module
+def remove_dead_modules(ordered_modules: list[PipelineModule]) -> list[PipelineModule]:
+    live: set[str] = set()
+    for mod in reversed(ordered_modules):
+        if mod.module_class == ModuleName.RESULT or mod.id in live:
+            live.add(mod.id)
+            live.update(mod.source)
+    return [mod for mod in ordered_modules if mod.id in live]
+
+
+# Merge modules that compute the same output: same module, executable and
+# parameters on the same (already merged) sources. The first one is kept and
+# the consumers of the others read from it. Result modules are never merged
+def merge_common_modules(
+    ordered_modules: list[PipelineModule],
+    module_map: dict[str, tuple[ModuleBase, dict[str, Any]]],
+) -> list[PipelineModule]:
+    replaced: dict[str, str] = {}
+    computed: dict[str, str] = {}
+    merged: list[PipelineModule] = []
+
+    for mod in ordered_modules:
+        sources = [replaced.get(src_id, src_id) for src_id in mod.source]
+        if sources != mod.source:
+            mod = mod.model_copy(update={"source": sources})
+
+        if mod.module_class != ModuleName.RESULT:
+            mod_instance, params = module_map[mod.id]
+            signature = json.dumps(
+                [mod.module_class, mod_instance.executable_path, params, sources],
+                sort_keys=True,
+                default=str,
+            )
+            if signature in computed:
+                replaced[mod.id] = computed[signature]
+                del module_map[mod.id]
+                continue
+            computed[signature] = mod.id
+
+        merged.append(mod)
+
+    return merged
+
+
+# Rewrite the ordered modules of a validated pipeline so that fewer full-frame
+# passes are needed:
+# - modules not feeding any result are removed
+# - modules computing the same output are merged, so every distinct
+#   computation runs once per frame
+# - identity color conversions are removed
+# - a color conversion feeding only another color conversion is fused with it
+#   into one conversion chain, run by one module without keeping the
+#   intermediate frames
+# Only rewrites whose output is bit-exact are made: resize chains, for one,
+# are left alone, as a downscale drops detail a single resample would keep
+# Module ids of the remaining modules are kept, so result modules still refer
+# to valid sources. The module map is updated in place
+def optimize_pipeline(
+    ordered_modules: list[PipelineModule],
+    module_map: dict[str, tuple[ModuleBase, dict[str, Any]]],
+) -> list[PipelineModule]:
+    ordered_modules = remove_dead_modules(ordered_modules)
+    for mod_id in module_map.keys() - {mod.id for mod in ordered_modules}:
+        del module_map[mod_id]
+    ordered_modules = merge_common_modules(ordered_modules, module_map)
+
+    consumers: dict[str, int] = {mod.id: 0 for mod in ordered_modules}
+    for mod in ordered_modules:
+        for src_id in mod.source:
+            consumers[src_id] += 1
+
+    # Removed module id -> module id its consumers read from instead
+    replaced: dict[str, str] = {}
+    optimized: dict[str, PipelineModule] = {}
+
+    for mod in ordered_modules:
+        sources = [replaced.get(src_id, src_id) for src_id in mod.source]
+        if sources != mod.source:
+            mod = mod.model_copy(update={"source": sources})
+        mod_instance, params = module_map[mod.id]
+
+        if is_identity_color(mod_instance, params):
+            replaced[mod.id] = sources[0]
+            consumers[sources[0]] += consumers[mod.id] - 1
+            del module_map[mod.id]
+            continue
+
+        source = optimized.get(sources[0]) if len(sources) == 1 else None
+        # Only fuse with a source nobody else reads
+        if source is not None and consumers[source.id] == 1:
+            source_instance, source_params = module_map[source.id]
+            if isinstance(mod_instance, ColorModule) and isinstance(
+                source_instance, ColorModule
+            ):
+                conversions = get_color_conversions(source_params)
+                conversions += get_color_conversions(params)
+                params = {
+                    **params,
+                    "input_colorspace": conversions[0][0],
+                    "conversions": conversions,
+                }
+                module_map[mod.id] = (mod_instance, params)
+                mod = mod.model_copy(update={"source": source.source})
+                del optimized[source.id], module_map[source.id]
+
+        optimized[mod.id] = mod
+
+    return list(optimized.values())
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable
+import threading
+from app.schemas.pipeline import PipelineResponse
+from app.utils.constants import RESULT_CACHE_MAX_ENTRIES
+
+
+class PipelineResultCache:
+    """Responses of finished pipeline runs by request key.
+
+    Concurrent calls with the same key are coalesced: the first caller runs the
+    pipeline and the others wait for, and share, its response or error.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._results: OrderedDict[str, PipelineResponse] = OrderedDict()
+        self._in_flight: dict[str, Future[PipelineResponse]] = {}
+
+    def get_or_run(
+        self,
+        key: str,
+        run: Callable[[], PipelineResponse],
+        is_valid: Callable[[PipelineResponse], bool],
+        retry_on: type[BaseException] | None = None,
+    ) -> PipelineResponse:
+        while True:
+            with self._lock:
+                cached = self._results.get(key)
+                if cached is not None:
+                    # Output files can disappear, e.g. when the server cleans up
+                    if is_valid(cached):
+                        self._results.move_to_end(key)
+                        return cached
+                    del self._results[key]
+
+                future = self._in_flight.get(key)
+                if future is None:
+                    # This caller runs the pipeline
+                    future = Future[PipelineResponse]()
+                    self._in_flight[key] = future
+                    break
+
+            try:
+                return future.result()
+            except BaseException as e:
+                # Waiters run again if the shared run failed with `retry_on`,
+                # e.g. because the request that started it was cancelled
+                if retry_on is None or not isinstance(e, retry_on):
+                    raise
+
+        try:
+            response = run()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            if self.max_entries > 0:
+                self._results[key] = response
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+        future.set_result(response)
+        return response
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+
+
+pipeline_result_cache = PipelineResultCache(RESULT_CACHE_MAX_ENTRIES)
@@ -0,0 +1,250 @@
+from contextlib import contextmanager
+from typing import Generator
+import itertools
+import threading
+from app.modules.inputs.video_source import VideoInfo
+from app.modules.transforms.resize import ResizeModule
+from app.schemas.pipeline import PipelineRequest, PipelineResponse
+from app.services.pipeline import (
+    QUEUE_POLL_INTERVAL,
+    PipelineCancelledError,
+    PipelinePlan,
+    build_pipeline_plan,
+    execute_pipeline_plan,
+    get_plan_batch_size,
+    get_plan_video_info,
+    get_segment_count,
+    uses_frame_workers,
+)
+from app.utils.constants import (
+    PIPELINE_FRAME_WORKERS,
+    PIPELINE_MAX_JOBS,
+    PIPELINE_MAX_QUEUED_JOBS,
+    PIPELINE_MAX_QUEUED_REQUESTS,
+    PIPELINE_MEMORY_BUDGET,
+    PIPELINE_QUEUE_SIZE,
+)
+
+
+class SchedulerFullError(Exception):
+    """Raised when too many pipeline runs are already waiting"""
+
+
+# Priorities of the runs, set by the server rather than by clients so that they
+# cannot overtake the others: synchronous requests hold a connection and a
+# server thread while they wait, so they go before background jobs
+REQUEST_PRIORITY = 1
+JOB_PRIORITY = 0
+
+
+# A pipeline run waiting for, or holding, a slot of the scheduler
+class SchedulerTicket:
+    def __init__(
+        self, client_id: str, priority: int, memory: int, seq: int, blocking: bool
+    ) -> None:
+        self.client_id = client_id
+        self.priority = priority
+        self.memory = memory
+        self.seq = seq
+        # Whether a thread is blocked waiting for the ticket from the start
+        self.blocking = blocking
+        # Whether the run is waiting for its slot (tickets can be enqueued early
+        # to reserve a place in the queue)
+        self.ready = False
+        self.admitted = False
+        self.released = False
+        self.admitted_event = threading.Event()
+
+
+class PipelineScheduler:
+    """Admission control for pipeline runs.
+
+    At most `max_jobs` runs execute at once and their estimated memory must fit
+    `memory_budget`; a single run larger than the budget only runs alone. The
+    next run admitted is the waiting one with the highest priority, then the
+    one whose client has the fewest running jobs and was served least recently,
+    then the oldest, so one client cannot starve the others. The queue is
+    strictly ordered: a large run at its head is not overtaken by smaller ones.
+
+    At most `max_queued` runs wait, of which at most `max_blocking` (all of
+    them by default) are blocking ones, whose caller waits on a thread it
+    cannot use for anything else.
+    """
+
+    def __init__(
+        self,
+        max_jobs: int,
+        max_queued: int,
+        memory_budget: int,
+        max_blocking: int | None = None,
+    ) -> None:
+        self.max_jobs = max(max_jobs, 1)
+        self.max_queued = max_queued
+        self.max_blocking = max_queued if max_blocking is None else max_blocking
+        self.memory_budget = memory_budget
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waiting: list[SchedulerTicket] = []
+        self._running: list[SchedulerTicket] = []
+        self._memory_in_use = 0
+        # Sequence number of the last admission of every client
+        self._last_served: dict[str, int] = {}
+
+    # Reserve a place in the queue; raises SchedulerFullError if it is full
+    def enqueue(
+        self,
+        client_id: str,
+        priority: int = 0,
+        memory: int = 0,
+        blocking: bool = False,
+    ) -> SchedulerTicket:
+        with self._lock:
+            if len(self._waiting) >= self.max_queued:
+                raise SchedulerFullError(
+                    f"Too many pipelines are waiting ({len(self._waiting)}), "
+                    "try again later"
+                )
+            if blocking:
+                blocked = sum(t.blocking for t in self._waiting)
+                if blocked >= self.max_blocking:
+                    raise SchedulerFullError(
+                        f"Too many pipeline requests are waiting ({blocked}), "
+                        "try again later or submit a job"
+                    )
+            ticket = SchedulerTicket(
+                client_id, priority, memory, next(self._seq), blocking
+            )
+            self._waiting.append(ticket)
+        return ticket
+
+    # Block until the ticket is admitted. Raises PipelineCancelledError, and
+    # gives the place up, once `cancelled` is set
+    def wait(
+        self, ticket: SchedulerTicket, cancelled: threading.Event | None = None
+    ) -> None:
+        with self._lock:
+            if ticket.released:
+                raise ValueError("Ticket was already released")
+            ticket.ready = True
+            self._admit()
+        while not ticket.admitted_event.wait(QUEUE_POLL_INTERVAL):
+            if cancelled is not None and cancelled.is_set():
+                self.release(ticket)
+                raise PipelineCancelledError("Pipeline was cancelled while queued")
+
+    # Give back a running slot or a place in the queue
+    def release(self, ticket: SchedulerTicket) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.admitted:
+                self._running.remove(ticket)
+                self._memory_in_use -= ticket.memory
+            else:
+                self._waiting.remove(ticket)
+            self._admit()
+
+    # Run the body once an enqueued ticket is admitted
+    @contextmanager
+    def hold(
+        self, ticket: SchedulerTicket, cancelled: threading.Event | None = None
+    ) -> Generator[None]:
+        try:
+            self.wait(ticket, cancelled)
+            yield
+        finally:
+            self.release(ticket)
+
+    # Enqueue a blocking ticket and run the body once it is admitted
+    @contextmanager
+    def slot(
+        self,
+        client_id: str,
+        priority: int = 0,
+        memory: int = 0,
+        cancelled: threading.Event | None = None,
+    ) -> Generator[None]:
+        ticket = self.enqueue(client_id, priority, memory, blocking=True)
+        with self.hold(ticket, cancelled):
+            yield
+
+    # 1-based position of a waiting ticket in admission order, 0 once admitted
+    def get_position(self, ticket: SchedulerTicket) -> int:
+        with self._lock:
+            if ticket.admitted or ticket.released:
+                return 0
+            return sorted(self._waiting, key=self._admission_key).index(ticket) + 1
+
+    def _admission_key(self, ticket: SchedulerTicket) -> tuple[int, int, int, int]:
+        running = sum(t.client_id == ticket.client_id for t in self._running)
+        return (
+            -ticket.priority,
+            running,
+            self._last_served.get(ticket.client_id, -1),
+            ticket.seq,
+        )
+
+    # Admit ready tickets in order while they fit; lock must be held
+    def _admit(self) -> None:
+        while len(self._running) < self.max_jobs:
+            ready = [t for t in self._waiting if t.ready]
+            if not ready:
+                return
+            ticket = min(ready, key=self._admission_key)
+            fits = self._memory_in_use + ticket.memory <= self.memory_budget
+            if not fits and self._running:
+                return
+            self._waiting.remove(ticket)
+            self._running.append(ticket)
+            self._memory_in_use += ticket.memory
+            self._last_served[ticket.client_id] = next(self._seq)
+            ticket.admitted = True
+            ticket.admitted_event.set()
+
+
+# Estimated bytes of frame data a running plan keeps in memory: the size of a
+# frame at every module (following resizes) times the number of frames the
+# chosen runner has in flight, batches included
+def estimate_plan_memory(plan: PipelinePlan, info: VideoInfo) -> int:
+    frame_bytes = {plan.source.id: info.width * info.height * 3}
+    for mod in plan.processing_nodes:
+        mod_instance, params = plan.module_map[mod.id]
+        if isinstance(mod_instance, ResizeModule):
+            frame_bytes[mod.id] = int(params["width"]) * int(params["height"]) * 3
+        else:
+            frame_bytes[mod.id] = max(frame_bytes[src_id] for src_id in mod.source)
+    bytes_per_frame = sum(frame_bytes.values())
+
+    # The streaming runner, which every segment runs too, holds a batch of
+    # frames at once; the staged runner only runs plans without batches
+    batch_size = get_plan_batch_size(plan)
+    segment_count = 1 if plan.stateful else get_segment_count(info.frame_count)
+    if segment_count > 1:
+        frames_in_flight = segment_count * batch_size
+    elif uses_frame_workers(plan):
+        frames_in_flight = PIPELINE_FRAME_WORKERS + 2 * PIPELINE_QUEUE_SIZE
+    else:
+        frames_in_flight = batch_size
+    return bytes_per_frame * frames_in_flight
+
+
+pipeline_scheduler = PipelineScheduler(
+    PIPELINE_MAX_JOBS,
+    PIPELINE_MAX_QUEUED_JOBS,
+    PIPELINE_MEMORY_BUDGET,
+    PIPELINE_MAX_QUEUED_REQUESTS,
+)
+
+
+# Validate a client's pipeline request and run it once the scheduler admits it
+def handle_scheduled_pipeline_request(
+    request: PipelineRequest, client_id: str, priority: int = REQUEST_PRIORITY
+) -> PipelineResponse:
+    plan = build_pipeline_plan(request)
+    memory = estimate_plan_memory(plan, get_plan_video_info(plan))
+    return execute_pipeline_plan(
+        request,
+        plan,
+        slot=lambda: pipeline_scheduler.slot(client_id, priority, memory),
+    )
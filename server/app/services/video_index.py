@@ -0,0 +1,205 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple
+import threading
+import cv2
+import numpy as np
+from app.services.frame_store import get_video_identity
+from app.utils.constants import VIDEO_FRAME_CACHE_MAX_BYTES, VIDEO_INDEX_CACHE_SIZE
+from app.utils.shared_functionality import as_context
+
+cv2VideoCaptureContext = as_context(cv2.VideoCapture, lambda cap: cap.release())
+
+
+class VideoIndex(NamedTuple):
+    """Frame layout of a video, used to reach any frame without decoding the
+    frames before its keyframe."""
+
+    # Presentation timestamps (ms) of the frames, in display order
+    timestamps: list[float]
+    # Frames decoding can start from, in order; always starts with frame 0
+    keyframes: list[int]
+    fps: float
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.timestamps)
+
+    # Last keyframe at or before the given frame
+    def get_keyframe(self, frame_index: int) -> int:
+        return self.keyframes[max(bisect_right(self.keyframes, frame_index) - 1, 0)]
+
+    # Frame with the given timestamp (ms), or None if no frame has it
+    def find_frame(self, timestamp: float) -> int | None:
+        tolerance = 500 / self.fps
+        frame_index = bisect_left(self.timestamps, timestamp - tolerance)
+        if (
+            frame_index < self.frame_count
+            and abs(self.timestamps[frame_index] - timestamp) <= tolerance
+        ):
+            return frame_index
+        return None
+
+
+# Index a video from its packets, which are read without being decoded where
+# the capture backend supports it. Backends that cannot report keyframes make
+# every frame a keyframe: their own seeking is then relied on, and checked
+# against the timestamps
+def build_video_index(path: Path) -> VideoIndex:
+    with cv2VideoCaptureContext(str(path)) as cap:
+        if not cap.isOpened():
+            raise ValueError(f"Could not open video file {path.name}")
+        fps: float = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        raw = cap.set(cv2.CAP_PROP_FORMAT, -1)
+        timestamps: list[float] = []
+        is_keyframe: list[bool] = []
+        while cap.grab():
+            timestamps.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+            is_keyframe.append(raw and bool(cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME)))
+
+    # Packets come in decoding order, which differs from the display order
+    # with B-frames
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    keyframes = [rank for rank, packet in enumerate(order) if is_keyframe[packet]]
+    if not keyframes:
+        keyframes = list(range(len(timestamps)))
+    if not keyframes or keyframes[0] != 0:
+        keyframes.insert(0, 0)
+    return VideoIndex([timestamps[packet] for packet in order], keyframes, fps)
+
+
+class VideoIndexCache:
+    """Indexes of the videos played or sampled, least recently used evicted
+    first. Videos are identified by path, size and modification time, so
+    replaced files are indexed again."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._indexes: OrderedDict[str, VideoIndex] = OrderedDict()
+
+    def get(self, path: Path) -> VideoIndex:
+        key = get_video_identity(path, output=False)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+
+        index = build_video_index(path)
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > max(self.max_entries, 0):
+                self._indexes.popitem(last=False)
+        return index
+
+
+class DecodedFrameCache:
+    """Size-bounded cache of decoded frames by video identity and frame index,
+    least recently used evicted first. Cached frames are shared: they must not
+    be modified."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._frames: OrderedDict[tuple[str, int], np.ndarray] = OrderedDict()
+        self._size = 0
+
+    def get(self, video_identity: str, frame_index: int) -> np.ndarray | None:
+        key = (video_identity, frame_index)
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+            return frame
+
+    def put(self, video_identity: str, frame_index: int, frame: np.ndarray) -> None:
+        if frame.nbytes > self.max_bytes:
+            return
+        key = (video_identity, frame_index)
+        with self._lock:
+            previous = self._frames.pop(key, None)
+            if previous is not None:
+                self._size -= previous.nbytes
+            self._frames[key] = frame
+            self._size += frame.nbytes
+            while self._size > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self._size -= evicted.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self._size = 0
+
+
+video_indexes = VideoIndexCache(VIDEO_INDEX_CACHE_SIZE)
+decoded_frames = DecodedFrameCache(VIDEO_FRAME_CACHE_MAX_BYTES)
+
+
+def get_video_indexes(video_paths: list[Path]) -> list[VideoIndex]:
+    return [video_indexes.get(path) for path in video_paths]
+
+
+# Move the capture to the last keyframe at or before the given frame and grab
+# the frame there. Returns the index of the grabbed frame, found from its
+# timestamp since backends do not always land where asked, or None if no frame
+# could be grabbed
+def seek_capture(
+    cap: cv2.VideoCapture, index: VideoIndex, frame_index: int
+) -> int | None:
+    cap.set(cv2.CAP_PROP_POS_FRAMES, index.get_keyframe(frame_index))
+    if not cap.grab():
+        return None
+    position = index.find_frame(cap.get(cv2.CAP_PROP_POS_MSEC))
+    if position is None or position > frame_index:
+        # Decode from the start rather than return the wrong frame
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        if not cap.grab():
+            return None
+        position = 0
+    return position
+
+
+# Grab the given frame of the capture, seeking to its keyframe first; the
+# frame can then be retrieved
+def grab_frame(cap: cv2.VideoCapture, index: VideoIndex, frame_index: int) -> bool:
+    position = seek_capture(cap, index, frame_index)
+    if position is None:
+        return False
+    while position < frame_index:
+        if not cap.grab():
+            return False
+        position += 1
+    return True
+
+
+# Decoded frame of a video, or None if the video has no such frame. The frames
+# decoded on the way from its keyframe are cached too, as neighbouring frames
+# are likely to be asked for next
+def read_video_frame(
+    path: Path, video_identity: str, frame_index: int
+) -> np.ndarray | None:
+    frame = decoded_frames.get(video_identity, frame_index)
+    if frame is not None:
+        return frame
+    index = video_indexes.get(path)
+    if not 0 <= frame_index < index.frame_count:
+        return None
+
+    with cv2VideoCaptureContext(str(path)) as cap:
+        if not cap.isOpened():
+            raise ValueError(f"Could not open video file {path.name}")
+        position = seek_capture(cap, index, frame_index)
+        while position is not None:
+            ret, frame = cap.retrieve()
+            if not ret:
+                return None
+            decoded_frames.put(video_identity, position, frame)
+            if position == frame_index:
+                return frame
+            if not cap.grab():
+                return None
+            position += 1
+    return None
@@ -1,3 +1,7 @@
+import os
+from pathlib import Path
+from app.utils.enums import MetricsSampling, SlowConsumerPolicy, VideoFormats
+
 # Supported video formats and their media types
 VIDEO_TYPES = {
     ".mp4": "video/mp4",
@@ -5,3 +9,174 @@ VIDEO_TYPES = {
     ".mov": "video/quicktime",
     ".avi": "video/x-msvideo",
 }
+
+# Maximum number of threads used to run independent pipeline branches of a frame
+PIPELINE_BRANCH_WORKERS = int(
+    os.environ.get("MMRP_PIPELINE_BRANCH_WORKERS", os.cpu_count() or 1)
+)
+
+# Number of threads processing frames concurrently; more than one enables the
+# staged (decode / process / encode) pipeline runner
+PIPELINE_FRAME_WORKERS = int(os.environ.get("MMRP_PIPELINE_FRAME_WORKERS", 1))
+
+# Capacity, in frames, of each queue between the staged pipeline runner stages
+PIPELINE_QUEUE_SIZE = int(os.environ.get("MMRP_PIPELINE_QUEUE_SIZE", 8))
+
+# Whether pipelines are optimized before they run (unused and duplicate
+# modules and identity color conversions removed, resize and color conversion
+# chains fused); set to 0 to run every module exactly as built
+PIPELINE_OPTIMIZE = os.environ.get("MMRP_PIPELINE_OPTIMIZE", "1") != "0"
+
+# Number of processes a long video is split across; more than one enables the
+# segment-parallel pipeline runner
+PIPELINE_SEGMENT_WORKERS = int(os.environ.get("MMRP_PIPELINE_SEGMENT_WORKERS", 1))
+
+# Minimum number of frames per segment of the segment-parallel pipeline runner
+PIPELINE_SEGMENT_MIN_FRAMES = int(
+    os.environ.get("MMRP_PIPELINE_SEGMENT_MIN_FRAMES", 300)
+)
+
+# Directory and size limit (bytes) of the on-disk cache of per-module frame
+# outputs used to skip unchanged modules when a pipeline is re-run. Every
+# module output of every frame is then compressed and written to disk, so it
+# is off (0) unless enabled
+NODE_CACHE_DIR = Path(
+    os.environ.get(
+        "MMRP_NODE_CACHE_DIR",
+        Path(__file__).resolve().parent.parent.parent / "cache" / "nodes",
+    )
+)
+NODE_CACHE_MAX_BYTES = int(os.environ.get("MMRP_NODE_CACHE_MAX_BYTES", 0))
+
+# Number of finished pipeline responses kept to answer identical requests
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("MMRP_RESULT_CACHE_MAX_ENTRIES", 64))
+
+# Number of pipeline runs (synchronous requests and jobs) executed at the same
+# time; further runs wait in the scheduler queue
+PIPELINE_MAX_JOBS = int(os.environ.get("MMRP_PIPELINE_MAX_JOBS", 2))
+
+# Number of pipeline runs that may wait for a slot before new ones are refused
+PIPELINE_MAX_QUEUED_JOBS = int(os.environ.get("MMRP_PIPELINE_MAX_QUEUED_JOBS", 64))
+
+# Number of those that may be synchronous requests. Each one blocks a thread of
+# the server's threadpool (40 threads) while it waits, so this stays well below
+PIPELINE_MAX_QUEUED_REQUESTS = int(
+    os.environ.get("MMRP_PIPELINE_MAX_QUEUED_REQUESTS", 16)
+)
+
+
+# Half of the physical memory, or 4 GiB where it cannot be determined
+def _default_memory_budget() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024**3
+
+
+# Estimated frame memory (bytes) all running pipelines may use together; a run
+# that does not fit waits until enough memory is released
+PIPELINE_MEMORY_BUDGET = int(
+    os.environ.get("MMRP_PIPELINE_MEMORY_BUDGET", _default_memory_budget())
+)
+
+# Number of finished pipeline jobs whose status and result are kept
+PIPELINE_JOB_HISTORY = int(os.environ.get("MMRP_PIPELINE_JOB_HISTORY", 100))
+
+# Which frames of a pipeline run are scored: every frame ("all"), every Nth
+# frame ("every_nth") or the first frame of every scene ("scene_change");
+# unscored frames get empty metrics
+METRICS_SAMPLING = MetricsSampling(os.environ.get("MMRP_METRICS_SAMPLING", "all"))
+
+# Format pipeline frames are scored in: "BGR" (PSNR over all channels, SSIM
+# of the luma) or "YUV_I420" (PSNR and SSIM of the Y plane, plus the PSNR of
+# the U and V planes)
+METRICS_FORMAT = VideoFormats(os.environ.get("MMRP_METRICS_FORMAT", "BGR"))
+
+# Distance between scored frames of the "every_nth" sampling
+METRICS_SAMPLE_INTERVAL = int(os.environ.get("MMRP_METRICS_SAMPLE_INTERVAL", 10))
+
+# Mean absolute difference (0-255) between the thumbnails of two consecutive
+# frames above which the "scene_change" sampling treats them as a cut
+METRICS_SCENE_THRESHOLD = float(os.environ.get("MMRP_METRICS_SCENE_THRESHOLD", 30))
+
+# Number of threads decoding, encoding and scoring the frames sent over
+# /ws/video, shared by all viewers
+FRAME_STREAM_WORKERS = int(os.environ.get("MMRP_FRAME_STREAM_WORKERS", 4))
+
+# Number of frames each /ws/video stream prepares ahead of the socket
+FRAME_STREAM_PREFETCH = int(os.environ.get("MMRP_FRAME_STREAM_PREFETCH", 4))
+
+# Directory and size limit (bytes) of the on-disk store of encoded frames sent
+# over /ws/video, filled by playback and optionally by pipeline runs; 0
+# disables it
+FRAME_STORE_DIR = Path(
+    os.environ.get(
+        "MMRP_FRAME_STORE_DIR",
+        Path(__file__).resolve().parent.parent.parent / "cache" / "frames",
+    )
+)
+FRAME_STORE_MAX_BYTES = int(os.environ.get("MMRP_FRAME_STORE_MAX_BYTES", 2 * 1024**3))
+
+# Whether pipeline runs also store the frames of their outputs, so that their
+# first playback is served from the store. Off by default: encoding every frame
+# again costs about as much CPU as the run, outside of its admission, for
+# videos that may never be played; playback stores the frames it encodes
+FRAME_STORE_FILL_ON_RUN = os.environ.get("MMRP_FRAME_STORE_FILL_ON_RUN", "0") != "0"
+
+# Number of output videos waiting to be stored; further ones are not stored
+FRAME_STORE_FILL_BACKLOG = int(os.environ.get("MMRP_FRAME_STORE_FILL_BACKLOG", 4))
+
+# Number of frames buffered for each viewer of a shared /ws/video stream; a
+# viewer can join a stream from its start until it has produced more frames
+FRAME_HUB_BUFFER_SIZE = int(os.environ.get("MMRP_FRAME_HUB_BUFFER_SIZE", 32))
+
+# What a shared /ws/video stream does with a viewer whose buffer is full: wait
+# for it ("wait"), drop its oldest frame ("drop_oldest") or disconnect it
+# ("disconnect"); the stream never waits for more than its fastest viewer
+# otherwise
+FRAME_HUB_SLOW_CONSUMER = SlowConsumerPolicy(
+    os.environ.get("MMRP_FRAME_HUB_SLOW_CONSUMER", "drop_oldest")
+)
+
+# Number of video indexes (frame timestamps and keyframes, used to seek to any
+# frame) kept in memory
+VIDEO_INDEX_CACHE_SIZE = int(os.environ.get("MMRP_VIDEO_INDEX_CACHE_SIZE", 64))
+
+# Size limit (bytes) of the in-memory cache of frames decoded to answer single
+# frame requests
+VIDEO_FRAME_CACHE_MAX_BYTES = int(
+    os.environ.get("MMRP_VIDEO_FRAME_CACHE_MAX_BYTES", 256 * 1024**2)
+)
+
+# Seconds a persistent ("stream" mode) binary may take to return a frame
+# before it is killed and the run fails
+BINARY_WORKER_TIMEOUT = float(os.environ.get("MMRP_BINARY_WORKER_TIMEOUT", 30))
+
+# Frames per invocation of a "batch" mode binary: the first batch size, the
+# largest one, and the fraction of an invocation its startup may take, which
+# the batch size is adapted to
+BINARY_BATCH_INITIAL_FRAMES = int(os.environ.get("MMRP_BINARY_BATCH_INITIAL_FRAMES", 4))
+BINARY_BATCH_MAX_FRAMES = int(os.environ.get("MMRP_BINARY_BATCH_MAX_FRAMES", 64))
+BINARY_BATCH_OVERHEAD = float(os.environ.get("MMRP_BINARY_BATCH_OVERHEAD", 0.1))
+
+# Binary invocations running at once across every job of the server, and
+# frames a pipeline hands binaries at once to run them concurrently on
+BINARY_MAX_PROCESSES = int(
+    os.environ.get("MMRP_BINARY_MAX_PROCESSES", os.cpu_count() or 1)
+)
+BINARY_POOL_MAX_FRAMES = int(os.environ.get("MMRP_BINARY_POOL_MAX_FRAMES", 128))
+
+
+# /dev/shm where it is a writable memory-backed file system, otherwise the
+# default temporary directory
+def _default_transport_dir() -> str:
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return ""
+
+
+# Directory of the files frames are passed to binaries through; an empty value
+# uses the default temporary directory
+BINARY_TRANSPORT_DIR = os.environ.get(
+    "MMRP_BINARY_TRANSPORT_DIR", _default_transport_dir()
+)
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from pathlib import Path
+import os
+import threading
+import uuid
+
+
+class DiskLRUCache:
+    """Size-bounded key/value store of files under a directory.
+
+    Entries are evicted least recently used first once the total size exceeds
+    `max_bytes`. Reads refresh the file modification time, so the recency order
+    survives restarts. Keys must be valid file names.
+    """
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    # Stop reading and writing entries, e.g. in a process that should not keep
+    # an index of the directory of its own
+    def disable(self) -> None:
+        self.max_bytes = 0
+
+    def get(self, key: str) -> bytes | None:
+        if not self.enabled:
+            return None
+        self._load()
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted, possibly by another process sharing the directory
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return data
+
+    def contains(self, key: str) -> bool:
+        if not self.enabled:
+            return False
+        self._load()
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: str, data: bytes) -> None:
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        self._load()
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so readers never see partial entries
+        tmp_path = path.with_name(f"{key}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            evicted = self._evict()
+
+        for evicted_key in evicted:
+            self._path(evicted_key).unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        self._load()
+        with self._lock:
+            keys = list(self._entries)
+            self._entries.clear()
+            self._size = 0
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
+
+    def _path(self, key: str) -> Path:
+        # Spread entries over subdirectories to keep directories small
+        return self.root / key[:2] / key
+
+    # Index the existing entries, oldest first, the first time the cache is used
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            found: list[tuple[float, str, int]] = []
+            if self.root.exists():
+                for path in self.root.glob("*/*"):
+                    if path.suffix == ".tmp" or not path.is_file():
+                        continue
+                    stat = path.stat()
+                    found.append((stat.st_mtime, path.name, stat.st_size))
+            for _, key, size in sorted(found):
+                self._entries[key] = size
+                self._size += size
+            self._loaded = True
+            evicted = self._evict()
+        for key in evicted:
+            self._path(key).unlink(missing_ok=True)
+
+    # Drop least recently used entries until the cache fits; lock must be held
+    def _evict(self) -> list[str]:
+        evicted: list[str] = []
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            evicted.append(key)
+        return evicted
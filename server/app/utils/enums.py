@@ -5,3 +5,23 @@ class VideoFormats(StrEnum):
     # TODO: add more formats if needed
     YUV_I420 = "YUV_I420"
     BGR = "BGR"
+
+
+class JobState(StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class MetricsSampling(StrEnum):
+    ALL = "all"
+    EVERY_NTH = "every_nth"
+    SCENE_CHANGE = "scene_change"
+
+
+class SlowConsumerPolicy(StrEnum):
+    WAIT = "wait"
+    DROP_OLDEST = "drop_oldest"
+    DISCONNECT = "disconnect"
@@ -0,0 +1,301 @@
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from secrets import token_hex
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+import os
+import re
+import anyio
+import anyio.to_thread
+
+# Size of the chunks files are read in where the server cannot send them
+# itself
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Ranges a request may ask for at once; requests for more are served whole
+# rather than as many small parts
+MAX_RANGES = 16
+
+# ASGI extension through which servers send file data without copying it
+# through Python
+ZEROCOPY_EXTENSION = "http.response.zerocopy"
+
+
+def get_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+# Timestamp of an HTTP date, or None if it is not one
+def parse_http_date(value: str) -> float | None:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+# Whether an If-Match / If-None-Match header lists the entity tag; weak
+# comparison ignores the W/ prefix, strong comparison fails on weak tags
+def etag_matches(header: str, etag: str, weak: bool) -> bool:
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+# Status answering a conditional request (304 or 412) instead of the file, if
+# any, following the precedence of RFC 9110 section 13.2.2
+def evaluate_preconditions(
+    headers: Headers, method: str, etag: str, modified: float
+) -> int | None:
+    # Dates have a one-second resolution
+    modified = int(modified)
+    if (if_match := headers.get("if-match")) is not None:
+        if not etag_matches(if_match, etag, weak=False):
+            return 412
+    elif (if_unmodified_since := headers.get("if-unmodified-since")) is not None:
+        date = parse_http_date(if_unmodified_since)
+        if date is not None and modified > date:
+            return 412
+
+    if (if_none_match := headers.get("if-none-match")) is not None:
+        if etag_matches(if_none_match, etag, weak=True):
+            return 304 if method in ("GET", "HEAD") else 412
+    elif (if_modified_since := headers.get("if-modified-since")) is not None:
+        date = parse_http_date(if_modified_since)
+        if method in ("GET", "HEAD") and date is not None and modified <= date:
+            return 304
+    return None
+
+
+# Byte ranges [start, end) of a `size` bytes file a Range header asks for,
+# sorted, with overlapping and adjacent ranges merged; an empty list if none
+# of them is satisfiable. None if the header is malformed or asks for more than
+# MAX_RANGES ranges, in which case it is ignored
+def parse_range_header(value: str, size: int) -> list[tuple[int, int]] | None:
+    unit, _, specs = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    specs = [spec.strip() for spec in specs.split(",") if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+
+    ranges: list[tuple[int, int]] = []
+    for spec in specs:
+        first, dash, last = spec.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last):
+            return None
+        # Only ASCII digits: int() also takes other Unicode digits, and
+        # str.isdigit() accepts superscripts int() rejects
+        if not (
+            re.fullmatch(r"\d*", first, re.ASCII)
+            and re.fullmatch(r"\d*", last, re.ASCII)
+        ):
+            return None
+        if not first:
+            # Suffix range: the last `last` bytes
+            if int(last) > 0 and size > 0:
+                ranges.append((max(size - int(last), 0), size))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, min(int(last) + 1, size) if last else size))
+
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RangeFileResponse(Response):
+    """A file, or the byte ranges of it the request asks for.
+
+    Supports single (206) and multipart byte ranges, If-Range, and conditional
+    requests against the file's ETag and Last-Modified date (304 / 412). File
+    data is sent by the server itself where it supports the ASGI zero-copy
+    extension, and read in chunks in a worker thread otherwise.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        media_type: str,
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        self.path = path
+        self.stat = path.stat()
+        self.etag = get_etag(self.stat)
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(
+            {
+                **(headers or {}),
+                "accept-ranges": "bytes",
+                "etag": self.etag,
+                "last-modified": formatdate(self.stat.st_mtime, usegmt=True),
+            }
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        headers = Headers(scope=scope)
+        method: str = scope["method"].upper()
+        size = self.stat.st_size
+
+        status = evaluate_preconditions(headers, method, self.etag, self.stat.st_mtime)
+        if status is not None:
+            await self._send_empty(send, status)
+            return
+
+        ranges: list[tuple[int, int]] | None = None
+        if (range_header := headers.get("range")) is not None:
+            if_range = headers.get("if-range")
+            if if_range is None or self._matches_if_range(if_range):
+                ranges = parse_range_header(range_header, size)
+        if ranges is not None and not ranges:
+            await self._send_empty(send, 416, {"content-range": f"bytes */{size}"})
+            return
+
+        body_only = method != "HEAD"
+        if ranges is None:
+            self.headers["content-length"] = str(size)
+            await self._start(send, 200)
+            if body_only:
+                await self._send_file(scope, send, [(0, size)])
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+            self.headers["content-length"] = str(end - start)
+            await self._start(send, 206)
+            if body_only:
+                await self._send_file(scope, send, ranges)
+        else:
+            boundary = token_hex(13)
+            part_headers = [
+                (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {self.media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n"
+                ).encode("latin-1")
+                for start, end in ranges
+            ]
+            closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+            # Every part but the first is preceded by a line break
+            self.headers["content-length"] = str(
+                sum(len(header) for header in part_headers)
+                + sum(end - start for start, end in ranges)
+                + 2 * (len(ranges) - 1)
+                + len(closing)
+            )
+            await self._start(send, 206)
+            if body_only:
+                await self._send_file(scope, send, ranges, part_headers, closing)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    # An If-Range header holds either the strong ETag or the exact date of the
+    # version the client has
+    def _matches_if_range(self, if_range: str) -> bool:
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == self.etag
+        return if_range == self.headers["last-modified"]
+
+    async def _start(self, send: Send, status: int) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": self.raw_headers,
+            }
+        )
+
+    # Send a response without a body; 304 responses keep the file's headers
+    # other than its content type and length
+    async def _send_empty(
+        self, send: Send, status: int, headers: dict[str, str] | None = None
+    ) -> None:
+        raw_headers = [(key, value) for key, value in (headers or {}).items()]
+        if status == 304:
+            raw_headers += [
+                (key, value)
+                for key, value in self.headers.items()
+                if key not in ("content-type", "content-length")
+            ]
+        else:
+            raw_headers.append(("content-length", "0"))
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (key.encode("latin-1"), value.encode("latin-1"))
+                    for key, value in raw_headers
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    # Send the given ranges of the file, each preceded by its part header if
+    # any, followed by the closing delimiter if any; the body is not ended
+    async def _send_file(
+        self,
+        scope: Scope,
+        send: Send,
+        ranges: list[tuple[int, int]],
+        part_headers: list[bytes] | None = None,
+        closing: bytes = b"",
+    ) -> None:
+        zerocopy = ZEROCOPY_EXTENSION in scope.get("extensions", {})
+        file = await anyio.to_thread.run_sync(self.path.open, "rb", 0)
+        with file:
+            for i, (start, end) in enumerate(ranges):
+                if part_headers is not None:
+                    header = part_headers[i] if i == 0 else b"\r\n" + part_headers[i]
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": header,
+                            "more_body": True,
+                        }
+                    )
+                if zerocopy:
+                    await send(
+                        {
+                            "type": ZEROCOPY_EXTENSION,
+                            "file": file,
+                            "offset": start,
+                            "count": end - start,
+                            "more_body": True,
+                        }
+                    )
+                    continue
+                while start < end:
+                    chunk = await anyio.to_thread.run_sync(
+                        os.pread,
+                        file.fileno(),
+                        min(READ_CHUNK_SIZE, end - start),
+                        start,
+                    )
+                    if not chunk:
+                        break
+                    start += len(chunk)
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+        if closing:
+            await send(
+                {"type": "http.response.body", "body": closing, "more_body": True}
+            )
@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+from app.utils.enums import MetricsSampling
+
+# Size of the thumbnails compared to detect scene changes
+SCENE_THUMBNAIL_SIZE = (64, 36)
+
+
+class MetricsSampler:
+    """Decides which frames of a video are scored.
+
+    Frames must be passed in decoding order: scene changes are detected by
+    comparing every frame with the previous one.
+    """
+
+    def __init__(
+        self,
+        policy: MetricsSampling,
+        interval: int = 1,
+        scene_threshold: float = 0.0,
+    ) -> None:
+        self.policy = policy
+        self.interval = max(interval, 1)
+        self.scene_threshold = scene_threshold
+        self._previous: np.ndarray | None = None
+
+    def should_score(self, frame_index: int, frame: np.ndarray) -> bool:
+        match self.policy:
+            case MetricsSampling.ALL:
+                return True
+            case MetricsSampling.EVERY_NTH:
+                # Absolute indices, so split runs sample the same frames
+                return frame_index % self.interval == 0
+            case MetricsSampling.SCENE_CHANGE:
+                return self._is_scene_change(frame)
+
+    # The first frame always starts a scene
+    def _is_scene_change(self, frame: np.ndarray) -> bool:
+        thumbnail = cv2.resize(
+            frame, SCENE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA
+        )
+        previous, self._previous = self._previous, thumbnail
+        if previous is None:
+            return True
+        return float(np.mean(cv2.absdiff(thumbnail, previous))) > self.scene_threshold
@@ -1,16 +1,40 @@
 import cv2
 import numpy as np
-from skimage.metrics import structural_similarity as ssim  # type: ignore
-from typing import cast
 from app.schemas.metrics import Metrics
+from app.utils.enums import VideoFormats
 
+PIXEL_MAX = 255.0
 
-def compute_psnr(img1: np.ndarray, img2: np.ndarray) -> float:
-    mse = np.mean((img1.astype(np.float32) - img2.astype(np.float32)) ** 2)
+# SSIM parameters, matching the defaults of skimage's structural_similarity
+# for 8-bit images: 7x7 uniform window, sample covariance, K1=0.01, K2=0.03
+SSIM_WIN_SIZE = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+
+def psnr_from_mse(mse: float) -> float:
     if mse == 0:
         return 100.0
-    PIXEL_MAX = 255.0
-    return 20 * np.log10(PIXEL_MAX / np.sqrt(mse))
+    return float(20 * np.log10(PIXEL_MAX / np.sqrt(mse)))
+
+
+def compute_psnr(img1: np.ndarray, img2: np.ndarray) -> float:
+    if img1.dtype == np.uint8 and img2.dtype == np.uint8:
+        return float(compute_psnr_batch(img1[np.newaxis], img2[np.newaxis])[0])
+    mse = np.mean((img1.astype(np.float32) - img2.astype(np.float32)) ** 2)
+    return psnr_from_mse(float(mse))
+
+
+# PSNR of every frame pair of two (N, ...) uint8 stacks. The squared errors are
+# summed exactly (in double precision) by OpenCV
+def compute_psnr_batch(frames1: np.ndarray, frames2: np.ndarray) -> np.ndarray:
+    values_per_frame = frames1[0].size
+    return np.array(
+        [
+            psnr_from_mse(cv2.norm(img1, img2, cv2.NORM_L2SQR) / values_per_frame)
+            for img1, img2 in zip(frames1, frames2)
+        ]
+    )
 
 
 def compute_ssim(img1: np.ndarray, img2: np.ndarray) -> float:
@@ -19,15 +43,150 @@ def compute_ssim(img1: np.ndarray, img2: np.ndarray) -> float:
     """
     gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
     gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
-    score = cast(float, ssim(gray1, gray2, full=False))
-    return score
+    return float(compute_ssim_batch(gray1[np.newaxis], gray2[np.newaxis])[0])
+
+
+# Unnormalized sums over the SSIM window around every pixel, as int32
+def window_sums(img: np.ndarray) -> np.ndarray:
+    return cv2.boxFilter(
+        img,
+        cv2.CV_32S,
+        (SSIM_WIN_SIZE, SSIM_WIN_SIZE),
+        normalize=False,
+        borderType=cv2.BORDER_REFLECT_101,
+    )
+
 
+# Mean SSIM of every image pair of two (N, H, W) uint8 stacks, equal to
+# skimage's structural_similarity(img1, img2) up to floating point rounding.
+# The window sums and the products of the variance and covariance numerators
+# are exact integers (they fit in int32 for 8-bit images), so only the final
+# ratio is computed in floating point. The stacks are filtered as one tall
+# image: windows that would straddle two images lie in the border that SSIM
+# leaves out anyway
+def compute_ssim_batch(gray1: np.ndarray, gray2: np.ndarray) -> np.ndarray:
+    count, height, width = gray1.shape
+    if height < SSIM_WIN_SIZE or width < SSIM_WIN_SIZE:
+        raise ValueError(
+            f"Images must be at least {SSIM_WIN_SIZE}x{SSIM_WIN_SIZE} pixels for SSIM"
+        )
+    x = gray1.reshape(count * height, width)
+    y = gray2.reshape(count * height, width)
+    x16 = x.astype(np.uint16)
+    y16 = y.astype(np.uint16)
 
-# TODO: Support YUV_I420 format in addition to RGB.
-#       For YUV_I420 input, expect a tuple of 3 np.ndarrays (Y, U, V), and compute metrics only on the Y plane.
-def compute_metrics(img1: np.ndarray, img2: np.ndarray) -> Metrics:
+    n = SSIM_WIN_SIZE * SSIM_WIN_SIZE
+    sum_x = window_sums(x)
+    sum_y = window_sums(y)
+    sum_squares = window_sums(
+        cv2.add(
+            cv2.multiply(x16, x16, dtype=cv2.CV_32S),
+            cv2.multiply(y16, y16, dtype=cv2.CV_32S),
+        )
+    )
+    sum_xy = window_sums(cv2.multiply(x16, y16))
+    product = cv2.multiply(sum_x, sum_y)
+    squares = cv2.add(cv2.multiply(sum_x, sum_x), cv2.multiply(sum_y, sum_y))
+
+    # skimage's terms with means (sum / n) and sample (co)variances
+    # ((n * sum_xy - sum_x * sum_y) / (n * (n - 1))), multiplied through by
+    # n^2 and n * (n - 1)
+    c1 = (SSIM_K1 * PIXEL_MAX) ** 2 * n * n
+    c2 = (SSIM_K2 * PIXEL_MAX) ** 2 * n * (n - 1)
+    a1 = cv2.addWeighted(product, 2, product, 0, c1, dtype=cv2.CV_64F)
+    a2 = cv2.addWeighted(sum_xy, 2 * n, product, -2, c2, dtype=cv2.CV_64F)
+    b1 = cv2.addWeighted(squares, 1, squares, 0, c1, dtype=cv2.CV_64F)
+    b2 = cv2.addWeighted(sum_squares, n, squares, -1, c2, dtype=cv2.CV_64F)
+    ssim_map = cv2.divide(cv2.multiply(a1, a2), cv2.multiply(b1, b2))
+
+    pad = (SSIM_WIN_SIZE - 1) // 2
+    cropped = ssim_map.reshape(count, height, width)[:, pad:-pad, pad:-pad]
+    return cropped.mean(axis=(1, 2))
+
+
+# Y, U and V planes of an I420 frame, or of a stack of them, in OpenCV's
+# layout: (height * 3 / 2, width) arrays holding the full size Y plane followed
+# by the quarter size U and V planes
+def split_i420_planes(
+    frames: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    *stack, rows, width = frames.shape
+    height = rows * 2 // 3
+    if rows != height * 3 // 2 or height % 2 or width % 2:
+        raise ValueError(f"Invalid I420 frame shape: {frames.shape[-2:]}")
+    chroma = frames[..., height:, :].reshape(*stack, 2, height // 2, width // 2)
+    return frames[..., :height, :], chroma[..., 0, :, :], chroma[..., 1, :, :]
+
+
+# Metrics of every frame pair of two (N, height * 3 / 2, width) I420 stacks,
+# computed on the planes without any color conversion: `psnr` and `ssim` are
+# the Y plane's (luma only, like the SSIM of BGR frames), `psnr_u` and
+# `psnr_v` the chroma planes'
+def compute_i420_metrics_batch(
+    frames1: np.ndarray, frames2: np.ndarray
+) -> list[Metrics]:
+    y1, u1, v1 = split_i420_planes(frames1)
+    y2, u2, v2 = split_i420_planes(frames2)
+    y_psnr = compute_psnr_batch(y1, y2)
+    u_psnr = compute_psnr_batch(u1, u2)
+    v_psnr = compute_psnr_batch(v1, v2)
+    y_ssim = compute_ssim_batch(np.ascontiguousarray(y1), np.ascontiguousarray(y2))
+    return [
+        Metrics(
+            message=None,
+            psnr=float(y_psnr[i]),
+            ssim=float(y_ssim[i]),
+            psnr_u=float(u_psnr[i]),
+            psnr_v=float(v_psnr[i]),
+        )
+        for i in range(len(frames1))
+    ]
+
+
+# Metrics of a frame pair in the given format; BGR frames are scored on all
+# channels (PSNR) and on their luma (SSIM), YUV_I420 frames per plane
+def compute_metrics(
+    img1: np.ndarray, img2: np.ndarray, format: VideoFormats = VideoFormats.BGR
+) -> Metrics:
+    if format == VideoFormats.YUV_I420:
+        return compute_i420_metrics_batch(img1[np.newaxis], img2[np.newaxis])[0]
     return Metrics(
         message=None,
         psnr=float(compute_psnr(img1, img2)),
         ssim=float(compute_ssim(img1, img2)),
     )
+
+
+# Metrics of a BGR frame pair scored in the given format: for YUV_I420 both
+# frames are converted and scored per plane, which needs even dimensions
+def compute_bgr_metrics(
+    img1: np.ndarray, img2: np.ndarray, format: VideoFormats = VideoFormats.BGR
+) -> Metrics:
+    if format != VideoFormats.YUV_I420:
+        return compute_metrics(img1, img2)
+    height, width = img1.shape[:2]
+    if height % 2 or width % 2:
+        return Metrics(
+            message=f"I420 metrics need even frame dimensions, not {width}x{height}",
+            psnr=None,
+            ssim=None,
+        )
+    return compute_metrics(
+        cv2.cvtColor(img1, cv2.COLOR_BGR2YUV_I420),
+        cv2.cvtColor(img2, cv2.COLOR_BGR2YUV_I420),
+        VideoFormats.YUV_I420,
+    )
+
+
+# Metrics of every frame pair of two (N, H, W, 3) BGR uint8 stacks at once
+def compute_metrics_batch(frames1: np.ndarray, frames2: np.ndarray) -> list[Metrics]:
+    count, height, width, _ = frames1.shape
+    gray1 = cv2.cvtColor(frames1.reshape(count * height, width, 3), cv2.COLOR_BGR2GRAY)
+    gray2 = cv2.cvtColor(frames2.reshape(count * height, width, 3), cv2.COLOR_BGR2GRAY)
+    psnr = compute_psnr_batch(frames1, frames2)
+    ssim = compute_ssim_batch(
+        gray1.reshape(count, height, width), gray2.reshape(count, height, width)
+    )
+    return [
+        Metrics(message=None, psnr=float(p), ssim=float(s)) for p, s in zip(psnr, ssim)
+    ]
@@ -2,6 +2,8 @@ from pathlib import Path
 import typing
 import contextlib
 import cv2
+import mmap
+import os
 import re
 import numpy as np
 from app.utils.enums import VideoFormats
@@ -28,6 +30,11 @@ def get_video_path(video: str) -> Path:
     )
 
 
+# Get path of a pipeline output video
+def get_output_video_path(video: str) -> Path:
+    return Path(__file__).resolve().parent.parent.parent / "output" / video
+
+
 # Context manager for video capture and video writer
 T = typing.TypeVar("T")
 P = typing.ParamSpec("P")
@@ -57,24 +64,63 @@ def as_context(
 # Write a YUV frame from a numpy ndarray
 def write_yuv420_frame(frame: np.ndarray, path: Path) -> Path:
     """Write a single BGR frame to YUV420p raw file."""
-    yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
-    with open(path, "wb") as f:
-        f.write(yuv.tobytes())
+    return write_yuv420_frames([frame], path)
+
+
+# Write BGR frames of the same size one after the other to a YUV420p raw file.
+# Frames are converted straight into a memory map of the file, without
+# intermediate buffers
+def write_yuv420_frames(frames: list[np.ndarray], path: Path) -> Path:
+    with open(path, "w+b") as f:
+        if not frames:
+            return path
+        height, width = frames[0].shape[:2]
+        f.truncate(width * height * 3 // 2 * len(frames))
+        with mmap.mmap(f.fileno(), 0) as mapped:
+            _convert_to_yuv420(frames, mapped, width, height)
     return path
 
 
 # Decode YUV frame to numpy ndarray
 def read_yuv420_frame(path: Path, width: int, height: int) -> np.ndarray:
-    expected_size = width * height * 3 // 2
-    data = path.read_bytes()
-    if len(data) != expected_size:
-        raise ValueError(
-            f"YUV size mismatch: expected {expected_size}, got {len(data)}"
-        )
+    return read_yuv420_frames(path, width, height, 1)[0]
+
+
+# Decode the given number of YUV420p frames of a raw file, converted from a
+# memory map of the file without reading it into an intermediate buffer
+def read_yuv420_frames(
+    path: Path, width: int, height: int, count: int
+) -> list[np.ndarray]:
+    expected_size = width * height * 3 // 2 * count
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size != expected_size:
+            raise ValueError(f"YUV size mismatch: expected {expected_size}, got {size}")
+        if not size:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return _convert_from_yuv420(mapped, width, height)
+
+
+# The views of the memory maps below are released when these return, as maps
+# cannot be closed while exported
+def _convert_to_yuv420(
+    frames: list[np.ndarray], buffer: mmap.mmap, width: int, height: int
+) -> None:
+    planes = np.frombuffer(buffer, dtype=np.uint8).reshape(
+        (len(frames), height * 3 // 2, width)
+    )
+    for frame, plane in zip(frames, planes):
+        cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420, dst=plane)
+
+
+def _convert_from_yuv420(
+    buffer: mmap.mmap, width: int, height: int
+) -> list[np.ndarray]:
     # this is following BT. 601 Limited Range.
     # Ref: https://docs.opencv.org/4.x/de/d25/imgproc_color_conversions.html#color_convert_rgb_yuv_42x
-    yuv = np.frombuffer(data, dtype=np.uint8).reshape((height * 3 // 2, width))
-    return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+    planes = np.frombuffer(buffer, dtype=np.uint8).reshape((-1, height * 3 // 2, width))
+    return [cv2.cvtColor(plane, cv2.COLOR_YUV2BGR_I420) for plane in planes]
 
 
 # Decode a video file to a specified output format such as YUV
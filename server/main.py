@@ -9,6 +9,9 @@ import uvicorn
 from app.routers import pipeline, video, modules, frame, binaries
 from app.db.convert_json_to_modules import get_all_mock_modules
 from app.services.binaries import download_gist_files
+from app.services.frame_store import shutdown_frame_store
+from app.services.frame_stream import frame_executor
+from app.services.jobs import pipeline_jobs
 
 
 api = APIRouter(prefix="/api")
@@ -29,6 +32,11 @@ async def lifespan(app: FastAPI):
 
     yield  # Application is running
 
+    # Stop running pipeline jobs
+    pipeline_jobs.shutdown()
+    frame_executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_frame_store()
+
     # Cleanup
     try:
         # Clean up binaries directory
@@ -0,0 +1,470 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import cv2
+import numpy as np
+import pytest
+from app.modules.generic import (
+    binary_batch,
+    binary_module,
+    binary_plugin,
+    binary_pool,
+)
+from app.modules.generic.binary_batch import BatchSizer
+from app.modules.generic.binary_module import BinaryRunError, GenericBinaryModule
+from app.modules.generic.binary_plugin import PluginError
+from app.modules.generic.binary_resolver import BinaryCache
+from app.modules.generic.binary_worker import BinaryWorkerError
+from app.modules.module import ModuleBase
+from app.modules.utils.enums import BinaryMode
+from app.schemas.module import ModuleData
+from app.schemas.pipeline import PipelineModule
+from app.services.node_cache import get_node_keys
+
+BINARY_NAME = "offset"
+
+# Adds --y to the Y plane of every I420 frame, from the -i file to the -o file,
+# or from stdin to stdout ("-"), logging its pid for every process started.
+# --fail-after makes it exit after that many frames
+BINARY_SOURCE = """
+import argparse, os, sys
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument("-i")
+parser.add_argument("-o")
+parser.add_argument("-w", type=int)
+parser.add_argument("-h", type=int)
+parser.add_argument("--y", type=int)
+parser.add_argument("--fail-after", type=int, default=-1)
+parser.add_argument("--pids")
+args = parser.parse_args()
+with open(args.pids, "a") as f:
+    f.write(f"{os.getpid()}\\n")
+
+size = args.w * args.h * 3 // 2
+def process(data):
+    y = (bytes((b + args.y) % 256 for b in data[: args.w * args.h]))
+    return y + data[args.w * args.h :]
+
+if args.i != "-":
+    if args.fail_after == 0:
+        print("simulated failure", file=sys.stderr)
+        sys.exit(3)
+    with open(args.i, "rb") as src, open(args.o, "wb") as dst:
+        while data := src.read(size):
+            dst.write(process(data))
+    sys.exit(0)
+
+frames = 0
+while data := sys.stdin.buffer.read(size):
+    if frames == args.fail_after:
+        print("simulated failure", file=sys.stderr)
+        sys.exit(3)
+    sys.stdout.buffer.write(process(data))
+    sys.stdout.buffer.flush()
+    frames += 1
+"""
+
+WIDTH, HEIGHT = 16, 8
+
+
+def write_binary(binaries_dir: Path, mode: str) -> None:
+    exe_dir = binaries_dir / BINARY_NAME / f"{platform.system()}-{platform.machine()}"
+    exe_dir.mkdir(parents=True)
+    exe = exe_dir / BINARY_NAME
+    exe.write_text(f"#!{sys.executable}\n" + textwrap.dedent(BINARY_SOURCE))
+    config = {
+        "name": BINARY_NAME,
+        "mode": mode,
+        "parameters": [
+            {"name": "input", "flag": "-i", "type": "str"},
+            {"name": "output", "flag": "-o", "type": "str"},
+            {"name": "width", "flag": "-w", "type": "int", "required": True},
+            {"name": "height", "flag": "-h", "type": "int", "required": True},
+            {"name": "y", "flag": "--y", "type": "int", "required": True},
+            {"name": "fail_after", "flag": "--fail-after", "type": "int"},
+            {"name": "pids", "flag": "--pids", "type": "str"},
+        ],
+    }
+    (exe_dir / "config.json").write_text(json.dumps(config))
+
+
+def create_module(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, mode: str
+) -> GenericBinaryModule:
+    monkeypatch.setattr(binary_module, "BINARIES_DIR", tmp_path / mode)
+    monkeypatch.setattr(binary_batch, "_sizers", {})
+    write_binary(tmp_path / mode, mode)
+    return GenericBinaryModule(
+        id=mode,
+        type="processNode",
+        data=ModuleData(name=BINARY_NAME, module_class=BINARY_NAME),
+        executable_path=BINARY_NAME,
+    )
+
+
+def make_frames(count: int) -> list[np.ndarray]:
+    rng = np.random.default_rng(0)
+    return [
+        rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8) for _ in range(count)
+    ]
+
+
+# Tests that a stream mode binary processes every frame of a run in a single
+# process, with the same results as one process per frame
+def test_stream_mode_uses_one_process(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    frames = make_frames(5)
+    results: dict[str, list[np.ndarray]] = {}
+    processes: dict[str, int] = {}
+    for mode in ("file", "stream"):
+        module = create_module(tmp_path, monkeypatch, mode)
+        pids = tmp_path / f"{mode}.pids"
+        parameters = {"width": WIDTH, "height": HEIGHT, "y": 40, "pids": str(pids)}
+        # The stream process must get every frame in order
+        assert module.is_stateful(parameters) == (mode == "stream")
+        with module.open_session(parameters):
+            results[mode] = [module.process_frame(f, parameters) for f in frames]
+        processes[mode] = len(pids.read_text().split())
+
+    assert processes == {"file": len(frames), "stream": 1}
+    for file_result, stream_result in zip(results["file"], results["stream"]):
+        assert np.array_equal(file_result, stream_result)
+    assert not np.array_equal(results["stream"][0], frames[0])
+
+
+# Tests that a binary exiting mid-run fails the frame with its stderr, and
+# every frame after it
+def test_stream_mode_reports_failures(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    module = create_module(tmp_path, monkeypatch, "stream")
+    frames = make_frames(3)
+    parameters = {
+        "width": WIDTH,
+        "height": HEIGHT,
+        "y": 1,
+        "fail_after": 1,
+        "pids": str(tmp_path / "pids"),
+    }
+    with module.open_session(parameters):
+        module.process_frame(frames[0], parameters)
+        with pytest.raises(BinaryWorkerError, match="(?s)code 3.*simulated failure"):
+            module.process_frame(frames[1], parameters)
+        with pytest.raises(BinaryWorkerError):
+            module.process_frame(frames[2], parameters)
+
+
+# Tests that a failed run of a file mode binary raises its stderr
+def test_file_mode_reports_failures(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    module = create_module(tmp_path, monkeypatch, "file")
+    parameters = {
+        "width": WIDTH,
+        "height": HEIGHT,
+        "y": 1,
+        "fail_after": 0,
+        "pids": str(tmp_path / "pids"),
+    }
+    with module.open_session(parameters):
+        with pytest.raises(BinaryRunError, match="(?s)code 3.*simulated failure"):
+            module.process_frame(make_frames(1)[0], parameters)
+
+
+# Tests that a batch mode binary is run once per batch, with the same results
+# as one process per frame
+def test_batch_mode_runs_once_per_batch(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(binary_module, "BINARY_MAX_PROCESSES", 1)
+    frames = make_frames(6)
+    results: dict[str, list[np.ndarray]] = {}
+    processes: dict[str, int] = {}
+    for mode in ("file", "batch"):
+        module = create_module(tmp_path, monkeypatch, mode)
+        pids = tmp_path / f"{mode}.pids"
+        parameters = {"width": WIDTH, "height": HEIGHT, "y": 7, "pids": str(pids)}
+        with module.open_session(parameters):
+            assert module.get_batch_size(parameters) == (4 if mode == "batch" else 1)
+            results[mode] = module.process_batch(frames, parameters)
+        processes[mode] = len(pids.read_text().split())
+
+    # Batches of the first batch size, 4 frames
+    assert processes == {"file": len(frames), "batch": 2}
+    for file_result, batch_result in zip(results["file"], results["batch"]):
+        assert np.array_equal(file_result, batch_result)
+
+
+# Tests that batches grow until the startup is a small part of an invocation
+def test_batch_size_follows_startup_cost() -> None:
+    sizer = BatchSizer(initial_frames=4, max_frames=64, overhead=0.1)
+
+    # 10 ms startup, 10 ms per frame: 9 frames make the startup 10%
+    sizer.record(4, 0.05)
+    assert sizer.size == 8
+    sizer.record(8, 0.09)
+    assert sizer.startup == pytest.approx(0.01)
+    assert 9 <= sizer.size <= 10
+
+    # A slow startup is capped by the largest batch size
+    slow = BatchSizer(initial_frames=2, max_frames=64, overhead=0.1)
+    slow.record(2, 1.02)
+    slow.record(4, 1.04)
+    assert slow.size == 64
+
+
+# Tests that binary invocations run concurrently, up to the server's binary
+# slots, with their results in frame order
+def test_invocations_share_binary_slots(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(binary_module, "BINARY_MAX_PROCESSES", 3)
+    monkeypatch.setattr(binary_pool, "binary_slots", threading.BoundedSemaphore(2))
+    monkeypatch.setattr(binary_pool, "binary_executor", ThreadPoolExecutor(3))
+
+    running = peak = 0
+    lock = threading.Lock()
+    subprocess_run = subprocess.run
+
+    def counting_run(command: list[str], **kwargs: Any) -> Any:
+        nonlocal running, peak
+        if Path(command[0]).name != BINARY_NAME:
+            return subprocess_run(command, **kwargs)
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        try:
+            time.sleep(0.05)
+            return subprocess_run(command, **kwargs)
+        finally:
+            with lock:
+                running -= 1
+
+    monkeypatch.setattr(subprocess, "run", counting_run)
+    module = create_module(tmp_path, monkeypatch, "file")
+    frames = make_frames(6)
+    parameters = {"width": WIDTH, "height": HEIGHT, "y": 3, "pids": str(tmp_path / "p")}
+    with module.open_session(parameters):
+        assert module.get_batch_size(parameters) == 3
+        results = module.process_batch(frames, parameters)
+        expected = [module.process_frame(frame, parameters) for frame in frames]
+
+    assert peak == 2
+    for result, expected_result in zip(results, expected):
+        assert np.array_equal(result, expected_result)
+
+
+# Tests that frames go to binaries through files of the transport directory,
+# which are removed after every invocation
+def test_frames_pass_through_transport_dir(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    transport_dir = tmp_path / "shm"
+    transport_dir.mkdir()
+    monkeypatch.setattr(binary_module, "BINARY_TRANSPORT_DIR", str(transport_dir))
+    seen: list[str] = []
+    subprocess_run = subprocess.run
+
+    def listing_run(command: list[str], **kwargs: Any) -> Any:
+        if Path(command[0]).name == BINARY_NAME:
+            seen.extend(str(path) for path in transport_dir.rglob("*.yuv"))
+        return subprocess_run(command, **kwargs)
+
+    monkeypatch.setattr(subprocess, "run", listing_run)
+    frame = make_frames(1)[0]
+    expected = cv2.cvtColor(
+        cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420), cv2.COLOR_YUV2BGR_I420
+    )
+    for mode in ("file", "batch"):
+        module = create_module(tmp_path, monkeypatch, mode)
+        parameters = {
+            "width": WIDTH,
+            "height": HEIGHT,
+            "y": 0,
+            "pids": str(tmp_path / "p"),
+        }
+        with module.open_session(parameters):
+            [result] = module.process_batch([frame], parameters)
+        # The binary leaves the frame as it is
+        assert np.array_equal(result, expected)
+
+    assert len(seen) == 2
+    assert not any(transport_dir.iterdir())
+
+
+# Tests that binaries are resolved once, and again only when their executable
+# or config changes
+def test_binary_resolution_is_cached(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(binary_module, "binary_cache", BinaryCache())
+    module = create_module(tmp_path, monkeypatch, "file")
+    module.preload_binary()
+    binary = module.get_binary()
+    assert os.access(binary.exe, os.X_OK)
+    assert module.get_binary() is binary
+
+    config_path = binary.exe.parent / "config.json"
+    config = json.loads(config_path.read_text())
+    config["mode"] = "batch"
+    config_path.write_text(json.dumps(config))
+    changed = module.get_binary()
+    assert changed is not binary
+    assert changed.mode == BinaryMode.BATCH
+    assert changed.build_command({"width": 2, "height": 2, "y": 1}, "in", "out") == [
+        str(binary.exe),
+        "-i",
+        "in",
+        "-o",
+        "out",
+        "-w",
+        "2",
+        "-h",
+        "2",
+        "--y",
+        "1",
+    ]
+
+
+# Adds the "y" parameter to every byte of the frame; fails with status 7 when
+# "fail" is set
+PLUGIN_SOURCE = """
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+int32_t mmrp_abi_version(void) { return 1; }
+
+int32_t mmrp_process_frame(
+    const uint8_t *input, uint8_t *output,
+    int32_t width, int32_t height, int32_t stride,
+    const char *const *names, const char *const *values, int32_t count) {
+    int offset = 0;
+    for (int32_t i = 0; i < count; i++) {
+        if (strcmp(names[i], "y") == 0) offset = atoi(values[i]);
+        if (strcmp(names[i], "fail") == 0 && strcmp(values[i], "1") == 0) return 7;
+    }
+    for (int32_t row = 0; row < height; row++)
+        for (int32_t i = 0; i < width * 3; i++)
+            output[row * stride + i] = (uint8_t)(input[row * stride + i] + offset);
+    return 0;
+}
+"""
+
+
+def create_plugin_module(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> GenericBinaryModule:
+    compiler = shutil.which("cc") or shutil.which("gcc")
+    if compiler is None or platform.system() != "Linux":
+        pytest.skip("Building the test plugin needs a C compiler on Linux")
+    module = create_module(tmp_path, monkeypatch, "plugin")
+    exe_dir = (
+        tmp_path / "plugin" / BINARY_NAME / f"{platform.system()}-{platform.machine()}"
+    )
+    source = tmp_path / "plugin.c"
+    source.write_text(PLUGIN_SOURCE)
+    subprocess.run(
+        [
+            compiler,
+            "-shared",
+            "-fPIC",
+            "-o",
+            str(exe_dir / "liboffset.so"),
+            str(source),
+        ],
+        check=True,
+    )
+    config = json.loads((exe_dir / "config.json").read_text())
+    config["parameters"].append({"name": "fail", "flag": "--fail", "type": "bool"})
+    (exe_dir / "config.json").write_text(json.dumps(config))
+    return module
+
+
+# Tests that plugin mode modules call their library on the frames, without
+# starting a process
+def test_plugin_mode_runs_in_process(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    module = create_plugin_module(tmp_path, monkeypatch)
+    frames = make_frames(4)
+    frames.append(frames[0][:, ::2])  # a view whose pixels are not contiguous
+    pids = tmp_path / "pids"
+    parameters = {"width": WIDTH, "height": HEIGHT, "y": 5, "pids": str(pids)}
+    with module.open_session(parameters):
+        results = module.process_batch(frames, parameters)
+        with pytest.raises(PluginError, match="status 7"):
+            module.process_frame(frames[0], {**parameters, "fail": True})
+
+    assert not pids.exists()
+    for frame, result in zip(frames, results):
+        assert np.array_equal(result, frame + np.uint8(5))
+
+
+# Tests that a replaced library is loaded from a copy, and that the copy of the
+# version it replaces is removed
+def test_plugin_reload_replaces_copy(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(binary_plugin, "_loaded", {})
+    monkeypatch.setattr(binary_plugin, "_copies_dir", None)
+    library = tmp_path / "liboffset.so"
+    library.write_bytes(b"v1")
+
+    def replace(data: bytes) -> None:
+        mtime = library.stat().st_mtime_ns + 1_000_000_000
+        library.write_bytes(data)
+        os.utime(library, ns=(mtime, mtime))
+
+    assert binary_plugin.load_path(library) == library
+    replace(b"v2")
+    first_copy = binary_plugin.load_path(library)
+    assert first_copy != library and first_copy.read_bytes() == b"v2"
+    assert binary_plugin.load_path(library) == first_copy
+
+    replace(b"v3")
+    second_copy = binary_plugin.load_path(library)
+    assert second_copy.read_bytes() == b"v3"
+    assert not first_copy.exists()
+    assert list(second_copy.parent.iterdir()) == [second_copy]
+
+
+# Tests that the cache keys of a binary's outputs change when its config or
+# executable is replaced
+def test_node_keys_follow_binary_files(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(binary_module, "binary_cache", BinaryCache())
+    module = create_module(tmp_path, monkeypatch, "file")
+    nodes = [
+        PipelineModule(
+            id="binary",
+            name="binary",
+            module_class=BINARY_NAME,
+            source=[],
+            parameters=[],
+        )
+    ]
+    module_map: dict[str, tuple[ModuleBase, dict[str, Any]]] = {
+        "binary": (module, {"y": 1})
+    }
+
+    def get_key() -> str:
+        return get_node_keys(nodes, module_map, {"path": "video.mp4"})["binary"]
+
+    first = get_key()
+    assert get_key() == first
+
+    exe = module.get_binary().exe
+    exe.write_text(exe.read_text() + "\n# rebuilt\n")
+    assert get_key() != first
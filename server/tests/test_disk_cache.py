@@ -0,0 +1,60 @@
+from pathlib import Path
+from app.utils.disk_cache import DiskLRUCache
+
+
+# Tests that entries round-trip through the cache
+def test_put_and_get(tmp_path: Path) -> None:
+    cache = DiskLRUCache(tmp_path, max_bytes=1024)
+
+    cache.put("abc", b"value")
+
+    assert cache.get("abc") == b"value"
+    assert cache.get("missing") is None
+
+
+# Tests that the least recently used entries are evicted first
+def test_evicts_least_recently_used(tmp_path: Path) -> None:
+    cache = DiskLRUCache(tmp_path, max_bytes=10)
+    cache.put("aa", b"1234")
+    cache.put("bb", b"1234")
+    cache.get("aa")
+
+    cache.put("cc", b"1234")
+
+    assert cache.get("aa") == b"1234"
+    assert cache.get("bb") is None
+    assert cache.get("cc") == b"1234"
+
+
+# Tests that existing entries are picked up and bounded by a new instance
+def test_reloads_existing_entries(tmp_path: Path) -> None:
+    DiskLRUCache(tmp_path, max_bytes=100).put("aa", b"12345678")
+
+    cache = DiskLRUCache(tmp_path, max_bytes=4)
+    cache.put("bb", b"1234")
+
+    assert cache.get("aa") is None
+    assert cache.get("bb") == b"1234"
+
+
+# Tests that a zero size disables the cache
+def test_disabled_cache(tmp_path: Path) -> None:
+    cache = DiskLRUCache(tmp_path, max_bytes=0)
+
+    cache.put("aa", b"1")
+
+    assert not cache.enabled
+    assert cache.get("aa") is None
+
+
+# Tests that a disabled cache neither serves nor removes the existing entries
+def test_disable_keeps_entries(tmp_path: Path) -> None:
+    DiskLRUCache(tmp_path, max_bytes=100).put("aa", b"1234")
+
+    cache = DiskLRUCache(tmp_path, max_bytes=100)
+    cache.disable()
+    cache.put("bb", b"1234")
+
+    assert cache.get("aa") is None
+    assert DiskLRUCache(tmp_path, max_bytes=100).get("aa") == b"1234"
+    assert DiskLRUCache(tmp_path, max_bytes=100).get("bb") is None
@@ -0,0 +1,108 @@
+from pathlib import Path
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+from app.utils.file_response import (
+    MAX_RANGES,
+    RangeFileResponse,
+    parse_range_header,
+)
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def client(tmp_path: Path) -> TestClient:
+    path = tmp_path / "video.mp4"
+    path.write_bytes(CONTENT)
+    app = FastAPI()
+
+    @app.api_route("/video", methods=["GET", "POST", "HEAD"])
+    def video() -> RangeFileResponse:
+        return RangeFileResponse(path, media_type="video/mp4")
+
+    return TestClient(app)
+
+
+# Tests that range headers are validated, sorted and merged
+def test_parses_range_headers() -> None:
+    size = 1000
+    assert parse_range_header("bytes=0-99", size) == [(0, 100)]
+    assert parse_range_header("bytes=900-", size) == [(900, 1000)]
+    assert parse_range_header("bytes=-100", size) == [(900, 1000)]
+    assert parse_range_header("bytes=990-2000", size) == [(990, 1000)]
+    assert parse_range_header("bytes=500-599, 0-9, 5-20, 21-30", size) == [
+        (0, 31),
+        (500, 600),
+    ]
+    assert parse_range_header("bytes=1000-, -0", size) == []
+    for malformed in (
+        "items=0-1",
+        "bytes=",
+        "bytes=5-1",
+        "bytes=a-b",
+        "bytes=1",
+        "bytes=²-",
+        "bytes=٠-٩",
+    ):
+        assert parse_range_header(malformed, size) is None
+    many = ",".join(f"{i * 10}-{i * 10}" for i in range(MAX_RANGES + 1))
+    assert parse_range_header(f"bytes={many}", size) is None
+
+
+# Tests full, single range and multipart responses
+def test_serves_ranges(client: TestClient) -> None:
+    full = client.get("/video")
+    assert full.status_code == 200
+    assert full.content == CONTENT
+    assert full.headers["accept-ranges"] == "bytes"
+
+    single = client.post("/video", headers={"Range": "bytes=100-199"})
+    assert single.status_code == 206
+    assert single.content == CONTENT[100:200]
+    assert single.headers["content-range"] == f"bytes 100-199/{len(CONTENT)}"
+
+    multi = client.get("/video", headers={"Range": "bytes=0-9,-10"})
+    assert multi.status_code == 206
+    content_type = multi.headers["content-type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("boundary=")[1].encode()
+    assert int(multi.headers["content-length"]) == len(multi.content)
+    parts = multi.content.split(b"--" + boundary)
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    assert parts[1].endswith(b"\r\n\r\n" + CONTENT[:10] + b"\r\n")
+    assert f"bytes {len(CONTENT) - 10}-{len(CONTENT) - 1}".encode() in parts[2]
+    assert parts[2].endswith(b"\r\n\r\n" + CONTENT[-10:] + b"\r\n")
+
+    unsatisfiable = client.get("/video", headers={"Range": f"bytes={len(CONTENT)}-"})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+    # Headers are decoded as Latin-1, which has superscript digits
+    superscript = client.get("/video", headers={"Range": "bytes=²-".encode("latin-1")})
+    assert superscript.status_code == 200
+    assert superscript.content == CONTENT
+
+    head = client.head("/video", headers={"Range": "bytes=0-9"})
+    assert head.status_code == 206 and head.content == b""
+
+
+# Tests conditional requests against the ETag and Last-Modified date
+def test_conditional_requests(client: TestClient) -> None:
+    first = client.get("/video")
+    etag, last_modified = first.headers["etag"], first.headers["last-modified"]
+
+    assert client.get("/video", headers={"If-None-Match": etag}).status_code == 304
+    assert client.post("/video", headers={"If-None-Match": etag}).status_code == 412
+    not_modified = client.get("/video", headers={"If-Modified-Since": last_modified})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == etag
+    assert client.get("/video", headers={"If-Match": '"other"'}).status_code == 412
+    changed = client.get("/video", headers={"If-None-Match": '"other"'})
+    assert changed.status_code == 200 and changed.content == CONTENT
+
+    # A Range with an outdated If-Range gets the whole file
+    headers = {"Range": "bytes=0-9", "If-Range": '"other"'}
+    assert client.get("/video", headers=headers).status_code == 200
+    headers["If-Range"] = etag
+    assert client.get("/video", headers=headers).content == CONTENT[:10]
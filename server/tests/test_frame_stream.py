@@ -0,0 +1,443 @@
+from pathlib import Path
+from typing import Any
+import asyncio
+import threading
+import time
+import cv2
+import numpy as np
+import pytest
+from app.schemas.metrics import Metrics
+from app.services import frame_hub, frame_store, frame_stream
+from app.services.frame_hub import (
+    FrameStreamHub,
+    FrameSubscription,
+    SlowConsumerError,
+)
+from app.services.frame_store import encode_frame, get_video_identity
+from app.services.frame_stream import (
+    QUALITY_RECOVERY_FRAMES,
+    STREAM_QUALITIES,
+    FrameStream,
+    QualityController,
+    StreamFrame,
+    StreamSettings,
+)
+from app.services.video_index import VideoIndex
+from app.utils.disk_cache import DiskLRUCache
+from app.utils.enums import SlowConsumerPolicy
+from app.utils.quality_metrics import compute_metrics
+
+FRAME_COUNT = 10
+WIDTH, HEIGHT = 64, 48
+
+
+# Writes a small synthetic video whose frames depend on the seed
+def write_video(path: Path, seed: int) -> None:
+    writer = cv2.VideoWriter(
+        str(path), getattr(cv2, "VideoWriter_fourcc")(*"mp4v"), 10.0, (WIDTH, HEIGHT)
+    )
+    for i in range(FRAME_COUNT):
+        frame = np.full((HEIGHT, WIDTH, 3), (i + seed) * 10, dtype=np.uint8)
+        cv2.circle(frame, (i * 5, HEIGHT // 2), 8, (255, 255, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def read_all(path: Path) -> list[np.ndarray]:
+    cap = cv2.VideoCapture(str(path))
+    frames: list[np.ndarray] = []
+    while (frame := cap.read())[0]:
+        frames.append(frame[1])
+    cap.release()
+    return frames
+
+
+@pytest.fixture
+def video_paths(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> list[Path]:
+    monkeypatch.setattr(
+        frame_store, "frame_store", DiskLRUCache(tmp_path / "frames", 64 * 1024**2)
+    )
+    paths = [tmp_path / "a.mp4", tmp_path / "b.mp4"]
+    for seed, path in enumerate(paths):
+        write_video(path, seed)
+    return paths
+
+
+async def stream_frames(
+    paths: list[Path],
+    limit: int | None = None,
+    metrics: list[Metrics] | None = None,
+    settings: StreamSettings = StreamSettings(),
+    start: int = 0,
+) -> list[StreamFrame]:
+    caps = [cv2.VideoCapture(str(path)) for path in paths]
+    identities = [get_video_identity(path, output=False) for path in paths]
+    frames: list[StreamFrame] = []
+    try:
+        async with FrameStream(
+            caps,
+            identities,
+            10.0,
+            metrics,
+            settings,
+            prefetch=2,
+            start=start,
+            video_paths=paths,
+        ) as stream:
+            async for frame in stream.frames():
+                frames.append(frame)
+                if len(frames) == limit:
+                    break
+    finally:
+        for cap in caps:
+            cap.release()
+    return frames
+
+
+# Tests that every frame is sent in order, encoded and scored
+def test_streams_all_frames_in_order(video_paths: list[Path]) -> None:
+    expected = [read_all(path) for path in video_paths]
+
+    frames = asyncio.run(stream_frames(video_paths))
+
+    assert len(frames) == FRAME_COUNT
+    for i, frame in enumerate(frames):
+        assert frame.buffers == [
+            encode_frame(expected[0][i])[0],
+            encode_frame(expected[1][i])[0],
+        ]
+        assert frame.metadata.mime == "image/webp"
+        assert frame.metadata.fps == 10.0
+        assert frame.metadata.metrics == compute_metrics(expected[0][i], expected[1][i])
+
+
+# Tests that a replay sends the stored frames without encoding them again
+def test_replay_uses_stored_frames(
+    video_paths: list[Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    first = asyncio.run(stream_frames(video_paths))
+
+    def failing_encode_frame(frame: np.ndarray) -> None:
+        raise AssertionError("Stored frames must not be encoded again")
+
+    monkeypatch.setattr(frame_store, "encode_frame", failing_encode_frame)
+    replay = asyncio.run(stream_frames(video_paths))
+
+    assert replay == first
+
+
+# Tests that with the pipeline's metrics, stored frames are neither decoded nor
+# scored again, and frames missing from the store are decoded at their index
+def test_pipeline_metrics_skip_decoding(
+    video_paths: list[Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    metrics = [
+        Metrics(message=None, psnr=float(i), ssim=None) for i in range(FRAME_COUNT)
+    ]
+    first = asyncio.run(stream_frames(video_paths, metrics=metrics))
+    identities = [get_video_identity(path, output=False) for path in video_paths]
+    for index in (3, 8):
+        key = frame_store.get_frame_key(identities[1], index)
+        frame_store.frame_store._path(key).unlink()
+
+    reads: list[int | None] = []
+    read_frames = frame_stream.read_frames
+
+    def counting_read_frames(
+        caps: list[cv2.VideoCapture],
+        frame_index: int | None = None,
+        indexes: list[VideoIndex] | None = None,
+    ) -> list[np.ndarray] | None:
+        reads.append(frame_index)
+        return read_frames(caps, frame_index, indexes)
+
+    def failing_compute_metrics(*args: object) -> None:
+        raise AssertionError("Pipeline metrics must not be computed again")
+
+    monkeypatch.setattr(frame_stream, "read_frames", counting_read_frames)
+    monkeypatch.setattr(frame_stream, "compute_bgr_metrics", failing_compute_metrics)
+    replay = asyncio.run(stream_frames(video_paths, metrics=metrics))
+
+    assert [frame.metadata.metrics for frame in first] == metrics
+    assert replay == first
+    assert reads == [3, 8]
+
+
+# Tests that the videos are only indexed once the stream has to seek, which
+# playback from the first frame does not
+def test_indexes_videos_on_first_seek(
+    video_paths: list[Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    indexed: list[list[Path]] = []
+    get_video_indexes = frame_stream.get_video_indexes
+
+    def counting_get_video_indexes(paths: list[Path]) -> list[VideoIndex]:
+        indexed.append(paths)
+        return get_video_indexes(paths)
+
+    monkeypatch.setattr(frame_stream, "get_video_indexes", counting_get_video_indexes)
+    expected = read_all(video_paths[0])
+
+    assert len(asyncio.run(stream_frames(video_paths))) == FRAME_COUNT
+    assert indexed == []
+
+    frames = asyncio.run(stream_frames(video_paths, start=6))
+    assert [frame.metadata.index for frame in frames] == list(range(6, FRAME_COUNT))
+    assert frames[0].buffers[0] == encode_frame(expected[6])[0]
+    assert indexed == [video_paths]
+
+
+# Tests that output videos beyond the fill backlog are left for playback to
+# store
+def test_frame_store_fill_backlog(
+    video_paths: list[Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(frame_store, "FRAME_STORE_FILL_ON_RUN", True)
+    monkeypatch.setattr(frame_store, "_fill_backlog", threading.BoundedSemaphore(1))
+    stored: list[Path] = []
+    monkeypatch.setattr(frame_store, "store_video_frames", stored.append)
+    release = threading.Event()
+    blocker = frame_store._fill_executor.submit(release.wait, 5)
+
+    for path in video_paths:
+        frame_store.fill_frame_store(path)
+    release.set()
+    blocker.result()
+    frame_store._fill_executor.submit(lambda: None).result()
+
+    assert stored == video_paths[:1]
+    frame_store.fill_frame_store(video_paths[1])
+    frame_store._fill_executor.submit(lambda: None).result()
+    assert stored == video_paths
+
+
+# Tests that frames are downscaled to fit the viewport, keeping their aspect
+def test_downscales_to_viewport(video_paths: list[Path]) -> None:
+    frames = asyncio.run(
+        stream_frames(video_paths, settings=StreamSettings(viewport=(32, 32)))
+    )
+
+    image = cv2.imdecode(np.frombuffer(frames[0].buffers[0], np.uint8), 1)
+    assert image.shape[:2] == (24, 32)
+
+
+# Tests that frames too far behind real time are dropped, not sent late
+def test_drops_late_frames(
+    video_paths: list[Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    encode_frame = frame_store.encode_frame
+
+    def slow_encode_frame(*args: Any) -> tuple[bytes, str] | None:
+        time.sleep(0.3)
+        return encode_frame(*args)
+
+    monkeypatch.setattr(frame_store, "encode_frame", slow_encode_frame)
+    frames = asyncio.run(
+        stream_frames(video_paths, settings=StreamSettings(max_latency=0.2))
+    )
+
+    indices = [frame.metadata.index for frame in frames]
+    assert indices[0] == 0 and indices == sorted(indices)
+    assert len(indices) < FRAME_COUNT
+
+
+# Tests that the quality drops under backpressure or over the bitrate target,
+# and recovers once frames are sent comfortably again
+def test_quality_follows_backpressure() -> None:
+    controller = QualityController(fps=10.0, max_bitrate=None, settle_frames=2)
+
+    controller.update(1000, 0.5)
+    assert controller.quality == STREAM_QUALITIES[1]
+    # Frames encoded before the step are ignored
+    controller.update(1000, 0.5)
+    controller.update(1000, 0.5)
+    assert controller.quality == STREAM_QUALITIES[1]
+    for _ in range(QUALITY_RECOVERY_FRAMES):
+        controller.update(1000, 0.01)
+    assert controller.quality == STREAM_QUALITIES[0]
+
+    limited = QualityController(fps=10.0, max_bitrate=80_000, settle_frames=0)
+    limited.update(2000, 0.01)
+    assert limited.quality == STREAM_QUALITIES[1]
+
+
+# Tests that a stream left early stops prefetching without errors
+def test_stops_when_left_early(video_paths: list[Path]) -> None:
+    frames = asyncio.run(stream_frames(video_paths, limit=2))
+
+    assert len(frames) == 2
+
+
+# Tests that worker errors reach the socket loop
+def test_raises_worker_errors(video_paths: list[Path]) -> None:
+    with pytest.raises(IndexError):
+        asyncio.run(stream_frames(video_paths[:1]))
+
+
+# Counts the streams created by the hub
+@pytest.fixture
+def stream_count(monkeypatch: pytest.MonkeyPatch) -> list[int]:
+    count = [0]
+
+    class CountingFrameStream(FrameStream):
+        def __init__(self, *args: Any, **kwargs: Any) -> None:
+            count[0] += 1
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(frame_hub, "FrameStream", CountingFrameStream)
+    return count
+
+
+def identities_of(paths: list[Path]) -> list[str]:
+    return [get_video_identity(path, output=False) for path in paths]
+
+
+async def receive_all(subscription: FrameSubscription, delay: float = 0) -> list[int]:
+    indices: list[int] = []
+    async for frame in subscription.frames():
+        indices.append(frame.metadata.index)
+        await asyncio.sleep(delay)
+    return indices
+
+
+# Tests that simultaneous viewers of the same videos share one stream and
+# each receive every frame
+def test_hub_shares_stream(video_paths: list[Path], stream_count: list[int]) -> None:
+    hub = FrameStreamHub(buffer_size=4, policy=SlowConsumerPolicy.WAIT)
+    identities = identities_of(video_paths)
+
+    async def watch() -> list[int]:
+        async with hub.subscribe(video_paths, identities) as subscription:
+            return await receive_all(subscription)
+
+    async def watch_together() -> list[list[int]]:
+        return list(await asyncio.gather(watch(), watch(), watch()))
+
+    received = asyncio.run(watch_together())
+
+    assert received == [list(range(FRAME_COUNT))] * 3
+    assert stream_count == [1]
+    assert hub.broadcast_count == 0
+
+
+# Tests that other settings, or joining after the start has been dropped, get
+# their own stream
+def test_hub_starts_new_streams(
+    video_paths: list[Path], stream_count: list[int]
+) -> None:
+    hub = FrameStreamHub(buffer_size=2, policy=SlowConsumerPolicy.DROP_OLDEST)
+    identities = identities_of(video_paths)
+
+    async def watch_late() -> tuple[list[int], list[int], list[int]]:
+        async with hub.subscribe(video_paths, identities) as first:
+            other_settings = hub.subscribe(
+                video_paths, identities, StreamSettings(viewport=(32, 32))
+            )
+            async with other_settings as second:
+                frames = first.frames()
+                early = [(await anext(frames)).metadata.index for _ in range(5)]
+                async with hub.subscribe(video_paths, identities) as late:
+                    return (
+                        early + await receive_all(first),
+                        await receive_all(second),
+                        await receive_all(late),
+                    )
+
+    first, second, late = asyncio.run(watch_late())
+
+    assert first == list(range(FRAME_COUNT))
+    assert second == list(range(FRAME_COUNT))
+    assert late == list(range(FRAME_COUNT))
+    assert stream_count == [3]
+
+
+# Tests the slow consumer policies: a viewer that does not keep up loses its
+# oldest frames, or is disconnected
+@pytest.mark.parametrize(
+    "policy", [SlowConsumerPolicy.DROP_OLDEST, SlowConsumerPolicy.DISCONNECT]
+)
+def test_hub_slow_consumer_policy(
+    video_paths: list[Path], policy: SlowConsumerPolicy
+) -> None:
+    hub = FrameStreamHub(buffer_size=2, policy=policy)
+    identities = identities_of(video_paths)
+
+    async def watch(delay: float) -> list[int] | BaseException:
+        try:
+            async with hub.subscribe(video_paths, identities) as subscription:
+                return await receive_all(subscription, delay)
+        except SlowConsumerError as e:
+            return e
+
+    async def watch_together() -> list[list[int] | BaseException]:
+        return list(await asyncio.gather(watch(0), watch(0.05)))
+
+    fast, slow = asyncio.run(watch_together())
+
+    assert fast == list(range(FRAME_COUNT))
+    if policy == SlowConsumerPolicy.DISCONNECT:
+        assert isinstance(slow, SlowConsumerError)
+    else:
+        assert isinstance(slow, list)
+        assert slow[-1] == FRAME_COUNT - 1 and len(slow) < FRAME_COUNT
+
+
+# Tests that the send times of a shared stream's viewers are accounted once
+# per frame, from the fastest viewer, so a slow viewer does not lower the
+# quality of the others
+def test_hub_quality_follows_fastest_viewer(
+    video_paths: list[Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    accounted: list[tuple[int, float]] = []
+
+    class RecordingFrameStream(FrameStream):
+        def sent(self, frame: StreamFrame, seconds: float) -> None:
+            accounted.append((frame.metadata.index, seconds))
+            super().sent(frame, seconds)
+
+    monkeypatch.setattr(frame_hub, "FrameStream", RecordingFrameStream)
+    hub = FrameStreamHub(buffer_size=4, policy=SlowConsumerPolicy.WAIT)
+    identities = identities_of(video_paths)
+    settings = StreamSettings(max_bitrate=1e12)
+
+    async def watch(seconds: float) -> int:
+        async with hub.subscribe(video_paths, identities, settings) as subscription:
+            async for frame in subscription.frames():
+                await asyncio.sleep(seconds / 10)
+                subscription.sent(frame, seconds)
+            stream = subscription.broadcast.stream
+            assert stream is not None and stream.quality is not None
+            return stream.quality.quality
+
+    async def watch_together() -> list[int]:
+        return list(await asyncio.gather(watch(0.001), watch(1.0)))
+
+    qualities = asyncio.run(watch_together())
+
+    assert accounted == [(index, 0.001) for index in range(FRAME_COUNT)]
+    assert qualities == [STREAM_QUALITIES[0]] * 2
+
+
+# Tests that seeking continues the viewer's frames from the new frame, without
+# the frames buffered before the seek
+def test_subscription_seeks(video_paths: list[Path], stream_count: list[int]) -> None:
+    hub = FrameStreamHub(buffer_size=2, policy=SlowConsumerPolicy.WAIT)
+    identities = identities_of(video_paths)
+    expected = read_all(video_paths[0])
+
+    async def watch_and_seek() -> list[StreamFrame]:
+        async with hub.subscribe(video_paths, identities) as subscription:
+            received: list[StreamFrame] = []
+            async for frame in subscription.frames():
+                received.append(frame)
+                if frame.metadata.index == 2:
+                    await subscription.seek(7)
+            return received
+
+    received = asyncio.run(watch_and_seek())
+
+    assert [frame.metadata.index for frame in received] == [0, 1, 2, 7, 8, 9]
+    for frame in received:
+        assert frame.buffers[0] == encode_frame(expected[frame.metadata.index])[0]
+    assert stream_count == [2]
+    assert hub.broadcast_count == 0
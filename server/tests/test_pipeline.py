@@ -0,0 +1,609 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+import shutil
+import threading
+import cv2
+import numpy as np
+import pytest
+from app.db.convert_json_to_modules import get_all_mock_modules
+from app.modules.outputs.video_output import VideoOutput
+from app.schemas.pipeline import PipelineParameter, PipelineRequest
+from app.modules.transforms.color import ColorModule
+from app.modules.transforms.blur import BlurModule
+from app.services import frame_store, pipeline
+from app.services.frame_store import get_stored_frame, get_video_identity
+from app.services.jobs import PipelineJobManager
+from app.services.metrics_sidecar import find_pipeline_metrics
+from app.services.pipeline import (
+    build_pipeline_plan,
+    get_execution_levels,
+    handle_pipeline_request,
+    get_segment_starts,
+    run_pipeline_plan,
+    run_pipeline_segment,
+    run_pipeline_segmented,
+    run_pipeline_staged,
+    run_pipeline_streaming,
+)
+from app.services.result_cache import PipelineResultCache
+from app.services.scheduler import PipelineScheduler
+from app.services.video_index import VideoIndex, video_indexes
+from app.utils.disk_cache import DiskLRUCache
+from app.utils.enums import JobState, MetricsSampling, VideoFormats
+
+FRAME_COUNT = 12
+WIDTH, HEIGHT = 64, 48
+
+
+# Builds the parameter list of a pipeline module
+def params(**kwargs: Any) -> list[dict[str, Any]]:
+    return [{"key": key, "value": value} for key, value in kwargs.items()]
+
+
+# Simple pipeline: source -> blur -> result, optionally with a second branch
+def pipeline_request(two_results: bool = False) -> PipelineRequest:
+    modules: list[dict[str, Any]] = [
+        {
+            "id": "src",
+            "name": "Video Source",
+            "module_class": "video_source",
+            "source": [],
+            "parameters": params(path="test.mp4"),
+        },
+        {
+            "id": "blur",
+            "name": "Blur",
+            "module_class": "blur",
+            "source": ["src"],
+            "parameters": params(kernel_size=5, method="gaussian"),
+        },
+        {
+            "id": "left",
+            "name": "Result",
+            "module_class": "video_output",
+            "source": ["blur"],
+            "parameters": params(video_player="left"),
+        },
+    ]
+    if two_results:
+        modules[2:2] = [
+            {
+                "id": "color",
+                "name": "Color",
+                "module_class": "color",
+                "source": ["src"],
+                "parameters": params(input_colorspace="RGB", output_colorspace="HSV"),
+            },
+            {
+                "id": "right",
+                "name": "Result",
+                "module_class": "video_output",
+                "source": ["color"],
+                "parameters": params(video_player="right"),
+            },
+        ]
+    return PipelineRequest.model_validate({"modules": modules})
+
+
+# Writes a small synthetic video and redirects input and output paths to tmp_path
+@pytest.fixture
+def video_env(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    video_path = tmp_path / "test.mp4"
+    writer = cv2.VideoWriter(
+        str(video_path),
+        getattr(cv2, "VideoWriter_fourcc")(*"mp4v"),
+        10.0,
+        (WIDTH, HEIGHT),
+    )
+    for i in range(FRAME_COUNT):
+        frame = np.full((HEIGHT, WIDTH, 3), i * 10, dtype=np.uint8)
+        cv2.circle(frame, (i * 4, HEIGHT // 2), 8, (255, 255, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+    def get_video_path(video: str) -> Path:
+        return tmp_path / video
+
+    def get_output_path(self: VideoOutput, parameters: dict[str, Any]) -> Path:
+        return tmp_path / "output" / parameters["path"]
+
+    monkeypatch.setattr(
+        "app.modules.inputs.video_source.get_video_path", get_video_path
+    )
+    monkeypatch.setattr("app.services.node_cache.get_video_path", get_video_path)
+    monkeypatch.setattr(VideoOutput, "get_output_path", get_output_path)
+    monkeypatch.setattr(
+        "app.services.pipeline.pipeline_result_cache", PipelineResultCache(8)
+    )
+    monkeypatch.setattr(
+        "app.services.node_cache.node_output_cache",
+        DiskLRUCache(tmp_path / "cache", 64 * 1024**2),
+    )
+    monkeypatch.setattr(
+        "app.services.frame_store.frame_store",
+        DiskLRUCache(tmp_path / "frames", 64 * 1024**2),
+    )
+    get_all_mock_modules()
+    return tmp_path
+
+
+# Tests that a single result is scored against the original frames
+def test_streaming_single_result(video_env: Path) -> None:
+    response = handle_pipeline_request(pipeline_request())
+
+    assert response.left.endswith(".webm")
+    assert response.right == ""
+    assert (video_env / "output" / response.left).exists()
+    assert len(response.metrics) == FRAME_COUNT
+    assert all(m.psnr is not None and m.ssim is not None for m in response.metrics)
+
+
+# Tests that the frames of the videos written by a run are stored for playback
+# when runs fill the store, which they do not by default
+def test_run_fills_frame_store(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    response = handle_pipeline_request(pipeline_request())
+    frame_store._fill_executor.submit(lambda: None).result()
+    identity = get_video_identity(video_env / "output" / response.left, output=True)
+    assert get_stored_frame(identity, 0) is None
+
+    monkeypatch.setattr(frame_store, "FRAME_STORE_FILL_ON_RUN", True)
+    # Another request, as the result of the first one is cached
+    request = pipeline_request()
+    request.modules[1].parameters[0].value = 7
+    response = handle_pipeline_request(request)
+    # The single fill thread fills one video after the other
+    frame_store._fill_executor.submit(lambda: None).result()
+
+    output_path = video_env / "output" / response.left
+    identity = get_video_identity(output_path, output=True)
+    stored = [get_stored_frame(identity, i) for i in range(FRAME_COUNT)]
+
+    # The frames are those of the encoded video, as playback decodes them
+    cap = cv2.VideoCapture(str(output_path))
+    for frame in stored:
+        ret, decoded = cap.read()
+        assert ret
+        encoded = frame_store.encode_frame(decoded)
+        assert frame is not None and encoded is not None
+        assert frame[0] == encoded[0]
+    cap.release()
+
+
+# Tests that a run's metrics are kept for playback of the compared videos
+def test_run_saves_metrics_sidecar(video_env: Path) -> None:
+    response = handle_pipeline_request(pipeline_request())
+
+    paths = [video_env / "test.mp4", video_env / "output" / response.left]
+    identities = [
+        get_video_identity(paths[0], output=False),
+        get_video_identity(paths[1], output=True),
+    ]
+    saved = find_pipeline_metrics(paths, identities)
+    assert saved is not None
+    assert [m.psnr for m in saved] == pytest.approx(
+        [m.psnr for m in response.metrics], rel=1e-6
+    )
+    assert find_pipeline_metrics(paths, identities[1:]) is None
+
+
+# Tests that two results are written and scored against each other
+def test_streaming_two_results(video_env: Path) -> None:
+    response = handle_pipeline_request(pipeline_request(two_results=True))
+
+    assert (video_env / "output" / response.left).exists()
+    assert (video_env / "output" / response.right).exists()
+    assert len(response.metrics) == FRAME_COUNT
+
+
+# Tests that invalid pipelines are rejected before any frame is decoded
+def test_plan_rejects_source_feeding_result(video_env: Path) -> None:
+    request = pipeline_request()
+    request.modules[2].source = ["src"]
+
+    with pytest.raises(ValueError, match="at least one processing node"):
+        build_pipeline_plan(request)
+
+
+# Tests that independent branches are grouped into the same level
+def test_execution_levels_group_branches(video_env: Path) -> None:
+    plan = build_pipeline_plan(pipeline_request(two_results=True))
+
+    levels = get_execution_levels(plan.processing_nodes)
+
+    assert [[mod.id for mod in level] for level in levels] == [["blur", "color"]]
+
+
+# Tests that the staged runner keeps frame order and matches the streaming runner
+def test_staged_matches_streaming(video_env: Path) -> None:
+    request = pipeline_request(two_results=True)
+
+    streamed = run_pipeline_streaming(build_pipeline_plan(request))
+    staged = run_pipeline_staged(build_pipeline_plan(request), workers=3)
+
+    assert staged.metrics == streamed.metrics
+    assert (video_env / "output" / staged.left).exists()
+    assert (video_env / "output" / staged.right).exists()
+
+
+# Tests that without the node cache, branches run in parallel on the branch
+# thread pool give the same results as running them one after the other
+def test_parallel_branches_match_sequential(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(
+        "app.services.node_cache.node_output_cache",
+        DiskLRUCache(video_env / "no-cache", 0),
+    )
+    calls: list[int] = []
+    process_frame_parallel = pipeline.process_pipeline_frame_parallel
+
+    def counting_process_frame_parallel(*args: Any, **kwargs: Any) -> None:
+        calls.append(1)
+        process_frame_parallel(*args, **kwargs)
+
+    monkeypatch.setattr(
+        pipeline, "process_pipeline_frame_parallel", counting_process_frame_parallel
+    )
+    request = pipeline_request(two_results=True)
+
+    monkeypatch.setattr(pipeline, "PIPELINE_BRANCH_WORKERS", 1)
+    sequential = run_pipeline_streaming(build_pipeline_plan(request))
+    assert not calls
+    monkeypatch.setattr(pipeline, "PIPELINE_BRANCH_WORKERS", 2)
+    parallel = run_pipeline_streaming(build_pipeline_plan(request))
+
+    assert len(calls) == FRAME_COUNT
+    assert parallel.metrics == sequential.metrics
+    assert all(m.psnr is not None for m in parallel.metrics)
+
+
+# Tests that both runners score only the sampled frames
+def test_runners_score_sampled_frames(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(
+        "app.services.pipeline.METRICS_SAMPLING", MetricsSampling.EVERY_NTH
+    )
+    monkeypatch.setattr("app.services.pipeline.METRICS_SAMPLE_INTERVAL", 4)
+    request = pipeline_request()
+
+    streamed = run_pipeline_streaming(build_pipeline_plan(request))
+    staged = run_pipeline_staged(build_pipeline_plan(request), workers=3)
+
+    scored = [i for i, m in enumerate(streamed.metrics) if m.psnr is not None]
+    assert scored == [0, 4, 8]
+    assert all(m.message is None for m in streamed.metrics)
+    assert staged.metrics == streamed.metrics
+
+
+# Tests that runs scoring in I420 fill the chroma plane metrics
+def test_runners_score_i420_planes(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    request = pipeline_request()
+    bgr = run_pipeline_streaming(build_pipeline_plan(request))
+    monkeypatch.setattr("app.services.pipeline.METRICS_FORMAT", VideoFormats.YUV_I420)
+
+    streamed = run_pipeline_streaming(build_pipeline_plan(request))
+    staged = run_pipeline_staged(build_pipeline_plan(request), workers=3)
+
+    assert all(m.psnr_u is None and m.psnr_v is None for m in bgr.metrics)
+    assert all(m.psnr_u is not None and m.psnr_v is not None for m in streamed.metrics)
+    assert staged.metrics == streamed.metrics
+
+
+# Tests that a failing module stops every stage and surfaces its error
+def test_staged_propagates_errors(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    calls: list[int] = []
+    blur_process_frame = BlurModule.process_frame
+
+    # Fails once some frames have been written
+    def broken_process_frame(
+        self: BlurModule, frame: np.ndarray, parameters: dict[str, Any]
+    ) -> np.ndarray:
+        calls.append(1)
+        if len(calls) > 6:
+            raise RuntimeError("module failed")
+        return blur_process_frame(self, frame, parameters)
+
+    monkeypatch.setattr(BlurModule, "process_frame", broken_process_frame)
+
+    with pytest.raises(RuntimeError, match="module failed"):
+        run_pipeline_staged(build_pipeline_plan(pipeline_request()), workers=2)
+    # The truncated output video is removed
+    assert not list((video_env / "output").glob("*.webm"))
+
+
+# Tests that modules asking for batches get consecutive frames together, with
+# the same results as frame by frame
+def test_streaming_runner_batches_frames(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    request = pipeline_request()
+    unbatched = run_pipeline_streaming(build_pipeline_plan(request))
+
+    batches: list[int] = []
+    blur_process_batch = BlurModule.process_batch
+
+    def recording_process_batch(
+        self: BlurModule, frames: list[np.ndarray], parameters: dict[str, Any]
+    ) -> list[np.ndarray]:
+        batches.append(len(frames))
+        return blur_process_batch(self, frames, parameters)
+
+    monkeypatch.setattr(BlurModule, "get_batch_size", lambda self, parameters: 5)
+    monkeypatch.setattr(BlurModule, "process_batch", recording_process_batch)
+    # Nothing cached from the first run
+    monkeypatch.setattr(
+        "app.services.node_cache.node_output_cache",
+        DiskLRUCache(video_env / "batch-cache", 64 * 1024**2),
+    )
+    batched = run_pipeline_streaming(build_pipeline_plan(request))
+
+    assert batches == [5, 5, 2]
+    assert batched.metrics == unbatched.metrics
+
+
+# Tests that a segment only covers its frame range and matches a full run
+def test_segment_covers_frame_range(video_env: Path) -> None:
+    request = pipeline_request()
+    full = handle_pipeline_request(request)
+    index = video_indexes.get(video_env / "test.mp4")
+
+    metrics = run_pipeline_segment(
+        request, 4, 8, {"left": "segment.webm"}, index.timestamps[4]
+    )
+
+    assert metrics == full.metrics[4:8]
+    assert (video_env / "output" / "segment.webm").exists()
+
+
+# Tests that a segment whose seek lands away from its first frame fails rather
+# than processing the wrong frames
+def test_segment_rejects_missed_seek(video_env: Path) -> None:
+    index = video_indexes.get(video_env / "test.mp4")
+
+    with pytest.raises(ValueError, match="landed at"):
+        run_pipeline_segment(
+            pipeline_request(), 4, 8, {"left": "segment.webm"}, index.timestamps[6]
+        )
+
+
+# Tests that segments start at the keyframes before evenly spaced frames, and
+# that videos with too few keyframes get fewer segments
+def test_segment_starts_at_keyframes() -> None:
+    index = VideoIndex([i * 100.0 for i in range(12)], [0, 5, 9], 10.0)
+
+    assert get_segment_starts(index, 3) == [0, 5]
+    assert get_segment_starts(index, 4) == [0, 5, 9]
+    assert get_segment_starts(VideoIndex(index.timestamps, [0], 10.0), 4) == [0]
+
+
+# Runs the segment workers on threads, which see the test's patches
+def thread_segment_pool(
+    max_workers: int,
+    mp_context: Any,
+    initializer: Callable[..., None],
+    initargs: tuple[Any, ...],
+) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers, initializer=initializer, initargs=initargs)
+
+
+# Tests that a run split in two segments gives the metrics of a single run and
+# one output video with all the frames
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_segmented_matches_streaming(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(pipeline, "ProcessPoolExecutor", thread_segment_pool)
+    request = pipeline_request()
+    streamed = run_pipeline_streaming(build_pipeline_plan(request))
+
+    index = video_indexes.get(video_env / "test.mp4")
+
+    segmented = run_pipeline_segmented(
+        request, build_pipeline_plan(request), 10.0, index, [0, 6]
+    )
+
+    assert segmented.metrics == streamed.metrics
+    cap = cv2.VideoCapture(str(video_env / "output" / segmented.left))
+    frame_count = 0
+    while cap.read()[0]:
+        frame_count += 1
+    cap.release()
+    assert frame_count == FRAME_COUNT
+    assert not list((video_env / "output").glob("*.part*"))
+
+
+# Tests that without ffmpeg a segmented run fails before processing any frame,
+# rather than encoding the segments again
+def test_segmented_needs_ffmpeg(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(pipeline, "ProcessPoolExecutor", thread_segment_pool)
+    monkeypatch.setattr(
+        "app.modules.outputs.video_output.shutil.which", lambda name: None
+    )
+    calls: list[int] = []
+    blur_process_frame = BlurModule.process_frame
+
+    def counting_process_frame(
+        self: BlurModule, frame: np.ndarray, parameters: dict[str, Any]
+    ) -> np.ndarray:
+        calls.append(1)
+        return blur_process_frame(self, frame, parameters)
+
+    monkeypatch.setattr(BlurModule, "process_frame", counting_process_frame)
+    request = pipeline_request()
+
+    index = video_indexes.get(video_env / "test.mp4")
+
+    with pytest.raises(RuntimeError, match="ffmpeg"):
+        run_pipeline_segmented(
+            request, build_pipeline_plan(request), 10.0, index, [0, 6]
+        )
+    assert not calls
+
+
+# Tests that a re-run after editing the last module reuses upstream outputs
+def test_node_cache_reruns_only_downstream_modules(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    calls: list[str] = []
+    color_process_frame = ColorModule.process_frame
+
+    def counting_process_frame(
+        self: ColorModule, frame: np.ndarray, parameters: dict[str, Any]
+    ) -> np.ndarray:
+        calls.append("color")
+        return color_process_frame(self, frame, parameters)
+
+    monkeypatch.setattr(ColorModule, "process_frame", counting_process_frame)
+
+    # source -> color -> blur -> result
+    request = pipeline_request()
+    request.modules.insert(
+        1,
+        request.modules[1].model_copy(
+            update={
+                "id": "color",
+                "module_class": "color",
+                "parameters": [
+                    PipelineParameter(key="input_colorspace", value="RGB"),
+                    PipelineParameter(key="output_colorspace", value="HSV"),
+                ],
+            }
+        ),
+    )
+    request.modules[2].source = ["color"]
+
+    first = handle_pipeline_request(request)
+    assert len(calls) == FRAME_COUNT
+
+    request.modules[2].parameters[0].value = 7
+    second = handle_pipeline_request(request)
+
+    assert len(calls) == FRAME_COUNT
+    assert len(second.metrics) == FRAME_COUNT
+    assert second.metrics != first.metrics
+
+
+# Tests that with the node cache, the modules left to run still run their
+# independent branches on the branch thread pool
+def test_node_cache_keeps_branches_parallel(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr("app.services.pipeline.PIPELINE_BRANCH_WORKERS", 2)
+    threads: set[str] = set()
+    blur_process_frame = BlurModule.process_frame
+
+    def recording_process_frame(
+        self: BlurModule, frame: np.ndarray, parameters: dict[str, Any]
+    ) -> np.ndarray:
+        threads.add(threading.current_thread().name)
+        return blur_process_frame(self, frame, parameters)
+
+    monkeypatch.setattr(BlurModule, "process_frame", recording_process_frame)
+    run_pipeline_streaming(build_pipeline_plan(pipeline_request(two_results=True)))
+
+    assert threads
+    assert all(name.startswith("pipeline-branch") for name in threads)
+
+
+# Tests that a module keeping state between frames gets every frame of every
+# run, in order, even with frame workers and the node cache enabled
+def test_stateful_module_gets_frames_in_order(
+    video_env: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    brightness: list[float] = []
+    blur_process_frame = BlurModule.process_frame
+
+    def recording_process_frame(
+        self: BlurModule, frame: np.ndarray, parameters: dict[str, Any]
+    ) -> np.ndarray:
+        brightness.append(float(frame.mean()))
+        return blur_process_frame(self, frame, parameters)
+
+    monkeypatch.setattr(BlurModule, "process_frame", recording_process_frame)
+    monkeypatch.setattr(BlurModule, "is_stateful", lambda self, parameters: True)
+    monkeypatch.setattr("app.services.pipeline.PIPELINE_FRAME_WORKERS", 3)
+    request = pipeline_request()
+    plan = build_pipeline_plan(request)
+
+    assert plan.stateful
+    for _ in range(2):
+        brightness.clear()
+        run_pipeline_plan(request, plan)
+        assert len(brightness) == FRAME_COUNT
+        assert brightness == sorted(brightness)
+
+
+# Tests that identical requests, even with other module ids, reuse the result
+def test_identical_requests_reuse_result(video_env: Path) -> None:
+    first = handle_pipeline_request(pipeline_request())
+
+    request = pipeline_request()
+    request.modules[1].id = "other-blur"
+    request.modules[2].source = ["other-blur"]
+    second = handle_pipeline_request(request)
+
+    assert second.left == first.left
+
+    # A missing output file is produced again
+    (video_env / "output" / first.left).unlink()
+    third = handle_pipeline_request(request)
+
+    assert third.left != first.left
+    assert (video_env / "output" / third.left).exists()
+
+
+# Tests that a background job reports its progress and result
+def test_job_completes_with_progress(video_env: Path) -> None:
+    jobs = PipelineJobManager(PipelineScheduler(1, 4, 1024**3), max_finished=4)
+
+    job = jobs.submit(pipeline_request(), "client")
+    assert job.future is not None
+    job.future.result(timeout=30)
+    status = jobs.get(job.id).snapshot()
+
+    assert status.state == JobState.COMPLETED
+    assert status.frames_done == status.total_frames == FRAME_COUNT
+    assert status.result is not None
+    assert (video_env / "output" / status.result.left).exists()
+    jobs.shutdown()
+
+
+# Tests that a running job stops at the next frame once cancelled
+def test_job_cancellation(video_env: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    started = threading.Event()
+    release = threading.Event()
+    blur_process_frame = BlurModule.process_frame
+
+    def blocking_process_frame(
+        self: BlurModule, frame: np.ndarray, parameters: dict[str, Any]
+    ) -> np.ndarray:
+        started.set()
+        release.wait(timeout=30)
+        return blur_process_frame(self, frame, parameters)
+
+    monkeypatch.setattr(BlurModule, "process_frame", blocking_process_frame)
+    jobs = PipelineJobManager(PipelineScheduler(1, 4, 1024**3), max_finished=4)
+
+    job = jobs.submit(pipeline_request(), "client")
+    assert started.wait(timeout=30)
+    jobs.cancel(job.id)
+    release.set()
+    assert job.future is not None
+    job.future.result(timeout=30)
+
+    status = job.snapshot()
+    assert status.state == JobState.CANCELLED
+    assert status.frames_done < FRAME_COUNT
+    assert status.result is None
+    assert not list((video_env / "output").glob("*.webm"))
+    jobs.shutdown()
@@ -0,0 +1,187 @@
+from typing import Any
+import numpy as np
+import pytest
+from app.db.convert_json_to_modules import get_all_mock_modules
+from app.modules.transforms.color import ColorModule
+from app.schemas.pipeline import PipelineRequest
+from app.services.pipeline import build_pipeline_plan
+
+
+@pytest.fixture(autouse=True)
+def modules() -> None:
+    get_all_mock_modules()
+
+
+def module(
+    mod_id: str, module_class: str, source: list[str], **params: Any
+) -> dict[str, Any]:
+    return {
+        "id": mod_id,
+        "name": mod_id,
+        "module_class": module_class,
+        "source": source,
+        "parameters": [{"key": key, "value": value} for key, value in params.items()],
+    }
+
+
+def color(mod_id: str, source: str, input: str, output: str) -> dict[str, Any]:
+    return module(
+        mod_id, "color", [source], input_colorspace=input, output_colorspace=output
+    )
+
+
+def resize(mod_id: str, source: str, width: int, height: int) -> dict[str, Any]:
+    return module(
+        mod_id, "resize", [source], width=width, height=height, interpolation="area"
+    )
+
+
+# Pipeline from a source through the given modules to one result per source id
+def request(modules: list[dict[str, Any]], *result_sources: str) -> PipelineRequest:
+    players = ["left", "right"]
+    return PipelineRequest.model_validate(
+        {
+            "modules": [
+                module("src", "video_source", [], path="missing.mp4"),
+                *modules,
+                *(
+                    module(
+                        f"result-{i}", "video_output", [sid], video_player=players[i]
+                    )
+                    for i, sid in enumerate(result_sources)
+                ),
+            ]
+        }
+    )
+
+
+# Tests that identity conversions are removed and their consumers rewired
+def test_removes_identity_color() -> None:
+    plan = build_pipeline_plan(
+        request(
+            [
+                color("same", "src", "RGB", "RGB"),
+                module("blur", "blur", ["same"], kernel_size=3, method="gaussian"),
+            ],
+            "blur",
+        )
+    )
+
+    assert [mod.id for mod in plan.processing_nodes] == ["blur"]
+    assert plan.processing_nodes[0].source == ["src"]
+    assert "same" not in plan.module_map
+
+
+# Tests that a resize chain is left alone: a downscale followed by an upscale
+# loses detail that a single resample to the final size would keep
+def test_keeps_resize_chain() -> None:
+    plan = build_pipeline_plan(
+        request(
+            [resize("down", "src", 64, 48), resize("up", "down", 320, 240)],
+            "up",
+        )
+    )
+
+    assert [mod.id for mod in plan.processing_nodes] == ["down", "up"]
+    assert plan.processing_nodes[1].source == ["down"]
+    assert plan.module_map["down"][1]["width"] == 64
+
+
+# Tests that color conversion chains are fused, except where an intermediate
+# result is also used elsewhere
+def test_fuses_color_chain() -> None:
+    plan = build_pipeline_plan(
+        request(
+            [
+                color("to-hsv", "src", "RGB", "HSV"),
+                color("to-rgb", "to-hsv", "HSV", "RGB"),
+                color("to-lab", "to-rgb", "RGB", "Lab"),
+                resize("small", "to-rgb", 64, 48),
+            ],
+            "to-lab",
+            "small",
+        )
+    )
+
+    nodes = {mod.id: mod for mod in plan.processing_nodes}
+    assert set(nodes) == {"to-rgb", "to-lab", "small"}
+    assert nodes["to-rgb"].source == ["src"]
+    assert plan.module_map["to-rgb"][1]["conversions"] == [
+        ["RGB", "HSV"],
+        ["HSV", "RGB"],
+    ]
+    assert nodes["to-lab"].source == ["to-rgb"]
+    assert "conversions" not in plan.module_map["to-lab"][1]
+
+
+# Tests that a fused chain gives the same output as the separate conversions,
+# at a width where OpenCV converts part of every row without SIMD
+@pytest.mark.parametrize(
+    "conversions",
+    [
+        [["RGB", "Lab"], ["Lab", "RGB"], ["RGB", "HSV"]],
+        [["RGB", "HSV"], ["HSV", "RGB"], ["RGB", "Lab"]],
+    ],
+)
+def test_fused_chain_matches_separate_conversions(
+    conversions: list[list[str]],
+) -> None:
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (48, 854, 3), dtype=np.uint8)
+    color_module = get_color_module()
+
+    fused = color_module.process_frame(
+        frame,
+        {
+            "input_colorspace": "RGB",
+            "output_colorspace": conversions[-1][1],
+            "conversions": conversions,
+        },
+    )
+
+    expected = frame
+    for input_color, output_color in conversions:
+        expected = color_module.match_colorspace(expected, input_color, output_color)
+    np.testing.assert_array_equal(fused, expected)
+
+
+def get_color_module() -> ColorModule:
+    plan = build_pipeline_plan(request([color("c", "src", "RGB", "HSV")], "c"))
+    mod_instance = plan.module_map["c"][0]
+    assert isinstance(mod_instance, ColorModule)
+    return mod_instance
+
+
+# Tests that modules not feeding a result are not run
+def test_removes_dead_modules() -> None:
+    plan = build_pipeline_plan(
+        request(
+            [
+                color("used", "src", "RGB", "HSV"),
+                module("unused", "blur", ["src"], kernel_size=3, method="gaussian"),
+            ],
+            "used",
+        )
+    )
+
+    assert [mod.id for mod in plan.processing_nodes] == ["used"]
+    assert set(plan.module_map) == {"src", "used", "result-0"}
+
+
+# Tests that identical branches are computed once and shared by both results
+def test_merges_identical_modules() -> None:
+    plan = build_pipeline_plan(
+        request(
+            [
+                module("blur-a", "blur", ["src"], kernel_size=5, method="gaussian"),
+                module("blur-b", "blur", ["src"], kernel_size=5, method="gaussian"),
+                resize("small-a", "blur-a", 64, 48),
+                resize("small-b", "blur-b", 64, 48),
+            ],
+            "small-a",
+            "small-b",
+        )
+    )
+
+    assert [mod.id for mod in plan.processing_nodes] == ["blur-a", "small-a"]
+    assert [mod.source for mod in plan.result_modules] == [["small-a"], ["small-a"]]
@@ -0,0 +1,154 @@
+from typing import cast
+import cv2
+import numpy as np
+import pytest
+from skimage.metrics import structural_similarity  # type: ignore
+from app.utils.enums import MetricsSampling, VideoFormats
+from app.utils.metrics_sampling import MetricsSampler
+from app.utils.quality_metrics import (
+    compute_bgr_metrics,
+    compute_metrics,
+    compute_metrics_batch,
+    compute_psnr,
+    compute_ssim,
+    compute_ssim_batch,
+    split_i420_planes,
+)
+
+
+# Smooth frame with texture, and a distorted copy of it
+def frame_pair(height: int, width: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    frame = cv2.GaussianBlur(frame, (5, 5), 0)
+    noise = rng.integers(-20, 21, frame.shape)
+    distorted = np.clip(frame.astype(np.int64) + noise, 0, 255).astype(np.uint8)
+    return frame, distorted
+
+
+# Previous implementations, kept as the reference
+def reference_psnr(img1: np.ndarray, img2: np.ndarray) -> float:
+    mse = np.mean((img1.astype(np.float32) - img2.astype(np.float32)) ** 2)
+    if mse == 0:
+        return 100.0
+    return float(20 * np.log10(255.0 / np.sqrt(mse)))
+
+
+def reference_ssim(img1: np.ndarray, img2: np.ndarray) -> float:
+    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    return cast(float, structural_similarity(gray1, gray2, full=False))
+
+
+# Tests that SSIM and PSNR match skimage and the float32 MSE on various sizes
+@pytest.mark.parametrize(
+    "height,width", [(7, 7), (8, 13), (48, 64), (240, 320), (181, 97)]
+)
+def test_matches_reference(height: int, width: int) -> None:
+    img1, img2 = frame_pair(height, width)
+
+    assert compute_ssim(img1, img2) == pytest.approx(
+        reference_ssim(img1, img2), abs=1e-12
+    )
+    assert compute_psnr(img1, img2) == pytest.approx(
+        reference_psnr(img1, img2), rel=1e-6
+    )
+
+
+# Tests the extremes: identical, inverted and flat frames
+def test_matches_reference_on_extremes() -> None:
+    img, _ = frame_pair(32, 32)
+    flat = np.full_like(img, 128)
+
+    for img1, img2 in [(img, img), (img, 255 - img), (flat, flat), (flat, img)]:
+        assert compute_ssim(img1, img2) == pytest.approx(
+            reference_ssim(img1, img2), abs=1e-12
+        )
+        assert compute_psnr(img1, img2) == pytest.approx(
+            reference_psnr(img1, img2), rel=1e-6
+        )
+    assert compute_psnr(img, img) == 100.0
+
+
+# Tests that scoring a stack of frames equals scoring them one by one
+def test_batch_matches_single_frames() -> None:
+    pairs = [frame_pair(36, 44, seed) for seed in range(5)]
+    frames1 = np.stack([img1 for img1, _ in pairs])
+    frames2 = np.stack([img2 for _, img2 in pairs])
+
+    batch = compute_metrics_batch(frames1, frames2)
+
+    for metrics, (img1, img2) in zip(batch, pairs):
+        single = compute_metrics(img1, img2)
+        assert metrics.psnr == pytest.approx(single.psnr, rel=1e-12)
+        assert metrics.ssim == pytest.approx(single.ssim, abs=1e-12)
+
+
+def test_rejects_images_smaller_than_window() -> None:
+    gray = np.zeros((1, 6, 20), dtype=np.uint8)
+
+    with pytest.raises(ValueError):
+        compute_ssim_batch(gray, gray)
+
+
+# Tests that I420 frames are scored per plane, without color conversion
+def test_i420_metrics_per_plane() -> None:
+    bgr1, bgr2 = frame_pair(48, 64)
+    yuv1 = cv2.cvtColor(bgr1, cv2.COLOR_BGR2YUV_I420)
+    yuv2 = cv2.cvtColor(bgr2, cv2.COLOR_BGR2YUV_I420)
+
+    metrics = compute_metrics(yuv1, yuv2, VideoFormats.YUV_I420)
+
+    (y1, u1, v1), (y2, u2, v2) = split_i420_planes(yuv1), split_i420_planes(yuv2)
+    assert y1.shape == (48, 64) and u1.shape == v1.shape == (24, 32)
+    assert metrics.psnr == pytest.approx(reference_psnr(y1, y2), rel=1e-6)
+    assert metrics.psnr_u == pytest.approx(reference_psnr(u1, u2), rel=1e-6)
+    assert metrics.psnr_v == pytest.approx(reference_psnr(v1, v2), rel=1e-6)
+    assert metrics.ssim == pytest.approx(
+        cast(float, structural_similarity(y1, y2, full=False)), abs=1e-12
+    )
+
+
+# Tests that BGR frames scored as I420 are converted first, and that frames of
+# odd dimensions get a message instead
+def test_bgr_metrics_as_i420() -> None:
+    bgr1, bgr2 = frame_pair(48, 64)
+
+    metrics = compute_bgr_metrics(bgr1, bgr2, VideoFormats.YUV_I420)
+
+    assert metrics == compute_metrics(
+        cv2.cvtColor(bgr1, cv2.COLOR_BGR2YUV_I420),
+        cv2.cvtColor(bgr2, cv2.COLOR_BGR2YUV_I420),
+        VideoFormats.YUV_I420,
+    )
+    assert compute_bgr_metrics(bgr1, bgr2) == compute_metrics(bgr1, bgr2)
+    odd1, odd2 = frame_pair(47, 64)
+    odd = compute_bgr_metrics(odd1, odd2, VideoFormats.YUV_I420)
+    assert odd.psnr is None and odd.message is not None
+
+
+def test_rejects_invalid_i420_shape() -> None:
+    with pytest.raises(ValueError):
+        split_i420_planes(np.zeros((50, 64), dtype=np.uint8))
+
+
+def test_samples_every_nth_frame() -> None:
+    sampler = MetricsSampler(MetricsSampling.EVERY_NTH, interval=3)
+    frame = np.zeros((8, 8, 3), dtype=np.uint8)
+
+    scored = [i for i in range(2, 12) if sampler.should_score(i, frame)]
+
+    assert scored == [3, 6, 9]
+
+
+# Tests that only the first frame and the frames after a cut are scored
+def test_samples_scene_changes() -> None:
+    sampler = MetricsSampler(MetricsSampling.SCENE_CHANGE, scene_threshold=30.0)
+    dark, _ = frame_pair(72, 128, seed=1)
+    dark //= 4
+    bright = 255 - dark
+    frames = [dark, dark, dark + 2, bright, bright, dark]
+
+    scored = [i for i, frame in enumerate(frames) if sampler.should_score(i, frame)]
+
+    assert scored == [0, 3, 5]
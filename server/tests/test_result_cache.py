@@ -0,0 +1,91 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import pytest
+from app.schemas.pipeline import PipelineResponse
+from app.services.result_cache import PipelineResultCache
+
+
+def response(name: str) -> PipelineResponse:
+    return PipelineResponse(left=name, right="", metrics=[])
+
+
+def always_valid(response: PipelineResponse) -> bool:
+    return True
+
+
+# Tests that a cached response is returned without running again
+def test_returns_cached_response() -> None:
+    cache = PipelineResultCache(max_entries=4)
+    calls: list[str] = []
+
+    def run() -> PipelineResponse:
+        calls.append("run")
+        return response("a.webm")
+
+    first = cache.get_or_run("key", run, always_valid)
+    second = cache.get_or_run("key", run, always_valid)
+
+    assert first == second
+    assert calls == ["run"]
+
+
+# Tests that invalid cached responses are computed again
+def test_reruns_invalid_response() -> None:
+    cache = PipelineResultCache(max_entries=4)
+    cache.get_or_run("key", lambda: response("a.webm"), always_valid)
+
+    result = cache.get_or_run("key", lambda: response("b.webm"), lambda response: False)
+
+    assert result.left == "b.webm"
+
+
+# In-flight runs of a cache, telling when a caller found a run to wait for
+class WatchedInFlight(dict[str, Future[PipelineResponse]]):
+    def __init__(self) -> None:
+        super().__init__()
+        self.joined = threading.Event()
+
+    def get(
+        self, key: str, default: Future[PipelineResponse] | None = None
+    ) -> Future[PipelineResponse] | None:
+        future = super().get(key, default)
+        if future is not None:
+            self.joined.set()
+        return future
+
+
+# Tests that concurrent identical requests share a single run. Nothing is kept
+# once the run ends, so a second caller only gets its response by waiting for
+# the run, which is held until that caller is waiting
+def test_coalesces_concurrent_requests() -> None:
+    cache = PipelineResultCache(max_entries=0)
+    in_flight = WatchedInFlight()
+    cache._in_flight = in_flight
+    calls: list[str] = []
+
+    def run() -> PipelineResponse:
+        calls.append("run")
+        assert in_flight.joined.wait(timeout=5)
+        return response("a.webm")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(
+            pool.map(lambda _: cache.get_or_run("key", run, always_valid), range(2))
+        )
+
+    assert calls == ["run"]
+    assert all(result.left == "a.webm" for result in results)
+
+
+# Tests that errors reach every waiter and are not cached
+def test_errors_are_not_cached() -> None:
+    cache = PipelineResultCache(max_entries=4)
+
+    def fail() -> PipelineResponse:
+        raise ValueError("pipeline failed")
+
+    with pytest.raises(ValueError, match="pipeline failed"):
+        cache.get_or_run("key", fail, always_valid)
+
+    result = cache.get_or_run("key", lambda: response("a.webm"), always_valid)
+    assert result.left == "a.webm"
@@ -0,0 +1,181 @@
+from typing import Any
+import threading
+import time
+import pytest
+from app.db.convert_json_to_modules import get_all_mock_modules
+from app.modules.inputs.video_source import VideoInfo
+from app.modules.transforms.blur import BlurModule
+from app.schemas.pipeline import PipelineRequest
+from app.services.pipeline import PipelineCancelledError, build_pipeline_plan
+from app.services.scheduler import (
+    PipelineScheduler,
+    SchedulerFullError,
+    SchedulerTicket,
+    estimate_plan_memory,
+)
+
+
+# Waits for the ticket on another thread until it is queued as ready
+def start_waiting(
+    scheduler: PipelineScheduler,
+    ticket: SchedulerTicket,
+    cancelled: threading.Event | None = None,
+) -> threading.Thread:
+    def wait() -> None:
+        try:
+            scheduler.wait(ticket, cancelled)
+        except PipelineCancelledError:
+            pass
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    while not ticket.ready:
+        time.sleep(0.001)
+    return thread
+
+
+# Admits the running ticket and returns it
+def start_running(
+    scheduler: PipelineScheduler, client_id: str, memory: int = 0
+) -> SchedulerTicket:
+    ticket = scheduler.enqueue(client_id, memory=memory)
+    scheduler.wait(ticket)
+    return ticket
+
+
+# Tests that no more than max_jobs runs are admitted at once
+def test_limits_concurrent_runs() -> None:
+    scheduler = PipelineScheduler(max_jobs=2, max_queued=8, memory_budget=100)
+    first = start_running(scheduler, "a")
+    second = start_running(scheduler, "b")
+
+    third = scheduler.enqueue("c")
+    thread = start_waiting(scheduler, third)
+    assert not third.admitted
+
+    scheduler.release(first)
+    thread.join(timeout=5)
+    assert third.admitted
+    scheduler.release(second)
+    scheduler.release(third)
+
+
+# Tests that higher priorities go first and clients take turns
+def test_priority_then_client_fairness() -> None:
+    scheduler = PipelineScheduler(max_jobs=1, max_queued=8, memory_budget=100)
+    running = start_running(scheduler, "a")
+
+    # Client "a" floods the queue before "b" and "c" submit
+    a_tickets = [scheduler.enqueue("a") for _ in range(3)]
+    b_ticket = scheduler.enqueue("b")
+    urgent = scheduler.enqueue("c", priority=5)
+    tickets = [*a_tickets, b_ticket, urgent]
+    threads = [start_waiting(scheduler, ticket) for ticket in tickets]
+
+    order: list[SchedulerTicket] = []
+    for _ in tickets:
+        scheduler.release(running)
+        running = next(t for t in tickets if t.admitted and t not in order)
+        order.append(running)
+    scheduler.release(running)
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order[0] is urgent
+    assert order[1] is b_ticket
+    assert order[2:] == a_tickets
+
+
+# Tests that runs wait until their estimated memory fits the budget, and that a
+# run larger than the budget still runs alone
+def test_memory_admission() -> None:
+    scheduler = PipelineScheduler(max_jobs=4, max_queued=8, memory_budget=100)
+    first = start_running(scheduler, "a", memory=60)
+
+    second = scheduler.enqueue("b", memory=60)
+    second_thread = start_waiting(scheduler, second)
+    assert not second.admitted
+
+    scheduler.release(first)
+    second_thread.join(timeout=5)
+    assert second.admitted
+
+    huge = scheduler.enqueue("c", memory=500)
+    huge_thread = start_waiting(scheduler, huge)
+    assert not huge.admitted
+
+    scheduler.release(second)
+    huge_thread.join(timeout=5)
+    assert huge.admitted
+    scheduler.release(huge)
+
+
+# Tests that a full queue refuses runs and cancelled runs give their place up
+def test_queue_limit_and_cancellation() -> None:
+    scheduler = PipelineScheduler(max_jobs=1, max_queued=1, memory_budget=100)
+    running = start_running(scheduler, "a")
+
+    queued = scheduler.enqueue("b")
+    with pytest.raises(SchedulerFullError):
+        scheduler.enqueue("c")
+
+    cancelled = threading.Event()
+    thread = start_waiting(scheduler, queued, cancelled)
+    cancelled.set()
+    thread.join(timeout=5)
+
+    assert queued.released and not queued.admitted
+    scheduler.release(scheduler.enqueue("c"))
+    scheduler.release(running)
+
+
+# Tests that blocking runs are refused past their own limit, while background
+# runs can still queue
+def test_blocking_queue_limit() -> None:
+    scheduler = PipelineScheduler(
+        max_jobs=1, max_queued=4, memory_budget=100, max_blocking=1
+    )
+    running = start_running(scheduler, "a")
+
+    blocked = scheduler.enqueue("b", blocking=True)
+    with pytest.raises(SchedulerFullError):
+        scheduler.enqueue("c", blocking=True)
+    queued = scheduler.enqueue("c")
+
+    scheduler.release(blocked)
+    scheduler.release(scheduler.enqueue("c", blocking=True))
+    scheduler.release(queued)
+    scheduler.release(running)
+
+
+# Tests that the memory estimate of a plan counts every frame of its batches
+def test_memory_estimate_counts_batches(monkeypatch: pytest.MonkeyPatch) -> None:
+    get_all_mock_modules()
+    request = PipelineRequest.model_validate(
+        {
+            "modules": [
+                module("src", "video_source", [], path="missing.mp4"),
+                module("blur", "blur", ["src"], kernel_size=5, method="gaussian"),
+                module("result", "video_output", ["blur"], video_player="left"),
+            ]
+        }
+    )
+    info = VideoInfo(fps=10.0, frame_count=100, width=64, height=48)
+    single = estimate_plan_memory(build_pipeline_plan(request), info)
+
+    monkeypatch.setattr(BlurModule, "get_batch_size", lambda self, parameters: 16)
+    batched = estimate_plan_memory(build_pipeline_plan(request), info)
+
+    assert batched == single * 16
+
+
+def module(
+    mod_id: str, module_class: str, source: list[str], **params: Any
+) -> dict[str, Any]:
+    return {
+        "id": mod_id,
+        "name": mod_id,
+        "module_class": module_class,
+        "source": source,
+        "parameters": [{"key": key, "value": value} for key, value in params.items()],
+    }
@@ -0,0 +1,83 @@
+from pathlib import Path
+import cv2
+import numpy as np
+import pytest
+from app.services import video_index
+from app.services.frame_stream import read_frames
+from app.services.video_index import (
+    DecodedFrameCache,
+    VideoIndexCache,
+    build_video_index,
+    read_video_frame,
+)
+
+FRAME_COUNT = 40
+WIDTH, HEIGHT = 64, 48
+
+
+# Writes a video long enough to have several keyframes
+@pytest.fixture
+def video_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(video_index, "video_indexes", VideoIndexCache(4))
+    monkeypatch.setattr(video_index, "decoded_frames", DecodedFrameCache(64 * 1024**2))
+    path = tmp_path / "video.mp4"
+    writer = cv2.VideoWriter(
+        str(path), getattr(cv2, "VideoWriter_fourcc")(*"mp4v"), 10.0, (WIDTH, HEIGHT)
+    )
+    for i in range(FRAME_COUNT):
+        frame = np.full((HEIGHT, WIDTH, 3), i * 5, dtype=np.uint8)
+        cv2.circle(frame, (i, HEIGHT // 2), 8, (255, 255, 255), -1)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def read_all(path: Path) -> list[np.ndarray]:
+    cap = cv2.VideoCapture(str(path))
+    frames: list[np.ndarray] = []
+    while (frame := cap.read())[0]:
+        frames.append(frame[1])
+    cap.release()
+    return frames
+
+
+# Tests that the index holds every frame's timestamp and the keyframes
+def test_builds_index(video_path: Path) -> None:
+    index = build_video_index(video_path)
+
+    assert index.frame_count == FRAME_COUNT
+    assert index.timestamps == pytest.approx([i * 100.0 for i in range(FRAME_COUNT)])
+    assert index.keyframes[0] == 0 and len(index.keyframes) > 1
+    assert index.get_keyframe(index.keyframes[1] - 1) == 0
+    assert index.get_keyframe(index.keyframes[1] + 1) == index.keyframes[1]
+    assert index.find_frame(1510.0) == 15
+    assert index.find_frame(FRAME_COUNT * 100.0) is None
+
+
+# Tests that single frames are read exactly, in any order, and that the frames
+# decoded on the way are cached
+def test_reads_any_frame(video_path: Path) -> None:
+    expected = read_all(video_path)
+    identity = "video"
+
+    for frame_index in (33, 5, 39, 0, 17):
+        frame = read_video_frame(video_path, identity, frame_index)
+        assert frame is not None
+        assert np.array_equal(frame, expected[frame_index])
+
+    keyframe = video_index.video_indexes.get(video_path).get_keyframe(33)
+    assert video_index.decoded_frames.get(identity, keyframe) is not None
+    assert read_video_frame(video_path, identity, FRAME_COUNT) is None
+
+
+# Tests that captures seek to the exact frame through the index
+def test_read_frames_seeks(video_path: Path) -> None:
+    expected = read_all(video_path)
+    index = video_index.video_indexes.get(video_path)
+    cap = cv2.VideoCapture(str(video_path))
+
+    for frame_index in (26, 3, 38):
+        frames = read_frames([cap], frame_index, [index])
+        assert frames is not None
+        assert np.array_equal(frames[0], expected[frame_index])
+    cap.release()